@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import random
+import threading
+import time
+
+from config_server import (
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_RETRY_AFTER,
+)
+
+# Admission waits kept for the percentiles of stats()
+WAIT_SAMPLES = 1024
+
+
+class Admission:
+    """
+    Admission control of new connections. Up to max_connections connections are
+    served, up to queue_size more wait for a free slot (first come, first served)
+    for queue_timeout seconds, the others are shed: the server answers them with
+    "/error server is busy <seconds>", a jittered hint when to come back, so the
+    clients of a reconnect storm do not all return at once.
+
+    arrive() never blocks, the accept loop calls it for every accepted socket,
+    a queued connection waits for its slot in its own thread or task.
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        queue_size=ADMISSION_QUEUE_SIZE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        retry_after=ADMISSION_RETRY_AFTER,
+    ):
+        """
+        :param max_connections: connections served at once
+        :param queue_size: connections waiting for a slot at most
+        :param queue_timeout: seconds a connection waits for a slot
+        :param retry_after: the hint of a shed client is between 1 and 2 times this
+        """
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry = retry_after
+
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+        self._waits = collections.deque(maxlen=WAIT_SAMPLES)
+        self.active = 0
+
+        self.accepted = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+
+    def arrive(self, start=None):
+        """
+        :param start: time.monotonic() when the connection was accepted
+        :return: True - admitted, None - shed, otherwise a waiter, the connection
+        is queued and is admitted if wait(waiter) returns True
+        """
+        with self._lock:
+            self.accepted += 1
+            if self.active < self.max_connections and not self._waiters:
+                self.active += 1
+                self.admitted += 1
+                self._waits.append(0.0)
+                return True
+            if len(self._waiters) >= self.queue_size:
+                self.shed += 1
+                return None
+            self.queued += 1
+            waiter = self._new_waiter()
+            self._waiters.append((waiter, start or time.monotonic()))
+            return waiter
+
+    def release(self) -> None:
+        """
+        A served connection is closed, its slot goes to the first queued one
+        :return: None
+        """
+        with self._lock:
+            while self._waiters:
+                waiter, start = self._waiters.popleft()
+                if self._wake(waiter):
+                    self.admitted += 1
+                    self._waits.append(time.monotonic() - start)
+                    return
+            self.active -= 1
+
+    def _timed_out(self, waiter) -> None:
+        """
+        Called under the lock, the waiter got no slot within queue_timeout
+        """
+        for entry in self._waiters:
+            if entry[0] is waiter:
+                self._waiters.remove(entry)
+                break
+        self.shed += 1
+
+    def retry_after(self) -> float:
+        """
+        :return: seconds a shed client should wait before it connects again
+        """
+        return self.retry * (1 + random.random())
+
+    def _new_waiter(self):
+        raise NotImplementedError
+
+    def _wake(self, waiter) -> bool:
+        """
+        Hands a free slot to the waiter
+        :return: False if the waiter gave up already
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = {
+                "active": self.active,
+                "waiting": len(self._waiters),
+                "accepted": self.accepted,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "shed": self.shed,
+            }
+        for p in (50, 99):
+            wait = waits[min(len(waits) - 1, len(waits) * p // 100)] if waits else 0.0
+            stats[f"wait_p{p}_ms"] = round(wait * 1000, 3)
+        return stats
+
+
+class ThreadedAdmission(Admission):
+    """
+    Admission of the threaded server, a queued connection waits in its own thread
+    """
+
+    def _new_waiter(self):
+        return threading.Event()
+
+    def _wake(self, waiter) -> bool:
+        waiter.set()
+        return True
+
+    def wait(self, waiter) -> bool:
+        """
+        Blocks until the queued connection has a slot
+        :param waiter: returned by arrive()
+        :return: False if no slot became free within queue_timeout, it is shed
+        """
+        if waiter.wait(self.queue_timeout):
+            return True
+        with self._lock:
+            # the slot may have been handed over just after the timeout
+            if waiter.is_set():
+                return True
+            self._timed_out(waiter)
+            return False
+
+
+class AsyncAdmission(Admission):
+    """
+    Admission of the asyncio server, a queued connection waits in its own task.
+    All its methods are called on the event loop.
+    """
+
+    def _new_waiter(self):
+        return asyncio.get_running_loop().create_future()
+
+    def _wake(self, waiter) -> bool:
+        if waiter.done():
+            return False
+        waiter.set_result(True)
+        return True
+
+    async def wait(self, waiter) -> bool:
+        """
+        :param waiter: returned by arrive()
+        :return: False if no slot became free within queue_timeout, it is shed
+        """
+        try:
+            return await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timed_out(waiter)
+            return False
@@ -0,0 +1,534 @@
+"""
+Headless load generator and benchmark for the chat server.
+
+Simulated clients speak the same protocol as client.py (/register, /login, /load,
+chat messages) without the GUI. By default a server is started in a child process
+with the in-memory storage backend (--storage), so no PostgreSQL is needed:
+
+    python3 benchmark.py --mode async --clients 2000 --senders 20 --messages 50
+
+Results are printed (or written to --output) as JSON.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+import uuid
+
+import supervisor
+from chat_util import Message, DataBase
+from codec import JSON
+from framing import FrameDecoder, READ_SIZE
+from logs import setup_logging
+from storage import create_backend
+from config_server import HISTORY_PAGE_SIZE
+
+
+def serve_in_process(
+    mode: str, host: str, port: int, max_connections: int, storage: str, workers: int
+) -> None:
+    """
+    Target of the server child process
+    :param mode: "threaded" or "async"
+    :param host:
+    :param port:
+    :param max_connections: overrides MAX_CONNECTIONS of config_server
+    :param storage: storage backend name, see STORAGE_BACKEND
+    :param workers: worker processes, more than 1 runs them under a Supervisor
+    :return: None
+    """
+    raise_fd_limit()
+    sys.stdout = open(os.devnull, "w")
+    setup_logging("WARNING")
+
+    worker_init = functools.partial(init_server, max_connections, storage)
+    if workers > 1:
+        supervisor.Supervisor(mode, host, port, workers, worker_init=worker_init).run()
+        return
+
+    if mode == "async":
+        import server_async as chat_server
+    else:
+        import server as chat_server
+
+    chat_server.run(host, port, db=worker_init(chat_server))
+
+
+def init_server(max_connections: int, storage: str, chat_server) -> DataBase:
+    """
+    Prepares the server module of a process (see supervisor.worker_main)
+    :param max_connections: overrides MAX_CONNECTIONS of config_server
+    :param storage: storage backend name
+    :param chat_server: server or server_async
+    :return: DataBase of the server
+    """
+    raise_fd_limit()
+    sys.stdout = open(os.devnull, "w")
+    setup_logging("WARNING")
+    chat_server.MAX_CONNECTIONS = max_connections
+    return DataBase(create_backend(storage))
+
+
+def raise_fd_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss_bytes(pid: int) -> int:
+    """
+    :param pid:
+    :return: resident memory of the process and its children (workers),
+    0 if it can not be read
+    """
+    rss = 0
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            for child in children.read().split():
+                rss += rss_bytes(int(child))
+    except OSError:
+        pass
+    return rss
+
+
+def summary(values: list) -> dict:
+    """
+    :param values: latencies in seconds
+    :return: count, mean, p50, p95, p99 and max in milliseconds
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def percentile(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+class BenchClient:
+    """
+    One simulated chat client
+    """
+
+    def __init__(self, bench, name: str, codecs=None):
+        """
+        :param bench:
+        :param name:
+        :param codecs: "codecs" of the login message, None - JSON only
+        """
+        self.bench = bench
+        self.name = name
+        self.codecs = codecs
+        self.codec = JSON
+        self.password = uuid.uuid4().hex
+        self.reader = None
+        self.writer = None
+        self.logged_in = asyncio.Event()
+        self.history_loaded = asyncio.Event()
+        self.error = None
+        self.session_token = None
+        self.flooder = False
+
+    async def connect(self, host: str, port: int, register=True, resume=False) -> float:
+        """
+        Connects and logs in
+        :param host:
+        :param port:
+        :param register: create the account
+        :param resume: /resume with the session token of the previous connection
+        :return: seconds from connect() to the welcome message (or /resumed),
+        including the retries of a client shed by a busy server
+        """
+        start = time.perf_counter()
+        while True:
+            self.logged_in.clear()
+            self.error = None
+            self.codec = JSON
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+            asyncio.get_running_loop().create_task(self.read_loop())
+
+            if resume:
+                text = f"/resume {self.session_token}"
+            else:
+                command = "/register" if register else "/login"
+                text = f"{command} {self.name}:{self.password}"
+            message = Message(text, self.name, [], codecs=self.codecs)
+            self.writer.write(message.encode(JSON))
+            await self.logged_in.wait()
+            if not self.error:
+                return time.perf_counter() - start
+            if not self.error.startswith("/error server is busy"):
+                raise ConnectionError(self.error)
+            # shed by the admission control, connect again after the hint
+            self.bench.shed += 1
+            self.close()
+            await asyncio.sleep(float(self.error.split(" ")[4]))
+
+    def send(self, text: str, recipients: list) -> None:
+        self.writer.write(Message(text, self.name, recipients).encode(self.codec))
+
+    async def load(self, limit: int) -> float:
+        """
+        :return: seconds from /load to /history_end
+        """
+        self.history_loaded.clear()
+        start = time.perf_counter()
+        self.send(f"/load {limit}", [])
+        await self.history_loaded.wait()
+        return time.perf_counter() - start
+
+    async def read_loop(self) -> None:
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    for decoded_data in Message.decode_all(payload):
+                        self.on_message(decoded_data)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if not self.logged_in.is_set():
+                self.error = self.error or "connection closed"
+                self.logged_in.set()
+
+    def on_message(self, decoded_data) -> None:
+        data_text = decoded_data.text
+        if data_text.startswith("/codec "):
+            self.codec = data_text.split(" ")[1]
+        elif data_text.startswith("bench "):
+            if not self.flooder:
+                sent = float(data_text.split(" ")[3])
+                self.bench.delivered(time.perf_counter() - sent)
+        elif data_text.startswith("flood "):
+            self.bench.flood_deliveries += 1
+        elif data_text == "/ping":
+            self.send("/pong", [])
+        elif data_text.startswith("/history_end"):
+            self.history_loaded.set()
+        elif data_text.startswith("/session ") or data_text.startswith("/resumed "):
+            self.session_token = data_text.split(" ")[1]
+            if data_text.startswith("/resumed "):
+                self.logged_in.set()
+        elif data_text.startswith("welcome to"):
+            self.logged_in.set()
+        elif data_text.startswith("/error rate limited"):
+            self.bench.rate_limit_errors += 1
+        elif data_text.startswith("/error"):
+            self.error = data_text
+            self.logged_in.set()
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Benchmark:
+    """
+    Runs the benchmark phases against one server and collects the results
+    """
+
+    def __init__(self, args, server_pid=None):
+        self.args = args
+        self.server_pid = server_pid
+        self.clients = []
+        self.message_latencies = []
+        self.expected_deliveries = 0
+        self.all_delivered = None
+        self.flood_deliveries = 0
+        self.rate_limit_errors = 0
+        self.shed = 0
+        self.codecs = {
+            "json": None,
+            "binary": ["binary"],
+            "binary+zlib": ["binary", "zlib"],
+        }[args.codec]
+
+    def delivered(self, latency: float) -> None:
+        self.message_latencies.append(latency)
+        if len(self.message_latencies) >= self.expected_deliveries:
+            self.all_delivered.set()
+
+    async def connect_clients(self) -> dict:
+        run_id = uuid.uuid4().hex[:6]
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+        failures = 0
+
+        async def connect(index):
+            nonlocal failures
+            client = BenchClient(self, f"bench_{run_id}_{index}", self.codecs)
+            async with semaphore:
+                try:
+                    latencies.append(
+                        await asyncio.wait_for(
+                            client.connect(self.args.host, self.args.port),
+                            self.args.timeout,
+                        )
+                    )
+                    self.clients.append(client)
+                except (ConnectionError, OSError, asyncio.TimeoutError):
+                    failures += 1
+                    client.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(connect(index) for index in range(self.args.clients)))
+        elapsed = time.perf_counter() - start
+        return {
+            "connected": len(self.clients),
+            "failed": failures,
+            "elapsed_s": round(elapsed, 3),
+            "logins_per_s": round(len(self.clients) / elapsed, 1) if elapsed else 0,
+            "shed": self.shed,
+            "latency": summary(latencies),
+        }
+
+    async def send_messages(self) -> dict:
+        senders = self.clients[: self.args.senders]
+        flooders = self.clients[len(senders) : len(senders) + self.args.flooders]
+        for client in flooders:
+            client.flooder = True
+        receivers = len(self.clients) - len(flooders) - 1
+        self.expected_deliveries = len(senders) * self.args.messages * receivers
+        self.all_delivered = asyncio.Event()
+        self.message_latencies = []
+        interval = 1 / self.args.rate if self.args.rate else 0
+        # like client.py, messages are addressed to everyone who is online
+        recipients = [client.name for client in self.clients]
+
+        async def send_from(index, client):
+            for seq in range(self.args.messages):
+                client.send(f"bench {index} {seq} {time.perf_counter()}", recipients)
+                await client.writer.drain()
+                await asyncio.sleep(interval)
+
+        flooding = True
+        flood_sent = 0
+
+        async def flood(client):
+            # as fast as the connection takes it, until the server disconnects it
+            nonlocal flood_sent
+            try:
+                while flooding:
+                    client.send(f"flood {flood_sent}", recipients)
+                    flood_sent += 1
+                    await client.writer.drain()
+                    await asyncio.sleep(0)
+            except (ConnectionError, OSError):
+                pass
+
+        flood_tasks = [asyncio.create_task(flood(client)) for client in flooders]
+        start = time.perf_counter()
+        await asyncio.gather(*(send_from(i, c) for i, c in enumerate(senders)))
+        try:
+            await asyncio.wait_for(self.all_delivered.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - start
+        flooding = False
+        await asyncio.gather(*flood_tasks)
+        # the server may have disconnected them, the next phases go without them
+        for client in flooders:
+            client.close()
+            self.clients.remove(client)
+
+        results = {
+            "senders": len(senders),
+            "messages_sent": len(senders) * self.args.messages,
+            "deliveries_expected": self.expected_deliveries,
+            "deliveries": len(self.message_latencies),
+            "elapsed_s": round(elapsed, 3),
+            "deliveries_per_s": round(len(self.message_latencies) / elapsed, 1)
+            if elapsed
+            else 0,
+            "latency": summary(self.message_latencies),
+        }
+        if flooders:
+            results["flood"] = {
+                "flooders": len(flooders),
+                "messages_sent": flood_sent,
+                "deliveries": self.flood_deliveries,
+                "rate_limit_errors": self.rate_limit_errors,
+            }
+        return results
+
+    async def load_history(self) -> dict:
+        clients = self.clients[: self.args.load_requests]
+        latencies = await asyncio.gather(
+            *(client.load(self.args.load_limit) for client in clients)
+        )
+        return {"limit": self.args.load_limit, "latency": summary(list(latencies))}
+
+    async def reconnect(self) -> dict:
+        """
+        Drops connections and reconnects them, half with /login, half with /resume
+        :return: latencies of both
+        """
+        clients = self.clients[: self.args.reconnects]
+        for client in clients:
+            client.close()
+        await asyncio.sleep(0.5)
+
+        half = len(clients) // 2
+        groups = {"login": (clients[:half], False), "resume": (clients[half:], True)}
+        results = {}
+        for name, (group, resume) in groups.items():
+            latencies = await asyncio.gather(
+                *(
+                    asyncio.wait_for(
+                        client.connect(
+                            self.args.host, self.args.port, register=False, resume=resume
+                        ),
+                        self.args.timeout,
+                    )
+                    for client in group
+                ),
+                return_exceptions=True,
+            )
+            done = [value for value in latencies if isinstance(value, float)]
+            results[name] = summary(done)
+            results[name]["failures"] = len(latencies) - len(done)
+        return results
+
+    async def run(self) -> dict:
+        results = {
+            "mode": self.args.mode if self.server_pid else "external",
+            "storage": self.args.storage if self.server_pid else "external",
+            "workers": self.args.workers if self.server_pid else "external",
+            "codec": self.args.codec,
+            "clients": self.args.clients,
+        }
+
+        rss_before = rss_bytes(self.server_pid) if self.server_pid else 0
+        results["connect"] = await self.connect_clients()
+        if self.server_pid:
+            await asyncio.sleep(0.5)
+            rss_after = rss_bytes(self.server_pid)
+            results["memory"] = {
+                "rss_before_bytes": rss_before,
+                "rss_after_bytes": rss_after,
+                "bytes_per_connection": (rss_after - rss_before) // len(self.clients)
+                if self.clients
+                else 0,
+            }
+
+        if len(self.clients) >= 2 and self.args.messages:
+            results["broadcast"] = await self.send_messages()
+        if self.clients and self.args.load_requests:
+            results["load"] = await self.load_history()
+        if len(self.clients) >= 2 and self.args.reconnects:
+            results["reconnect"] = await self.reconnect()
+
+        for client in self.clients:
+            client.close()
+        return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Chat server benchmark")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="async")
+    parser.add_argument(
+        "--target",
+        help="host:port of a running server, by default a server with "
+        "in-memory storage is started in a child process",
+    )
+    parser.add_argument("--port", type=int, default=8765, help="port of the child server")
+    parser.add_argument(
+        "--storage",
+        choices=["memory", "sqlite", "postgres"],
+        default="memory",
+        help="storage backend of the child server",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="worker processes of the child server"
+    )
+    parser.add_argument(
+        "--codec",
+        choices=["json", "binary", "binary+zlib"],
+        default="json",
+        help="wire format the clients ask for",
+    )
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100, help="parallel logins")
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=0,
+        help="MAX_CONNECTIONS of the child server, 0 - enough for all clients",
+    )
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20, help="per sender")
+    parser.add_argument("--rate", type=float, default=0, help="messages/s per sender, 0 - max")
+    parser.add_argument(
+        "--flooders",
+        type=int,
+        default=0,
+        help="clients sending as fast as they can while the senders send",
+    )
+    parser.add_argument("--load-requests", type=int, default=50)
+    parser.add_argument("--load-limit", type=int, default=HISTORY_PAGE_SIZE)
+    parser.add_argument(
+        "--reconnects", type=int, default=100, help="clients reconnecting, half with /resume"
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+
+    server = None
+    if args.target:
+        args.host, port = args.target.rsplit(":", 1)
+        args.port = int(port)
+    else:
+        args.host = "127.0.0.1"
+        server = multiprocessing.Process(
+            target=serve_in_process,
+            args=(
+                args.mode,
+                args.host,
+                args.port,
+                args.max_connections or args.clients + 1,
+                args.storage,
+                args.workers,
+            ),
+        )
+        server.start()
+        time.sleep(1 + 0.25 * args.workers)
+
+    try:
+        results = asyncio.run(Benchmark(args, server.pid if server else None).run())
+    finally:
+        if server is not None:
+            server.kill()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import Future
+
+from framing import encode_frame, FrameDecoder, FrameError, READ_SIZE
+from config_server import BUS_TIMEOUT
+
+log = logging.getLogger("chat.bus")
+
+
+def encode_bus_message(header: dict, body=b"") -> bytes:
+    """
+    A bus message is one frame: a JSON header line, followed by the body
+    (for "route" the frame of the chat message, forwarded without re-encoding)
+    :param header: {"op": ..., ...}
+    :param body:
+    :return: frame
+    """
+    return encode_frame(json.dumps(header).encode("utf-8") + b"\n" + body)
+
+
+def decode_bus_message(payload: bytes) -> tuple:
+    """
+    :param payload:
+    :return: (header, body)
+    """
+    header, _, body = payload.partition(b"\n")
+    return json.loads(header), body
+
+
+class BusHub:
+    """
+    Hub of the local message bus between the worker processes, runs in the supervisor.
+    Workers connect over a Unix-domain socket. The hub owns the cluster-wide
+    directory of usernames, so a user can not log in twice through different
+    workers, tells the workers who joins and leaves, and forwards chat frames
+    only to the workers of their recipients.
+
+    Operations sent by workers:
+    claim <username> -> claimed <ok>, release <username>, join <username>,
+    route <recipients> + frame.
+    Operations sent to workers:
+    roster <usernames> (on connect), join <username>, leave <username>,
+    route <recipients> + frame.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: path of the Unix-domain socket
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._workers = {}
+        self._owners = {}
+        self._online = set()
+        self._sock = None
+
+    def start(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(64)
+        threading.Thread(target=self._accept, name="bus-hub", daemon=True).start()
+
+    def close(self) -> None:
+        self._sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            with self._lock:
+                self._workers[conn] = threading.Lock()
+                roster = sorted(self._online)
+            self._send(conn, encode_bus_message({"op": "roster", "usernames": roster}))
+            threading.Thread(target=self._serve, args=[conn], daemon=True).start()
+
+    def _serve(self, conn) -> None:
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = conn.recv(READ_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    header, body = decode_bus_message(payload)
+                    self._handle(conn, header, body)
+        except (OSError, FrameError, ValueError) as e:
+            log.warning("Bus worker connection lost: %s", e)
+        finally:
+            self._drop(conn)
+
+    def _handle(self, conn, header: dict, body: bytes) -> None:
+        op = header.get("op")
+
+        if op == "route":
+            recipients = header.get("to", [])
+            with self._lock:
+                if "All users" in recipients:
+                    targets = [worker for worker in self._workers if worker is not conn]
+                else:
+                    targets = {
+                        self._owners[username]
+                        for username in recipients
+                        if username in self._owners
+                    }
+                    targets.discard(conn)
+            message = encode_bus_message(header, body)
+            for worker in targets:
+                self._send(worker, message)
+            return
+
+        username = header.get("username")
+        if op == "claim":
+            with self._lock:
+                owner = self._owners.get(username)
+                ok = owner is None or owner is conn
+                if ok:
+                    self._owners[username] = conn
+            self._send(conn, encode_bus_message({"op": "claimed", "id": header["id"], "ok": ok}))
+
+        elif op == "join":
+            with self._lock:
+                if self._owners.get(username) is not conn:
+                    return
+                self._online.add(username)
+            self._announce(conn, {"op": "join", "username": username})
+
+        elif op == "release":
+            with self._lock:
+                if self._owners.get(username) is not conn:
+                    return
+                del self._owners[username]
+                if username not in self._online:
+                    return
+                self._online.discard(username)
+            self._announce(conn, {"op": "leave", "username": username})
+
+    def _drop(self, conn) -> None:
+        """
+        A worker is gone (e.g. crashed), its users are released
+        :param conn:
+        :return: None
+        """
+        with self._lock:
+            self._workers.pop(conn, None)
+            usernames = [name for name, owner in self._owners.items() if owner is conn]
+            left = []
+            for username in usernames:
+                del self._owners[username]
+                if username in self._online:
+                    self._online.discard(username)
+                    left.append(username)
+        conn.close()
+        for username in left:
+            self._announce(None, {"op": "leave", "username": username})
+
+    def _announce(self, sender, header: dict) -> None:
+        """
+        Sends the message to all workers except the sender
+        """
+        message = encode_bus_message(header)
+        with self._lock:
+            workers = [worker for worker in self._workers if worker is not sender]
+        for worker in workers:
+            self._send(worker, message)
+
+    def _send(self, conn, message: bytes) -> None:
+        lock = self._workers.get(conn)
+        if lock is None:
+            return
+        with lock:
+            try:
+                conn.sendall(message)
+            except OSError:
+                pass
+
+
+class BusClient:
+    """
+    Connection of a worker to the BusHub. Messages from the hub are read on
+    a separate thread and passed to the handler given to connect().
+    """
+
+    def __init__(self, path: str, timeout=BUS_TIMEOUT):
+        """
+        :param path: path of the Unix-domain socket of the hub
+        :param timeout: seconds to wait for the reply to a claim
+        """
+        self.path = path
+        self.handler = None
+        self.timeout = timeout
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._ids = itertools.count()
+
+    def connect(self, handler) -> None:
+        """
+        :param handler: handler(header, body), called for roster, join, leave and route
+        :return: None
+        """
+        self.handler = handler
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        threading.Thread(target=self._run, name="bus-client", daemon=True).start()
+
+    def claim(self, username: str) -> bool:
+        """
+        Reserves the username in the whole cluster, blocks until the hub replies
+        :param username:
+        :return: False if the user is logged in through another worker
+        """
+        future = Future()
+        request_id = next(self._ids)
+        self._pending[request_id] = future
+        try:
+            self._send({"op": "claim", "id": request_id, "username": username})
+            return future.result(timeout=self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def release(self, username: str) -> None:
+        self._send({"op": "release", "username": username})
+
+    def join(self, username: str) -> None:
+        self._send({"op": "join", "username": username})
+
+    def publish(self, frame: bytes, recipients: list) -> None:
+        """
+        Sends the frame to the workers of the recipients (to all for "All users")
+        :param frame: frame of the chat message
+        :param recipients:
+        :return: None
+        """
+        self._send({"op": "route", "to": recipients}, frame)
+
+    def _send(self, header: dict, body=b"") -> None:
+        message = encode_bus_message(header, body)
+        with self._send_lock:
+            self._sock.sendall(message)
+
+    def _run(self) -> None:
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = self._sock.recv(READ_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    header, body = decode_bus_message(payload)
+                    if header["op"] == "claimed":
+                        future = self._pending.get(header["id"])
+                        if future is not None:
+                            future.set_result(header["ok"])
+                    else:
+                        self.handler(header, body)
+        except (OSError, FrameError, ValueError) as e:
+            log.error("Bus connection lost: %s", e)
+
+        # without the hub the worker can not serve its users correctly,
+        # the supervisor starts a new one
+        log.error("Bus hub is gone, worker exits")
+        os._exit(1)
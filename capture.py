@@ -0,0 +1,189 @@
+"""
+Capture of the frames received by the server, replayed by replay.py.
+
+The capture file starts with MAGIC, then records are appended one after another:
+
+    +---------------+------------+------+--------+
+    | time          | connection | kind | length |  then length bytes of body
+    | u64 (us, UTC) | u32        | u8   | u32    |
+    +---------------+------------+------+--------+
+
+OPEN and CLOSE have no body, FRAME has the payload of a received frame as it came
+(JSON or binary), LOGIN the username a connection logged in with (after /login,
+/register or /resume succeeded). Passwords and session tokens of the frames
+received before the login are replaced with "*". A server started again with the
+same file appends to it, its connections get new numbers.
+"""
+import atexit
+import itertools
+import logging
+import struct
+import threading
+import time
+
+from chat_util import Message
+from codec import JSON
+from framing import FrameError
+
+MAGIC = b"CHATCAP1"
+RECORD = struct.Struct("!QIBI")
+
+OPEN = 1
+FRAME = 2
+LOGIN = 3
+CLOSE = 4
+
+# Seconds between flushes of the file, a killed server loses the records of the last one
+FLUSH_INTERVAL = 1
+AUTH_COMMANDS = ("/login", "/register", "/resume")
+
+log = logging.getLogger("chat.capture")
+
+
+def redact(payload: bytes) -> bytes:
+    """
+    :param payload: frame received from a client that is not logged in
+    :return: the payload with the password of /login and /register and the token
+    of /resume replaced with "*", other frames are not changed
+    """
+    try:
+        message = Message.decode(payload)
+    except (FrameError, ValueError):
+        return payload
+    words = message.text.split(" ")
+    if not message.text.startswith(AUTH_COMMANDS) and not any(
+        command in message.text for command in AUTH_COMMANDS[:2]
+    ):
+        return payload
+
+    if words[0] == "/resume" and len(words) > 1:
+        words[1] = "*"
+    else:
+        words = [word.split(":")[0] + ":*" if ":" in word else word for word in words]
+    return Message(
+        " ".join(words), message.author, [], message.datetime, codecs=message.codecs
+    ).payload(JSON)
+
+
+def start_capture(path: str):
+    """
+    :param path: capture file, "" - off
+    :return: CaptureWriter, flushed and closed when the process exits, or None
+    """
+    if not path:
+        return None
+    capture = CaptureWriter(path)
+    atexit.register(capture.shutdown)
+    log.info("Capturing the received frames to %s", path)
+    return capture
+
+
+def read_capture(path: str):
+    """
+    :param path: capture file
+    :return: generator of (time in microseconds, connection, kind, body),
+    a record cut off at the end (the server was killed while writing it) is skipped
+    """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            head = file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            timestamp, connection, kind, length = RECORD.unpack(head)
+            body = file.read(length)
+            if len(body) < length:
+                return
+            yield timestamp, connection, kind, body
+
+
+class CaptureWriter:
+    """
+    Appends the records of the server's connections to a capture file. Records
+    are written to the file buffer under a lock, so a frame costs a memory copy,
+    a thread flushes the buffer every FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: capture file, created or appended to
+        """
+        self.path = path
+        last = 0
+        try:
+            last = max((record[1] for record in read_capture(path)), default=0)
+        except FileNotFoundError:
+            pass
+
+        self._file = open(path, "ab", buffering=1024 * 1024)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._ids = {}
+        self._next_id = itertools.count(last + 1)
+        self._lock = threading.Lock()
+
+        self.records = 0
+        threading.Thread(target=self._flush_loop, name="capture", daemon=True).start()
+
+    def open(self, user) -> None:
+        """
+        A new connection
+        :param user:
+        :return: None
+        """
+        with self._lock:
+            self._ids[user] = next(self._next_id)
+        self._write(OPEN, user, b"")
+
+    def frame(self, user, payload: bytes) -> None:
+        """
+        :param user:
+        :param payload: frame received from the user
+        :return: None
+        """
+        if not user.logged_in:
+            payload = redact(payload)
+        self._write(FRAME, user, payload)
+
+    def login(self, user) -> None:
+        """
+        The user logged in, the username is recorded
+        :param user:
+        :return: None
+        """
+        self._write(LOGIN, user, user.username.encode("utf-8"))
+
+    def close(self, user) -> None:
+        """
+        The connection is closed
+        :param user:
+        :return: None
+        """
+        self._write(CLOSE, user, b"")
+        with self._lock:
+            self._ids.pop(user, None)
+
+    def _write(self, kind: int, user, body: bytes) -> None:
+        record = RECORD.pack(time.time_ns() // 1000, self._ids.get(user, 0), kind, len(body))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(record + body)
+            self.records += 1
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            with self._lock:
+                if self._file.closed:
+                    return
+                self._file.flush()
+
+    def shutdown(self) -> None:
+        """
+        Flushes and closes the file, later records are ignored
+        :return: None
+        """
+        with self._lock:
+            self._file.close()
@@ -1,32 +1,60 @@
+import atexit
 import datetime
 import json
-
-import psycopg2
-
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from codec import JSON, encode_json, encode_binary, decode_binary, pack, unpack, is_json
+from credentials import CredentialCache, hash_password, verify_password, needs_rehash
+from framing import FrameError, HEADER
+from history_cache import HistoryCache
+from metrics import DB_SECONDS
+from ratelimit import RateLimiter
+from storage import get_backend, page_limit, parse_datetime, search_terms, MAX_TEXT_LENGTH
 from config_server import (
-    DATABASE,
-    DB_USER,
-    DB_PASSWORD,
-    DB_HOST,
-    SERVER_NAME,
-    SERVER_ACCOUNT_PASSWORD,
+    DB_WRITE_BATCH_SIZE,
+    DB_WRITE_BATCH_INTERVAL,
+    DB_WRITE_QUEUE_SIZE,
+    DB_WRITE_DURABILITY,
+    HISTORY_PAGE_SIZE,
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_CHUNK_SIZE,
+    HISTORY_CACHE_USER_MESSAGES,
+    SEARCH_PAGE_SIZE,
+    PASSWORD_HASH_WORKERS,
+    CREDENTIAL_CACHE_TTL,
 )
 
+log = logging.getLogger("chat.db")
+
+
+# (second, formatted), the time is formatted once per second
+_now = (0, "")
 
-def make_message(
-    text: str,
-    author_name: str,
-    recipient_names: list,
-    m_datetime=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-) -> json:
-    """
-    Converts the collected data to JSON
-    :param text:
-    :param author_name:
-    :param recipient_names:
-    :param m_datetime: Optional, if not, the time and date is now
-    :return: json message
-    Return example:
+
+def current_datetime() -> str:
+    """
+    :return: the time and date now, in the format of the "datetime" field of messages
+    """
+    global _now
+    second = int(time.time())
+    if _now[0] != second:
+        _now = (second, datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S"))
+    return _now[1]
+
+
+# sets the attributes of a Message, its own __setattr__ refuses
+_init = object.__setattr__
+
+
+class Message:
+    """
+    A chat message. It is immutable, so its frame for each wire format is encoded
+    once, on first use, and the same bytes are shared by every recipient.
+    Example of its JSON format:
     message = {
         "author": 'Arrow',
         "recipient": ['Aggosh', 'Anton'],
@@ -35,16 +63,240 @@ def make_message(
     }
     """
 
-    if author_name in recipient_names:
-        recipient_names.remove(author_name)
+    __slots__ = ("text", "author", "recipients", "datetime", "message_id", "codecs", "_encoded")
 
-    message = {
-        "author": author_name,
-        "recipient": recipient_names,
-        "text": text,
-        "datetime": m_datetime,
-    }
-    return json.dumps(message)
+    def __init__(
+        self,
+        text: str,
+        author_name: str,
+        recipient_names,
+        m_datetime=None,
+        message_id=None,
+        codecs=None,
+    ):
+        """
+        :param text:
+        :param author_name:
+        :param recipient_names: the author is left out, the list is not changed
+        :param m_datetime: Optional, if not, the time and date is now
+        :param message_id: Optional, sequence id of a saved message
+        :param codecs: Optional, wire formats a client asks for in /login or /register
+        """
+        if author_name in recipient_names:
+            recipients = tuple(name for name in recipient_names if name != author_name)
+        else:
+            recipients = tuple(recipient_names)
+        _init(self, "text", text)
+        _init(self, "author", author_name)
+        _init(self, "recipients", recipients)
+        _init(self, "datetime", m_datetime or current_datetime())
+        _init(self, "message_id", message_id)
+        _init(self, "codecs", codecs)
+        _init(self, "_encoded", {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Message is immutable")
+
+    def __repr__(self) -> str:
+        return f"Message({self.to_dict()!r})"
+
+    def to_dict(self) -> dict:
+        """
+        :return: the message in its JSON format
+        """
+        message = {
+            "author": self.author,
+            "recipient": list(self.recipients),
+            "text": self.text,
+            "datetime": self.datetime,
+        }
+        if self.message_id is not None:
+            message["message_id"] = self.message_id
+        if self.codecs is not None:
+            message["codecs"] = self.codecs
+        return message
+
+    def payload(self, codec: str) -> bytes:
+        """
+        :param codec: wire format, see codec.py
+        :return: payload of the message, not framed
+        """
+        if codec == JSON:
+            return encode_json(self.to_dict())
+        return encode_binary(
+            self.author, self.recipients, self.text, self.datetime, self.message_id
+        )
+
+    def encode(self, codec: str) -> bytes:
+        """
+        :param codec: wire format, see codec.py
+        :return: frame of the message, cached
+        """
+        frame = self._encoded.get(codec)
+        if frame is None:
+            frame = self._encoded[codec] = pack([self.payload(codec)], codec)
+        return frame
+
+    @classmethod
+    def from_dict(cls, message: dict):
+        """
+        :param message: a message in its JSON format
+        :return: Message
+        """
+        if not isinstance(message, dict) or not isinstance(message.get("text"), str):
+            raise FrameError("message without text")
+        recipients = message.get("recipient")
+        if not isinstance(recipients, list):
+            recipients = []
+        codecs = message.get("codecs")
+        return cls(
+            message["text"],
+            message.get("author"),
+            recipients,
+            m_datetime=str(message.get("datetime") or ""),
+            message_id=message.get("message_id"),
+            codecs=codecs if isinstance(codecs, list) else None,
+        )
+
+    @classmethod
+    def decode_all(cls, payload: bytes) -> list:
+        """
+        :param payload: frame payload in any wire format
+        :return: list of Message, several for a batch
+        """
+        messages = []
+        for part in unpack(payload):
+            if is_json(part):
+                messages.append(cls.from_dict(json.loads(part)))
+            else:
+                author, recipients, text, m_datetime, message_id = decode_binary(part)
+                messages.append(cls(text, author, recipients, m_datetime, message_id))
+        return messages
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        """
+        :param payload: frame payload in any wire format that carries a single message
+        :return: Message
+        """
+        if is_json(payload):
+            return cls.from_dict(json.loads(payload))
+        messages = cls.decode_all(payload)
+        if len(messages) != 1:
+            raise FrameError("expected a single message")
+        return messages[0]
+
+    @classmethod
+    def from_frame(cls, frame: bytes):
+        """
+        Decodes a whole JSON frame and keeps it as the message's JSON encoding,
+        used for frames forwarded by the bus
+        :param frame:
+        :return: Message
+        """
+        message = cls.decode(frame[HEADER.size :])
+        message._encoded[JSON] = frame
+        return message
+
+
+class MessagePage:
+    """
+    Messages sent together, e.g. a chunk of history: one (compressed) frame
+    for the binary wire format, consecutive frames for JSON
+    """
+
+    __slots__ = ("messages",)
+
+    def __init__(self, messages: list):
+        self.messages = messages
+
+    def encode(self, codec: str) -> bytes:
+        return pack([message.payload(codec) for message in self.messages], codec)
+
+
+def parse_load_command(data_text: str) -> tuple:
+    """
+    Parses "/load", "/load <n>" and "/load <n> before <message_id>"
+    Invalid values fall back to the defaults.
+    :param data_text:
+    :return: (limit, before), before is None for the newest page
+    """
+    limit = HISTORY_PAGE_SIZE
+    before = None
+
+    splitted_data = data_text.split(" ")
+    try:
+        if len(splitted_data) >= 2:
+            limit = int(splitted_data[1])
+        if len(splitted_data) >= 4 and splitted_data[2] == "before":
+            before = int(splitted_data[3])
+    except ValueError:
+        pass
+
+    return limit, before
+
+
+def parse_sync_command(data_text: str) -> int:
+    """
+    Parses "/sync <message_id>", an invalid or missing id is 0 (everything)
+    :param data_text:
+    :return: message_id of the last message the client has seen
+    """
+    splitted_data = data_text.split(" ")
+    try:
+        return max(0, int(splitted_data[1]))
+    except (IndexError, ValueError):
+        return 0
+
+
+def parse_search_command(data_text: str) -> tuple:
+    """
+    Parses "/search <words>" and "/search from <offset> <words>" (the next pages)
+    :param data_text:
+    :return: (query, offset)
+    """
+    splitted_data = data_text.split(" ")[1:]
+    offset = 0
+    if len(splitted_data) >= 2 and splitted_data[0] == "from":
+        try:
+            offset = max(0, int(splitted_data[1]))
+            splitted_data = splitted_data[2:]
+        except ValueError:
+            pass
+
+    return " ".join(splitted_data), offset
+
+
+def server_reply(message, server_name: str, command: str):
+    """
+    Parses a reply of the server on the client, e.g. "/presence <version> +alice".
+    Chat messages of other users that only look like one are not replies.
+    :param message: received Message
+    :param server_name: username of the server, from /server_name
+    :param command: e.g. "/presence" or "/error server is busy"
+    :return: list of the words after the command, None if the message is not this reply
+    """
+    text = message.text
+    if message.author != server_name:
+        return None
+    if text != command and not text.startswith(command + " "):
+        return None
+    return text[len(command) + 1:].split(" ") if text != command else []
+
+
+def timed(op: str, chunks):
+    """
+    Passes the chunks of a history query through, the time until the last one
+    (or until the query is closed) is observed as chat_db_seconds of op
+    :param op: "load_history", "load_since" or "search"
+    :param chunks: generator of the storage backend
+    :return: generator of the same chunks
+    """
+    start = time.perf_counter()
+    try:
+        yield from chunks
+    finally:
+        DB_SECONDS.labels(op).observe(time.perf_counter() - start)
 
 
 class User:
@@ -65,9 +317,26 @@ class User:
         self.password = password
         self.socket = socket
         self.address = address
+        self.outbox = None
+        self.codec = JSON
+        self.limiter = RateLimiter()
+        # time.monotonic() of the last frame received and of an unanswered /ping,
+        # see heartbeat.Heartbeat
+        self.last_seen = 0.0
+        self.ping_sent = 0.0
 
         self.logged_in = False
 
+    def send(self, message, essential=False) -> bool:
+        """
+        Queues the message to the user's outbox, it is written by the outbox writer
+        :param message: Message or MessagePage, encoded in the codec of the user
+        :param essential: presence or a reply to the user's own request,
+        such frames are not dropped for a slow user
+        :return: True if the frame was queued
+        """
+        return self.outbox.put(message.encode(self.codec), essential)
+
     def login(self) -> bool:
         if self.db.login(self.username, self.password):
             self.logged_in = True
@@ -85,67 +354,74 @@ class User:
 
 
 class DataBase:
-    @staticmethod
-    def init() -> None:
+    """
+    Accounts and messages storage, the work is delegated to a storage backend,
+    by default the one chosen by STORAGE_BACKEND in config_server.py.
+    Recent history is served from a HistoryCache when HISTORY_CACHE_USER_MESSAGES > 0.
+    Passwords are hashed and verified on a pool of PASSWORD_HASH_WORKERS threads,
+    verified logins are kept in a CredentialCache when CREDENTIAL_CACHE_TTL > 0.
+    """
+
+    def __init__(self, backend=None):
+        """
+        :param backend: StorageBackend, default is storage.get_backend()
+        """
+        self.backend = backend or get_backend()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+        self.history_cache = None
+        if HISTORY_CACHE_USER_MESSAGES > 0:
+            self.history_cache = HistoryCache(self._load_newest)
+
+        self.credential_cache = None
+        if CREDENTIAL_CACHE_TTL > 0:
+            self.credential_cache = CredentialCache()
+        self._hasher = None
+        # accounts are never deleted, a name seen once is known for good
+        self._known_users = set()
+
+    def init(self) -> None:
         """
         Database initialization, creating tables: accounts, messages, accounts_messages
         and creating an account for messages from the server
         :return: None
         """
-        with DataConn() as cursor:
-            cursor.execute(
-                "CREATE TABLE accounts ("
-                "user_id serial PRIMARY KEY,"
-                "username VARCHAR ( 50 ) UNIQUE NOT NULL,"
-                "password VARCHAR ( 50 ) NOT NULL);"
-            )
-
-            cursor.execute(
-                "CREATE TABLE messages ("
-                "message_id serial PRIMARY KEY,"
-                "author VARCHAR ( 50 ) NOT NULL,"
-                "text VARCHAR ( 2048 ) NOT NULL,"
-                "datetime timestamp NOT NULL,"
-                "FOREIGN KEY (author) REFERENCES accounts(username) ON DELETE CASCADE);"
-            )
-
-            cursor.execute(
-                "CREATE TABLE accounts_messages ("
-                "message_id integer,"
-                "recipient VARCHAR ( 50 ),"
-                "FOREIGN KEY (recipient) REFERENCES accounts(username) ON DELETE CASCADE,"
-                "FOREIGN KEY (message_id) REFERENCES messages(message_id) ON DELETE CASCADE,"
-                "PRIMARY KEY (message_id, recipient));"
-            )
-
-            cursor.execute(
-                "INSERT INTO accounts (username, password) VALUES"
-                f"('{SERVER_NAME}', '{SERVER_ACCOUNT_PASSWORD}');"
-            )
+        self.backend.init()
 
     def register(self, username: str, password: str) -> bool:
         """
-        Adds a record with new user data to the database. If there is no table, then the self.init () method is called
+        Adds a record with new user data to the database
         :param username:
         :param password:
         :return: True if the record has been added, False if something went wrong,
         for example, such a user already exists.
         """
-        with DataConn() as cursor:
-            try:
-                cursor.execute(
-                    "INSERT INTO accounts (username, password) VALUES"
-                    f"('{username}', '{password}');"
-                )
-            except psycopg2.errors.UniqueViolation:
-                print(f"User {username} already exist")
-                return False
+        return self.submit_register(username, password).result()
 
-            except psycopg2.errors.UndefinedTable:
-                self.init()
-                return self.register(username, password)
+    def submit_register(self, username: str, password: str) -> Future:
+        """
+        Hashes the password and adds the account on the hasher pool
+        :param username:
+        :param password:
+        :return: Future resolved with the result of register()
+        """
+        return self.password_hasher().submit(self._register, username, password)
 
-        return True
+    def _register(self, username: str, password: str) -> bool:
+        start = time.perf_counter()
+        try:
+            if self.backend.get_password(username) is not None:
+                log.info("User %s already exist", username)
+                return False
+            if not self.backend.register(username, hash_password(password)):
+                return False
+            self._known_users.add(username)
+            if self.credential_cache is not None:
+                self.credential_cache.add(username, password)
+            return True
+        finally:
+            DB_SECONDS.labels("register").observe(time.perf_counter() - start)
 
     def login(self, username: str, password: str) -> bool:
         """
@@ -154,89 +430,467 @@ class DataBase:
         :param password:
         :return: False or True
         """
-        with DataConn() as cursor:
-            try:
-                cursor.execute(
-                    f"SELECT * FROM accounts WHERE username='{username}' AND password='{password}';"
-                )
-                records = cursor.fetchall()
-            except psycopg2.errors.UndefinedTable:
-                self.init()
-                return self.login(username, password)
+        return self.submit_login(username, password).result()
 
-            if records:
-                return True
-            else:
+    def submit_login(self, username: str, password: str) -> Future:
+        """
+        A recently verified login is answered from the credential cache at once,
+        otherwise the password is verified on the hasher pool
+        :param username:
+        :param password:
+        :return: Future resolved with the result of login()
+        """
+        if self.credential_cache is not None and self.credential_cache.check(
+            username, password
+        ):
+            future = Future()
+            future.set_result(True)
+            return future
+        return self.password_hasher().submit(self._login, username, password)
+
+    def _login(self, username: str, password: str) -> bool:
+        start = time.perf_counter()
+        try:
+            stored = self.backend.get_password(username)
+            if stored is None or not verify_password(password, stored):
                 return False
+            if needs_rehash(stored):
+                self.backend.set_password(username, hash_password(password))
+            if self.credential_cache is not None:
+                self.credential_cache.add(username, password)
+            return True
+        finally:
+            DB_SECONDS.labels("login").observe(time.perf_counter() - start)
 
-    @staticmethod
-    def new_message(author: str, recipients: list, text: str, m_datetime: str) -> None:
+    def password_hasher(self) -> ThreadPoolExecutor:
+        """
+        :return: the threads hashing passwords, started on first use
+        """
+        if self._hasher is None:
+            with self._writer_lock:
+                if self._hasher is None:
+                    self._hasher = ThreadPoolExecutor(
+                        max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password"
+                    )
+        return self._hasher
+
+    def recipients_known(self, recipients: list) -> bool:
+        """
+        :param recipients: usernames or ["All users"]
+        :return: True if all the recipients are known to have an account,
+        answered without the database
+        """
+        return all(
+            username == "All users" or username in self._known_users for username in recipients
+        )
+
+    def unknown_recipients(self, recipients: list) -> list:
+        """
+        Recipients without an account, a message to them can not be saved
+        :param recipients: usernames or ["All users"]
+        :return: the usernames that do not exist
+        """
+        names = [
+            username
+            for username in dict.fromkeys(recipients)
+            if username != "All users" and username not in self._known_users
+        ]
+        if not names:
+            return []
+        start = time.perf_counter()
+        existing = self.backend.existing_users(names)
+        DB_SECONDS.labels("existing_users").observe(time.perf_counter() - start)
+        self._known_users.update(existing)
+        return [username for username in names if username not in existing]
+
+    def new_message(self, author: str, recipients: list, text: str, m_datetime: str) -> None:
         """
-        Saves the message to the database
+        Saves the message to the database. The message is queued to the background
+        writer, with DB_WRITE_DURABILITY = "flush" the call returns after the batch
+        containing it was committed, with "async" it returns at once.
         :param author:
         :param recipients:
         :param text:
         :param m_datetime:
         :return: None
+        :raises WriterBusy: too many messages are waiting, this one is not saved
+        """
+        future = self.submit_message(author, recipients, text, m_datetime)
+        if DB_WRITE_DURABILITY == "flush":
+            future.result()
+
+    def submit_message(
+        self, author: str, recipients: list, text: str, m_datetime: str
+    ) -> Future:
+        """
+        Queues the message to the background writer without waiting
+        :param author:
+        :param recipients:
+        :param text:
+        :param m_datetime:
+        :return: Future resolved with message_id once the message is committed
+        :raises WriterBusy: too many messages are waiting, this one is not saved
         """
         if len(recipients) == 0:
+            future = Future()
+            future.set_result(None)
+            return future
+
+        future = self.message_writer().submit(author, recipients, text, m_datetime)
+        if self.history_cache is not None:
+            future.add_done_callback(
+                lambda done: self._cache_message(done, author, recipients, text, m_datetime)
+            )
+        return future
+
+    def _cache_message(self, future, author, recipients, text, m_datetime) -> None:
+        """
+        Write-through of a saved message to the history cache,
+        runs on the writer thread before the message is delivered
+        """
+        if future.exception() is None:
+            self.history_cache.add(
+                future.result(), author, recipients, text, parse_datetime(m_datetime)
+            )
+
+    def cache_message(self, message) -> None:
+        """
+        Write-through of a message saved by another worker process
+        :param message: Message, skipped if it has no message_id
+        :return: None
+        """
+        if self.history_cache is None or message.message_id is None:
             return
+        self.history_cache.add(
+            message.message_id,
+            message.author,
+            message.recipients,
+            message.text,
+            parse_datetime(message.datetime),
+        )
 
-        with DataConn() as cursor:
-            cursor.execute(
-                "INSERT INTO messages (author, text, datetime) VALUES"
-                f"('{author}', '{text}', '{m_datetime}') RETURNING message_id;"
+    def message_writer(self):
+        """
+        :return: the MessageWriter of this database, started on first use
+        """
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = MessageWriter(self.backend, known_users=self._known_users)
+                    atexit.register(self._writer.close)
+        return self._writer
+
+    def writer_stats(self) -> dict:
+        """
+        :return: counters of the message writer, empty before the first message
+        """
+        if self._writer is None:
+            return {}
+        return self._writer.stats()
+
+    def load_history(
+        self, username: str, limit=HISTORY_PAGE_SIZE, before=None, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        """
+        Loads a page of messages written by the user or if the user was the recipient,
+        newest first. Pages are addressed by message_id (keyset pagination).
+        :param username:
+        :param limit: page size, capped at HISTORY_MAX_PAGE_SIZE
+        :param before: message_id, only older messages are loaded. None - newest
+        :param chunk_size: rows fetched at once
+        :return: generator of lists of (message_id, text, author, datetime)
+        """
+        if self.history_cache is None:
+            yield from timed(
+                "load_history", self.backend.load_history(username, limit, before, chunk_size)
             )
-            records = cursor.fetchall()
-            message_id = records[0][0]
-            for recip in recipients:
-                cursor.execute(
-                    f"INSERT INTO accounts_messages (message_id, recipient) VALUES ({message_id}, '{recip}');"
-                )
+            return
+
+        records = self.history_cache.load(username, page_limit(limit), before)
+        if records is None:
+            yield from timed(
+                "load_history", self.backend.load_history(username, limit, before, chunk_size)
+            )
+            return
 
-    @staticmethod
-    def load_message(username, limit=10) -> list:
+        for start in range(0, len(records), chunk_size):
+            yield records[start : start + chunk_size]
+
+    def load_since(
+        self, username: str, after: int, limit=HISTORY_MAX_PAGE_SIZE, chunk_size=HISTORY_CHUNK_SIZE
+    ):
         """
-        Loads messages written by the user or if the user was the recipient.
-        Does not download messages that have no recipient.
+        Loads the messages of the user saved after message_id "after", oldest first,
+        used to catch up a client that reconnects
         :param username:
-        :param limit: default is 10
-        :return:
-        """
-        with DataConn() as cursor:
-            cursor.execute(
-                f"SELECT messages.text, messages.author, messages.datetime FROM messages "
-                f"JOIN accounts_messages on accounts_messages.message_id = messages.message_id "
-                f"JOIN accounts on accounts.username = accounts_messages.recipient "
-                f"WHERE messages.author = '{username}' OR accounts_messages.recipient = '{username}' LIMIT {limit};"
+        :param after: message_id of the last message the client has seen
+        :param limit: page size, capped at HISTORY_MAX_PAGE_SIZE
+        :param chunk_size: rows fetched at once
+        :return: generator of lists of (message_id, text, author, datetime)
+        """
+        records = None
+        if self.history_cache is not None:
+            records = self.history_cache.load_since(username, after, page_limit(limit))
+        if records is None:
+            yield from timed(
+                "load_since", self.backend.load_since(username, after, limit, chunk_size)
             )
-            records = cursor.fetchall()
-            print(records)
+            return
 
-        return records
+        for start in range(0, len(records), chunk_size):
+            yield records[start : start + chunk_size]
+
+    def search(
+        self,
+        username: str,
+        query: str,
+        limit=SEARCH_PAGE_SIZE,
+        offset=0,
+        chunk_size=HISTORY_CHUNK_SIZE,
+    ):
+        """
+        Full-text search in the messages written by the user or if the user was the
+        recipient, through the index of the storage. A message matches if it
+        contains all the words of the query, best matches first.
+        :param username:
+        :param query: words to search for
+        :param limit: page size
+        :param offset: matches skipped, for the next pages
+        :param chunk_size: rows fetched at once
+        :return: generator of lists of (message_id, text, author, datetime)
+        """
+        yield from timed(
+            "search",
+            self.backend.search(username, search_terms(query), limit, offset, chunk_size),
+        )
+
+    def _load_newest(self, username: str, limit: int) -> list:
+        """
+        Loader of the history cache
+        :param username:
+        :param limit:
+        :return: the newest records of the user, newest first
+        """
+        return [
+            record
+            for records in timed("load_history", self.backend.load_history(username, limit))
+            for record in records
+        ]
+
+    def load_message(self, username, limit=HISTORY_PAGE_SIZE) -> list:
+        """
+        Loads the newest messages written by the user or if the user was the recipient.
+        :param username:
+        :param limit: default is HISTORY_PAGE_SIZE
+        :return: list of (text, author, datetime), newest first
+        """
+        return [
+            record[1:]
+            for records in self.load_history(username, limit)
+            for record in records
+        ]
 
 
-class DataConn:
+class WriterBusy(Exception):
     """
-    Context manager for working with the database.
+    Raised by MessageWriter.submit when DB_WRITE_QUEUE_SIZE messages are waiting
     """
 
-    def __init__(self, name=DATABASE, user=DB_USER, password=DB_PASSWORD, host=DB_HOST):
-        self.database = name
-        self.user = user
-        self.password = password
-        self.host = host
 
-    def __enter__(self):
-        self.conn = psycopg2.connect(
-            dbname=self.database, user=self.user, password=self.password, host=self.host
-        )
-        self.cursor = self.conn.cursor()
-        return self.cursor
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.commit()
-        self.cursor.close()
-        self.conn.close()
-        if exc_val:
-            raise Exception(exc_val)
+class MessageWriter:
+    """
+    Write-behind persistence of chat messages. Messages are queued by submit() and
+    saved by a background thread in batches, one transaction of the backend per batch
+    (for PostgreSQL: one multi-row INSERT into messages, one into accounts_messages).
+    """
+
+    def __init__(
+        self,
+        backend,
+        batch_size=DB_WRITE_BATCH_SIZE,
+        interval=DB_WRITE_BATCH_INTERVAL,
+        queue_size=DB_WRITE_QUEUE_SIZE,
+        known_users=None,
+    ):
+        """
+        :param backend: StorageBackend the messages are saved to
+        :param batch_size: max messages in one transaction
+        :param interval: seconds to wait for more messages before flushing a batch
+        :param queue_size: max queued messages, submit() raises WriterBusy when it is full
+        :param known_users: set of usernames known to have an account, shared with
+        DataBase, authors and recipients of a batch missing from it are checked
+        in one query before the batch is saved
+        """
+        self.backend = backend
+        self.known_users = known_users if known_users is not None else set()
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.batches = 0
+        self.saved = 0
+        self.failed = 0
+
+    def submit(self, author: str, recipients: list, text: str, m_datetime: str) -> Future:
+        """
+        Queues the message for saving, never blocks
+        :param author:
+        :param recipients:
+        :param text:
+        :param m_datetime:
+        :return: Future resolved with message_id once the message is committed
+        :raises WriterBusy: the queue is full, the message is not saved
+        """
+        if self._thread is None:
+            self._start()
+
+        future = Future()
+        recipients = list(dict.fromkeys(recipients))
+        try:
+            self._queue.put_nowait(
+                (author, recipients, text, m_datetime, future, time.perf_counter())
+            )
+        except queue.Full:
+            raise WriterBusy(f"{self._queue.maxsize} messages are waiting to be saved")
+        return future
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="message-writer", daemon=True
+                )
+                self._thread.start()
+
+    def close(self) -> None:
+        """
+        Saves everything that is still queued and stops the writer thread
+        :return: None
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=max(remaining, 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+
+    def _flush(self, batch: list) -> None:
+        """
+        Saves the valid messages of the batch in one transaction, messages that
+        can not be saved (unknown users, text too long) are failed before.
+        If the transaction still fails on a row (backend.data_errors), the batch is
+        split in halves, so a bad message costs a few more transactions, not one
+        per message. Any other error (database down, no free connection) fails the
+        whole batch at once.
+        :param batch: list of (author, recipients, text, m_datetime, future, submitted),
+        submitted is the time.perf_counter() of submit()
+        :return: None
+        """
+        batch = self._check(batch)
+        if batch:
+            self._save(batch)
+
+    def _check(self, batch: list) -> list:
+        """
+        :param batch:
+        :return: the messages of the batch that can be saved, the futures of
+        the others are failed
+        """
+        names = set()
+        for author, recipients, _, _, _, _ in batch:
+            names.add(author)
+            names.update(recipients)
+        names.discard("All users")
+        missing = names - self.known_users
+        if missing:
+            try:
+                self.known_users.update(self.backend.existing_users(list(missing)))
+            except Exception as e:
+                # the transaction of the batch will fail the same way
+                log.error("Users of a batch of messages were not checked: %s", e)
+                return batch
+            missing -= self.known_users
+
+        valid = []
+        for item in batch:
+            author, recipients, text = item[:3]
+            unknown = missing.intersection([author, *recipients])
+            if unknown:
+                error = ValueError("unknown users " + " ".join(sorted(unknown)))
+            elif len(text) > MAX_TEXT_LENGTH:
+                error = ValueError(f"text longer than {MAX_TEXT_LENGTH} characters")
+            else:
+                valid.append(item)
+                continue
+            self.failed += 1
+            log.warning("Message from %s was not saved: %s", author, error)
+            item[4].set_exception(error)
+        return valid
+
+    def _save(self, batch: list) -> None:
+        start = time.perf_counter()
+        try:
+            message_ids = self._insert(batch)
+        except self.backend.data_errors as e:
+            if len(batch) > 1:
+                half = len(batch) // 2
+                self._save(batch[:half])
+                self._save(batch[half:])
+                return
+            self.failed += 1
+            log.error("Message from %s was not saved: %s", batch[0][0], e)
+            batch[0][4].set_exception(e)
+            return
+        except Exception as e:
+            # splitting would only repeat the failure once per half
+            self.failed += len(batch)
+            log.error("Batch of %s messages was not saved: %s", len(batch), e)
+            for item in batch:
+                item[4].set_exception(e)
+            return
+
+        now = time.perf_counter()
+        DB_SECONDS.labels("save_messages").observe(now - start)
+        new_message = DB_SECONDS.labels("new_message")
+        self.batches += 1
+        self.saved += len(batch)
+        for message_id, item in zip(message_ids, batch):
+            new_message.observe(now - item[5])
+            item[4].set_result(message_id)
+
+    def _insert(self, batch: list) -> list:
+        """
+        :param batch:
+        :return: message_id of every message of the batch, in the same order
+        """
+        return self.backend.save_messages([item[:4] for item in batch])
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "saved": self.saved,
+            "failed": self.failed,
+        }
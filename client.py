@@ -1,7 +1,7 @@
 import sys
 import socket
-import json
 import hashlib
+import time
 
 
 from threading import Thread
@@ -19,7 +19,24 @@ from PyQt5.QtWidgets import (
     QCheckBox,
 )
 
-from chat_util import make_message
+from chat_util import Message, server_reply
+from codec import JSON
+from framing import FrameDecoder, FrameError
+
+# After losing the connection the client logs in again and catches up with /sync
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 2
+# Wire formats the client asks for at login, the server confirms one with /codec
+CLIENT_CODECS = ["binary", "zlib"]
+
+
+def send_message(message) -> None:
+    """
+    Sends the message to the server, in the wire format confirmed by /codec
+    :param message: Message
+    :return: None
+    """
+    SERVER.sendall(message.encode(CODEC))
 
 
 class Window(QDialog):
@@ -98,13 +115,10 @@ class Window(QDialog):
         font = self.chat.font()
         font.setPointSize(13)
         self.chat.setFont(font)
-        message = make_message(text, self.client_username.text(), RECIPIENT_LIST)
-        message_json = json.loads(message)
-        self.chat.append(
-            f"{message_json.get('datetime')} {message_json.get('author')}: {message_json.get('text')}"
-        )
+        message = Message(text, self.client_username.text(), RECIPIENT_LIST)
+        self.chat.append(f"{message.datetime} {message.author}: {message.text}")
         try:
-            SERVER.send(message.encode())
+            send_message(message)
         except (OSError, AttributeError) as e:
             self.rise_error(e)
         self.chatTextField.setText("")
@@ -189,6 +203,14 @@ class ClientThread(Thread):
         self.window.show_login()
         self.client_name = "UNDEFINED_CLIENT_NAME"
         self.server_name = "UNDEFINED_SERVER_NAME"
+        self.presence_epoch = ""
+        self.presence_version = 0
+        self.last_message_id = 0
+        self.synced_ids = None
+        self.awaiting_codec = False
+        self.session_token = None
+        self.resuming = False
+        self.retry_after = 0
 
     def run(self):
         host = window.host_textbox.text()
@@ -202,27 +224,60 @@ class ClientThread(Thread):
         self.client_name = window.login_textbox.text()
         password = window.password_textbox.text()
         hash_password = hashlib.md5(password.encode()).hexdigest()
+        register = window.register_checkbox.isChecked()
+
+        attempts = 0
+        while True:
+            if self.connect(host, port, hash_password, register):
+                error = self.receive()
+                if error is None:
+                    return
+                # the account exists now, reconnects log in
+                register = False
+            else:
+                error = "can not connect to the server"
+
+            attempts += 1
+            if self.retry_after and attempts <= RECONNECT_ATTEMPTS:
+                # the server is full, it tells when to come back
+                window.chat.append(f"(server is busy, retrying in {self.retry_after:.0f} s)")
+                time.sleep(self.retry_after)
+                self.retry_after = 0
+                continue
+            if self.last_message_id == 0 or attempts > RECONNECT_ATTEMPTS:
+                self.window.rise_error(error)
+                return
+            window.chat.append(f"(connection lost: {error}, reconnecting...)")
+            time.sleep(RECONNECT_DELAY)
 
-        BUFFER_SIZE = 1024
-        global SERVER
+    def connect(self, host: str, port: int, hash_password: str, register: bool) -> bool:
+        """
+        Connects to the server and sends /resume with the session token of
+        the previous connection, or /login (or /register)
+        :param host:
+        :param port:
+        :param hash_password:
+        :param register: True to create a new account
+        :return: True if the request was sent
+        """
+        global SERVER, CODEC
         SERVER = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        CODEC = JSON
+        self.awaiting_codec = True
         try:
             SERVER.connect((host, port))
-            print(f"register: {window.register_checkbox.isChecked()}")
-            if window.register_checkbox.isChecked():
-                message = make_message(
-                    f"/register {self.client_name}:{hash_password}",
-                    self.client_name,
-                    RECIPIENT_LIST,
+            print(f"register: {register}")
+            self.resuming = self.session_token is not None
+            if self.resuming:
+                text = (
+                    f"/resume {self.session_token} "
+                    f"{self.presence_epoch}.{self.presence_version}"
                 )
-                SERVER.send(message.encode())
             else:
-                message = make_message(
-                    f"/login {self.client_name}:{hash_password}",
-                    self.client_name,
-                    RECIPIENT_LIST,
-                )
-                SERVER.send(message.encode())
+                command = "/register" if register else "/login"
+                text = f"{command} {self.client_name}:{hash_password}"
+            message = Message(text, self.client_name, RECIPIENT_LIST, codecs=CLIENT_CODECS)
+            send_message(message)
         except (
             OSError,
             AttributeError,
@@ -231,64 +286,217 @@ class ClientThread(Thread):
             ValueError,
             socket.gaierror,
         ) as e:
-            self.window.rise_error(e)
+            print(f"ERROR: {e}")
+            return False
+        return True
 
+    def receive(self):
+        """
+        Handles messages from the server until the connection is closed
+        :return: None if the client should stop, the error if the connection was lost
+        """
+        BUFFER_SIZE = 65536
+        decoder = FrameDecoder()
         while True:
             try:
                 data = SERVER.recv(BUFFER_SIZE)
+                if not data:
+                    raise ConnectionResetError("Connection closed by the server")
+
+                for payload in decoder.feed(data):
+                    try:
+                        messages = Message.decode_all(payload)
+                    except ValueError as e:
+                        print(f"Decode error: {e}")
+                        continue
+
+                    for decoded_data in messages:
+                        try:
+                            if not self.process_message(decoded_data):
+                                return None
+                        except (ValueError, IndexError) as e:
+                            # a malformed reply is skipped, the connection stays open
+                            print(f"Invalid message from {decoded_data.author}: {e}")
+
+            except (OSError, FrameError) as e:
+                SERVER.close()
+                return e
+
+    def sync(self) -> None:
+        """
+        Requests the messages saved after the last one the client has seen.
+        Messages that also arrive live while syncing are shown once.
+        :return: None
+        """
+        if self.synced_ids is None:
+            self.synced_ids = set()
+        send_message(Message(f"/sync {self.last_message_id}", self.client_name, []))
 
-                # for multiline messages
-                if "__+\|SPLIT|/+__" in data.decode("utf-8"):
-                    for message in data.decode("utf-8").split("__+\|SPLIT|/+__"):
-                        print(f"splited to: {message}")
-                        decoded_data = json.loads(message)
-                        if not self.process_message(decoded_data):
-                            break
-                else:
-                    decoded_data = json.loads(data.decode("utf-8"))
-                    if not self.process_message(decoded_data):
-                        break
-
-            except ConnectionResetError as e:
-                self.window.rise_error(e)
-                break
-
-            except json.decoder.JSONDecodeError:
-                print(f'Decode json error: {data.decode("utf-8")}')
-                continue
-
-    def process_message(self, decoded_data: str) -> bool:
+    def process_message(self, decoded_data) -> bool:
         """
         Handles messages from the server, including special messages (/server_name (sets the server name),
-        /error (triggers an error alert), /now_online (records which users are currently online))
+        /error (triggers an error alert), /now_online (records which users are currently online),
+        /presence (applies joins and leaves to the recorded users),
+        /undelivered (shows recipients that did not get the message),
+        /history_end (shows the cursor for loading older messages),
+        /search_end (shows the offset of the next page of search results),
+        /sent (id of the client's own message), /sync_end (end of a catch-up),
+        /codec (the server switches to the binary wire format),
+        /session (token for /resume), /resumed (the session was restored),
+        /error rate limited (a message was dropped, sent too fast),
+        /error unknown recipients (a message to users without an account was dropped),
+        /error message dropped (the server could not queue a message for saving),
+        /error message not saved (the server could not save a message),
+        /error server is busy (connect again after the given seconds),
+        /ping (the server checks the connection, answered with /pong))
         :param decoded_data:
         :return:
         """
-        data_text = decoded_data.get("text")
+        data_text = decoded_data.text
+        # nothing of other users arrives before the reply to /login, /register or /resume
+        first_reply = self.awaiting_codec
+        if self.awaiting_codec:
+            # only the first reply to /login or /register may switch the format
+            self.awaiting_codec = False
+            if data_text.startswith("/codec "):
+                global CODEC
+                CODEC = data_text.split(" ")[1]
+                return True
+
+        message_id = decoded_data.message_id
+        if message_id is not None:
+            self.last_message_id = max(self.last_message_id, message_id)
+
         if "/server_name" in data_text:
             self.server_name = data_text.split(" ")[1]
             window.server_username.setText(self.server_name)
+            if self.last_message_id:
+                self.sync()
+
+        elif data_text.startswith("/sent") and decoded_data.author == self.server_name:
+            self.last_message_id = max(self.last_message_id, int(data_text.split(" ")[1]))
 
-        elif "/error" in data_text:
+        elif data_text.startswith("/sync_end") and decoded_data.author == self.server_name:
+            if data_text.endswith(" more"):
+                self.sync()
+            else:
+                self.synced_ids = None
+
+        elif data_text.startswith("/session ") and decoded_data.author == self.server_name:
+            self.session_token = data_text.split(" ")[1]
+
+        elif data_text.startswith("/resumed ") and decoded_data.author == self.server_name:
+            self.session_token = data_text.split(" ")[1]
+            self.resuming = False
+            if self.last_message_id:
+                self.sync()
+
+        elif data_text == "/ping" and decoded_data.author == self.server_name:
+            send_message(Message("/pong", self.client_name, []))
+
+        elif data_text.startswith("/error rate limited") and decoded_data.author == self.server_name:
+            # the message was dropped, the connection stays open
+            window.chat.append(f"(sending too fast, wait {data_text.split(' ')[3]} s)")
+
+        elif data_text.startswith("/error unknown recipients") and decoded_data.author == self.server_name:
+            # the message was dropped, the connection stays open
+            window.chat.append(f"(not sent, no such users: {' '.join(data_text.split(' ')[3:])})")
+
+        elif data_text.startswith("/error message dropped") and decoded_data.author == self.server_name:
+            window.chat.append("(not sent, the server is busy, send it again)")
+
+        elif data_text.startswith("/error message not saved") and decoded_data.author == self.server_name:
+            window.chat.append(f"(not sent, {' '.join(data_text.split(' ')[4:])}, send it again)")
+
+        elif data_text.startswith("/error server is busy") and (
+            first_reply or decoded_data.author == self.server_name
+        ):
+            # turned away before the login, the server name is not known yet
+            try:
+                self.retry_after = float(data_text.split(" ")[4])
+            except (IndexError, ValueError):
+                self.retry_after = RECONNECT_DELAY
+            raise ConnectionResetError(data_text)
+
+        elif data_text.startswith("/error") and (
+            first_reply or decoded_data.author == self.server_name
+        ):
+            if self.resuming:
+                # the session expired, the next attempt logs in with the password
+                self.session_token = None
+                raise ConnectionResetError(data_text)
             self.window.rise_error(data_text)
             return False
 
-        elif "/now_online" in data_text:
+        elif server_reply(decoded_data, self.server_name, "/history_end") is not None:
+            before = server_reply(decoded_data, self.server_name, "/history_end")[0]
+            if before:
+                window.chat.append(
+                    f"(older messages: /load <n> before {before})"
+                )
+
+        elif data_text.startswith("/search_end") and decoded_data.author == self.server_name:
+            offset = data_text.split(" ")[1]
+            if offset:
+                window.chat.append(f"(more results: /search from {offset} <words>)")
+            else:
+                window.chat.append("(no more results)")
+
+        elif server_reply(decoded_data, self.server_name, "/now_online") is not None:
             global RECIPIENT_LIST
-            RECIPIENT_LIST = []
-            data_text.split(" ")
-            for recipient in data_text.split(" ")[1:]:
-                RECIPIENT_LIST.append(recipient)
+            splitted_data = server_reply(decoded_data, self.server_name, "/now_online")
+            epoch, _, version = splitted_data[0].partition(".")
+            self.presence_version = int(version)
+            self.presence_epoch = epoch
+            RECIPIENT_LIST = splitted_data[1:]
+
+        elif server_reply(decoded_data, self.server_name, "/presence") is not None:
+            self.apply_presence(server_reply(decoded_data, self.server_name, "/presence"))
+
+        elif "/undelivered" in data_text:
+            window.chat.append(
+                f"(not delivered, offline: {' '.join(data_text.split(' ')[1:])})"
+            )
 
         else:
+            if self.synced_ids is not None and message_id is not None:
+                if message_id in self.synced_ids:
+                    return True
+                self.synced_ids.add(message_id)
             window.chat.append(
-                f"{decoded_data.get('datetime')} {decoded_data.get('author')}: {data_text}"
+                f"{decoded_data.datetime} {decoded_data.author}: {data_text}"
             )
         return True
 
+    def apply_presence(self, splitted_data: list) -> None:
+        """
+        Applies a presence delta "/presence <epoch>.<version> +<joined> -<left> ..." to
+        RECIPIENT_LIST. Deltas already contained in the last snapshot are skipped, if a delta
+        is missing or comes from another roster (epoch) a new snapshot is requested.
+        :param splitted_data: the words after "/presence"
+        :return: None
+        """
+        epoch, _, version = splitted_data[0].partition(".")
+        version = int(version)
+        if epoch == self.presence_epoch and version <= self.presence_version:
+            return
+
+        if epoch != self.presence_epoch or version > self.presence_version + 1:
+            send_message(Message("/now_online", self.client_name, []))
+            return
+
+        for change in splitted_data[1:]:
+            name = change[1:]
+            if change.startswith("+") and name not in RECIPIENT_LIST:
+                RECIPIENT_LIST.append(name)
+            elif change.startswith("-") and name in RECIPIENT_LIST:
+                RECIPIENT_LIST.remove(name)
+        self.presence_version = version
+
 
 if __name__ == "__main__":
     SERVER = None
+    CODEC = JSON
     RECIPIENT_LIST = []
 
     app = QApplication(sys.argv)
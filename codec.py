@@ -0,0 +1,193 @@
+"""
+Wire formats of chat messages, the payload of a frame is either:
+
+JSON - a JSON object, always starts with "{" (all clients understand it)
+
+binary - first byte is a type tag, the rest depends on the type:
+
+    MESSAGE  +-----+------------+--------+--------+--------+--------+
+             | tag | message_id | len dt | len au | len rc | len tx |
+             | u8  | u64 (0=no) | u32    | u32    | u32    | u32    |
+             +-----+------------+--------+--------+--------+--------+
+             then datetime, author, recipients (names joined by NUL), text
+
+    BATCH    | tag | frames of MESSAGE payloads (length prefixed) ... |
+
+    A tag with the COMPRESSED bit set is followed by the zlib-compressed rest.
+
+A client asks for the binary format with "codecs": ["binary", "zlib"] in its
+/login or /register message, the server confirms with "/codec <codec>" and
+sends binary frames from then on. Both sides accept either format in every frame.
+The message objects built from these payloads are chat_util.Message.
+"""
+import json
+import struct
+import zlib
+
+from framing import encode_frame, FrameError, HEADER, MAX_FRAME_SIZE
+from config_server import WIRE_BINARY, WIRE_COMPRESSION, WIRE_COMPRESS_MIN_BYTES
+
+JSON = "json"
+BINARY = "binary"
+BINARY_ZLIB = "binary+zlib"
+
+MESSAGE = 1
+BATCH = 2
+COMPRESSED = 0x80
+
+HEAD = struct.Struct("!BQIIII")
+SEPARATOR = "\x00"
+
+
+def choose_codec(codecs) -> str:
+    """
+    :param codecs: "codecs" of the client's login message, None for old clients
+    :return: codec of the connection
+    """
+    if not WIRE_BINARY or not isinstance(codecs, list) or BINARY not in codecs:
+        return JSON
+    if WIRE_COMPRESSION and "zlib" in codecs:
+        return BINARY_ZLIB
+    return BINARY
+
+
+def encode_json(message: dict) -> bytes:
+    """
+    :param message: dict with author, recipient, text, datetime and optional message_id
+    :return: JSON payload
+    """
+    return json.dumps(message).encode("utf-8")
+
+
+def encode_binary(
+    author: str, recipients, text: str, m_datetime: str, message_id=None
+) -> bytes:
+    """
+    :return: binary MESSAGE payload
+    """
+    m_datetime = m_datetime.encode("utf-8")
+    author = str(author).encode("utf-8")
+    text = text.encode("utf-8")
+    # one split() decodes all names, a NUL inside a username is not supported
+    recipients = SEPARATOR.join(map(str, recipients)).encode("utf-8")
+
+    return b"".join(
+        [
+            HEAD.pack(
+                MESSAGE,
+                message_id or 0,
+                len(m_datetime),
+                len(author),
+                len(recipients),
+                len(text),
+            ),
+            m_datetime,
+            author,
+            recipients,
+            text,
+        ]
+    )
+
+
+def decode_binary(payload) -> tuple:
+    """
+    Strings are decoded straight from slices of a memoryview, the payload is not copied
+    :param payload: binary MESSAGE payload, bytes or memoryview
+    :return: (author, recipients, text, datetime, message_id or None)
+    """
+    view = memoryview(payload)
+    try:
+        tag, message_id, dt_size, author_size, rc_size, text_size = HEAD.unpack_from(view)
+    except struct.error:
+        raise FrameError("malformed binary message")
+    if tag != MESSAGE:
+        raise FrameError(f"unexpected binary message type {tag}")
+    offset = HEAD.size
+    if len(view) != offset + dt_size + author_size + rc_size + text_size:
+        raise FrameError("malformed binary message")
+
+    m_datetime = str(view[offset : offset + dt_size], "utf-8")
+    offset += dt_size
+    author = str(view[offset : offset + author_size], "utf-8")
+    offset += author_size
+    recipients = str(view[offset : offset + rc_size], "utf-8")
+    offset += rc_size
+    text = str(view[offset:], "utf-8")
+
+    return (
+        author,
+        recipients.split(SEPARATOR) if recipients else [],
+        text,
+        m_datetime,
+        message_id or None,
+    )
+
+
+def pack(payloads: list, codec: str) -> bytes:
+    """
+    :param payloads: payloads of messages, all in the format of the codec
+    :param codec: JSON, BINARY or BINARY_ZLIB
+    :return: frames of the messages, one binary BATCH frame for several messages
+    """
+    if codec == JSON:
+        return b"".join(encode_frame(payload) for payload in payloads)
+
+    if len(payloads) == 1:
+        payload = payloads[0]
+    else:
+        payload = bytes([BATCH]) + b"".join(encode_frame(payload) for payload in payloads)
+
+    if codec == BINARY_ZLIB and len(payload) >= WIRE_COMPRESS_MIN_BYTES:
+        payload = bytes([payload[0] | COMPRESSED]) + zlib.compress(payload[1:])
+    return encode_frame(payload)
+
+
+def unpack(payload: bytes) -> list:
+    """
+    Decompresses a frame payload and splits a batch, without copying its messages
+    :param payload:
+    :return: payloads of single messages, JSON (bytes) or binary (bytes or memoryview)
+    """
+    if not payload:
+        raise FrameError("empty frame")
+    if is_json(payload):
+        return [payload]
+
+    tag = payload[0]
+    if tag & COMPRESSED:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(memoryview(payload)[1:], MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise FrameError(f"invalid compressed frame: {e}")
+        if decompressor.unconsumed_tail:
+            raise FrameError(f"compressed frame exceeds {MAX_FRAME_SIZE} bytes")
+        tag &= ~COMPRESSED
+        payload = bytes([tag]) + body
+
+    if tag == MESSAGE:
+        return [payload]
+    if tag != BATCH:
+        raise FrameError(f"unknown frame type {tag}")
+
+    view = memoryview(payload)
+    payloads = []
+    offset = 1
+    while offset < len(view):
+        if len(view) - offset < HEADER.size:
+            raise FrameError("malformed binary batch")
+        (length,) = HEADER.unpack_from(view, offset)
+        offset += HEADER.size
+        if len(view) - offset < length:
+            raise FrameError("malformed binary batch")
+        payloads.append(view[offset : offset + length])
+        offset += length
+    return payloads
+
+
+def is_json(payload) -> bool:
+    """
+    :param payload: payload of a single message
+    :return: True for JSON, False for binary
+    """
+    return payload[:1] == b"{"
@@ -4,7 +4,158 @@ MAX_CONNECTIONS = 2
 HOST = "127.0.0.1"
 PORT = 80
 
+# "threaded" - one thread per connection, "async" - single asyncio event loop
+SERVER_MODE = "threaded"
+# Threads used by the async server for blocking database calls
+ASYNC_DB_WORKERS = 8
+# Worker processes sharing the port (SO_REUSEPORT), 1 - a single process.
+# With several workers MAX_CONNECTIONS applies to each worker and the "memory"
+# storage is not shared between them
+SERVER_WORKERS = 1
+# Unix-domain socket of the bus between the workers, "" - in the temp directory
+BUS_PATH = ""
+# Seconds a worker waits for the bus to confirm a login
+BUS_TIMEOUT = 5
+# Seconds between checks of the workers, a worker that exits is started again
+SUPERVISOR_CHECK_INTERVAL = 1
+
+# Federation of nodes: "host:port" this node listens on for other nodes ("" - off)
+# and the addresses of the other nodes. Nodes are expected to share the storage.
+FEDERATION_ADDRESS = ""
+FEDERATION_PEERS = []
+# Seconds between attempts to connect to a missing peer
+FEDERATION_RETRY = 2
+# Queue of a link to a peer, a peer that falls further behind is disconnected
+FEDERATION_LINK_MAX_FRAMES = 100000
+FEDERATION_LINK_MAX_BYTES = 16 * 1024 * 1024
+
+# Storage of accounts and messages: "postgres", "sqlite" (embedded, in SQLITE_PATH)
+# or "memory" (lost when the server stops)
+STORAGE_BACKEND = "postgres"
+SQLITE_PATH = "chat.sqlite3"
+
 DATABASE = ""
 DB_USER = ""
 DB_PASSWORD = ""
 DB_HOST = ""
+
+# Connection pool of the database, connections are kept open between queries
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+# Seconds to wait for a free connection when all DB_POOL_MAX_SIZE are busy
+DB_POOL_TIMEOUT = 5
+# Connections idle longer than this (seconds) are health-checked before use
+DB_POOL_CHECK_IDLE = 30
+
+# Messages are saved by a background writer in batches of up to DB_WRITE_BATCH_SIZE,
+# a batch is flushed at most DB_WRITE_BATCH_INTERVAL seconds after its first message
+DB_WRITE_BATCH_SIZE = 500
+DB_WRITE_BATCH_INTERVAL = 0.01
+DB_WRITE_QUEUE_SIZE = 10000
+# "flush" - the sender waits until its message is committed,
+# "async" - fire-and-forget, messages queued at a crash are lost
+DB_WRITE_DURABILITY = "flush"
+
+# /load returns HISTORY_PAGE_SIZE messages by default and never more than
+# HISTORY_MAX_PAGE_SIZE, rows are read from the database HISTORY_CHUNK_SIZE at a time
+HISTORY_PAGE_SIZE = 10
+HISTORY_MAX_PAGE_SIZE = 500
+HISTORY_CHUNK_SIZE = 100
+# /search returns SEARCH_PAGE_SIZE messages at a time, best matches first,
+# the following pages go up to SEARCH_MAX_RESULTS matches
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_RESULTS = 1000
+# The newest HISTORY_CACHE_USER_MESSAGES messages of every active user are cached,
+# least recently used users are evicted beyond HISTORY_CACHE_MAX_MESSAGES messages
+# or HISTORY_CACHE_MAX_BYTES in total, 0 disables the cache
+HISTORY_CACHE_USER_MESSAGES = 100
+HISTORY_CACHE_MAX_MESSAGES = 100000
+HISTORY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Every connection has a bounded queue of outgoing frames, written by its own writer
+OUTBOX_MAX_FRAMES = 1000
+OUTBOX_MAX_BYTES = 1024 * 1024
+# Queued frames are joined and written with one syscall, up to this size
+OUTBOX_COALESCE_BYTES = 64 * 1024
+# What to do with a client whose queue is full: "drop" - drop new chat messages,
+# "disconnect" - disconnect it, "presence_only" - only send it presence updates
+# and replies to its own requests until the queue drains
+OUTBOX_POLICY = "drop"
+
+# Users joining and leaving within this many seconds are announced in one presence update
+PRESENCE_COALESCE_INTERVAL = 0.05
+# Presence deltas kept to bring a resumed session up to date without a snapshot
+PRESENCE_HISTORY = 64
+
+# Clients may ask for the compact binary wire format (with zlib compression of
+# frames of at least WIRE_COMPRESS_MIN_BYTES), JSON clients keep working
+WIRE_BINARY = True
+WIRE_COMPRESSION = True
+WIRE_COMPRESS_MIN_BYTES = 1024
+
+# A login returns a session token valid for SESSION_TTL seconds, "/resume <token>"
+# reconnects without a database query. Empty secret - random, shared by the workers
+# of one supervisor, federation nodes need the same SESSION_SECRET
+SESSION_SECRET = ""
+SESSION_TTL = 3600
+
+# Passwords are stored as salted PBKDF2-SHA256 hashes, computed by PASSWORD_HASH_WORKERS
+# threads besides the connection handlers. Hashes with fewer iterations and plaintext
+# passwords of old databases are rehashed at the next login
+PASSWORD_HASH_ITERATIONS = 100000
+PASSWORD_HASH_WORKERS = 2
+# Verified logins are trusted for CREDENTIAL_CACHE_TTL seconds without the database
+# and the KDF, at most CREDENTIAL_CACHE_SIZE users, 0 disables the cache
+CREDENTIAL_CACHE_TTL = 300
+CREDENTIAL_CACHE_SIZE = 10000
+
+# Flood protection, token buckets of every connection: chat messages and bytes per
+# second (with bursts after a pause) and a separate budget of expensive commands
+# (/load, /sync, /search, /now_online), 0 - no limit. Throttled frames are answered
+# with "/error rate limited <seconds>" once per burst and dropped
+RATE_MESSAGES = 20
+RATE_MESSAGES_BURST = 100
+RATE_BYTES = 1024 * 1024
+RATE_BYTES_BURST = 4 * 1024 * 1024
+RATE_COMMANDS = 2
+RATE_COMMANDS_BURST = 20
+# A client that sends this many throttled frames in a row is disconnected, 0 - never
+RATE_DISCONNECT_AFTER = 200
+
+# Pending connections the kernel keeps until the server accepts them (listen backlog)
+LISTEN_BACKLOG = 1024
+# Connections beyond MAX_CONNECTIONS wait for a free slot, at most ADMISSION_QUEUE_SIZE
+# of them for ADMISSION_QUEUE_TIMEOUT seconds, the others are shed with
+# "/error server is busy <seconds>", 1 to 2 times ADMISSION_RETRY_AFTER
+ADMISSION_QUEUE_SIZE = 256
+ADMISSION_QUEUE_TIMEOUT = 5
+ADMISSION_RETRY_AFTER = 2
+
+# A connection silent for HEARTBEAT_IDLE seconds gets "/ping", it is disconnected when
+# nothing arrives within HEARTBEAT_TIMEOUT seconds more, a connection that has not
+# logged in is disconnected when idle (0 - off). The deadlines are kept in a timer
+# wheel of HEARTBEAT_WHEEL_SLOTS slots of HEARTBEAT_TICK seconds
+HEARTBEAT_IDLE = 30
+HEARTBEAT_TIMEOUT = 10
+HEARTBEAT_TICK = 1
+HEARTBEAT_WHEEL_SLOTS = 64
+
+# Log records of the server at LOG_LEVEL and above ("DEBUG" logs every received frame),
+# at most LOG_RATE_LIMIT records of one kind per LOG_RATE_INTERVAL seconds, the rest
+# are dropped and counted
+LOG_LEVEL = "INFO"
+LOG_RATE_LIMIT = 10
+LOG_RATE_INTERVAL = 1
+# Metrics in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+# (0 - off), the worker processes of a supervisor use the next ports, one each
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9180
+# Upper bounds in seconds of the buckets of the latency histograms
+METRICS_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+)
+
+# Every frame received is recorded to CAPTURE_PATH ("" - off) with its time and
+# connection, for replay.py. Passwords and session tokens are not recorded
+CAPTURE_PATH = ""
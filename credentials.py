@@ -0,0 +1,130 @@
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from config_server import (
+    PASSWORD_HASH_ITERATIONS,
+    CREDENTIAL_CACHE_TTL,
+    CREDENTIAL_CACHE_SIZE,
+)
+
+# Stored passwords are "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>",
+# anything else is a plaintext password of an old database
+ALGORITHM = "pbkdf2_sha256"
+SALT_SIZE = 16
+
+
+def hash_password(password: str, iterations=PASSWORD_HASH_ITERATIONS) -> str:
+    """
+    :param password: password sent by the client
+    :param iterations: PBKDF2 iterations, the cost of a hash
+    :return: salted hash to store
+    """
+    salt = os.urandom(SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{ALGORITHM}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """
+    :param password: password sent by the client
+    :param stored: hash from the storage, or a plaintext password of an old database
+    :return: True if the password matches
+    """
+    if not stored.startswith(ALGORITHM + "$"):
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        salt = bytes.fromhex(salt)
+        digest = bytes.fromhex(digest)
+        iterations = int(iterations)
+    except ValueError:
+        return False
+    computed = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return hmac.compare_digest(computed, digest)
+
+
+def needs_rehash(stored: str, iterations=PASSWORD_HASH_ITERATIONS) -> bool:
+    """
+    :param stored: hash from the storage
+    :param iterations: current PASSWORD_HASH_ITERATIONS
+    :return: True for plaintext passwords and hashes with fewer iterations
+    """
+    if not stored.startswith(ALGORITHM + "$"):
+        return True
+    try:
+        return int(stored.split("$")[1]) < iterations
+    except (IndexError, ValueError):
+        return True
+
+
+class CredentialCache:
+    """
+    Recently verified (username, password) pairs, so a repeated login costs
+    neither a database query nor the KDF. Passwords are not kept, only their
+    HMAC with a key of the process. Least recently used users are evicted
+    beyond max_size, entries expire after ttl seconds.
+    """
+
+    def __init__(self, ttl=CREDENTIAL_CACHE_TTL, max_size=CREDENTIAL_CACHE_SIZE):
+        """
+        :param ttl: seconds a verified password is trusted
+        :param max_size: users kept
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._key = os.urandom(32)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, username: str, password: str) -> bool:
+        """
+        :param username:
+        :param password:
+        :return: True if this password was verified for the user within ttl
+        """
+        fingerprint = self._fingerprint(username, password)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[1] > time.monotonic():
+                if hmac.compare_digest(entry[0], fingerprint):
+                    self._entries.move_to_end(username)
+                    self.hits += 1
+                    return True
+            self.misses += 1
+            return False
+
+    def add(self, username: str, password: str) -> None:
+        """
+        Remembers a verified password
+        :param username:
+        :param password:
+        :return: None
+        """
+        fingerprint = self._fingerprint(username, password)
+        with self._lock:
+            self._entries[username] = (fingerprint, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, username: str) -> None:
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def _fingerprint(self, username: str, password: str) -> bytes:
+        return hmac.new(
+            self._key, f"{username}\x00{password}".encode("utf-8"), hashlib.sha256
+        ).digest()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,263 @@
+import logging
+import socket
+import threading
+import time
+
+from bus import encode_bus_message, decode_bus_message
+from framing import FrameDecoder, FrameError, READ_SIZE
+from outbox import ThreadedOutbox
+from config_server import (
+    FEDERATION_RETRY,
+    FEDERATION_LINK_MAX_FRAMES,
+    FEDERATION_LINK_MAX_BYTES,
+)
+
+log = logging.getLogger("chat.federation")
+
+
+def parse_address(address: str) -> tuple:
+    """
+    :param address: "host:port"
+    :return: (host, port)
+    """
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class PeerLink:
+    """
+    Server-to-server link to one peer node. Outgoing messages are queued to an
+    outbox, its writer joins everything queued into one write, so a burst of
+    chat frames costs one syscall per peer.
+    """
+
+    def __init__(self, sock, outgoing: bool):
+        """
+        :param sock: connected socket
+        :param outgoing: True if this node dialed the peer
+        """
+        self.sock = sock
+        self.outgoing = outgoing
+        self.node = None
+        self.outbox = ThreadedOutbox(
+            sock,
+            max_frames=FEDERATION_LINK_MAX_FRAMES,
+            max_bytes=FEDERATION_LINK_MAX_BYTES,
+            policy="disconnect",
+        )
+
+    def send(self, header: dict, body=b"") -> None:
+        self.outbox.put(encode_bus_message(header, body), essential=True)
+
+    def close(self) -> None:
+        self.outbox.close()
+
+
+class Federation:
+    """
+    Federation of chat nodes: every node keeps a link to every other node, tells
+    them who joins and leaves, and keeps a routing table of the users connected
+    to the other nodes. A chat frame crosses each link once, with the list of
+    recipients on that node, and is never forwarded further.
+
+    It has the interface of BusClient (claim, release, join, publish), so the
+    server uses it the same way as the bus of the worker processes.
+    A node is identified by its federation address "host:port".
+    """
+
+    def __init__(self, address: str, peers: list, retry=FEDERATION_RETRY):
+        """
+        :param address: "host:port" the node listens on for other nodes
+        :param peers: addresses of the other nodes, they are dialed and redialed
+        :param retry: seconds between attempts to connect to missing peers
+        """
+        self.address = address
+        self.peers = [peer for peer in peers if peer != address]
+        self.retry = retry
+        self.handler = None
+
+        self._lock = threading.Lock()
+        self._links = {}
+        self._routes = {}
+        self._local = set()
+        self._sock = None
+
+    def connect(self, handler) -> None:
+        """
+        Starts listening for peers and dialing them
+        :param handler: handler(header, body), called for join, leave and route
+        :return: None
+        """
+        self.handler = handler
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(parse_address(self.address))
+        self._sock.listen(16)
+        threading.Thread(target=self._accept, name="federation", daemon=True).start()
+        threading.Thread(target=self._dial, name="federation-dial", daemon=True).start()
+        log.info("Federation node %s, peers: %s", self.address, " ".join(self.peers))
+
+    def claim(self, username: str) -> bool:
+        """
+        :param username:
+        :return: False if the user is logged in on another node
+        """
+        with self._lock:
+            return username not in self._routes
+
+    def join(self, username: str) -> None:
+        with self._lock:
+            self._local.add(username)
+            links = list(self._links.values())
+        for link in links:
+            link.send({"op": "join", "username": username})
+
+    def release(self, username: str) -> None:
+        with self._lock:
+            if username not in self._local:
+                return
+            self._local.discard(username)
+            links = list(self._links.values())
+        for link in links:
+            link.send({"op": "leave", "username": username})
+
+    def publish(self, frame: bytes, recipients: list) -> None:
+        """
+        Sends the frame once to every node that has some of its recipients
+        :param frame: frame of the chat message
+        :param recipients: usernames or ["All users"]
+        :return: None
+        """
+        with self._lock:
+            if "All users" in recipients:
+                targets = {node: recipients for node in self._links}
+            else:
+                targets = {}
+                for username in recipients:
+                    node = self._routes.get(username)
+                    if node is not None:
+                        targets.setdefault(node, []).append(username)
+            links = {node: self._links.get(node) for node in targets}
+
+        for node, link in links.items():
+            if link is not None:
+                link.send({"op": "route", "to": targets[node]}, frame)
+
+    def nodes(self) -> list:
+        """
+        :return: addresses of the connected peers
+        """
+        with self._lock:
+            return list(self._links)
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                break
+            self._start_link(sock, outgoing=False)
+
+    def _dial(self) -> None:
+        while True:
+            with self._lock:
+                missing = [peer for peer in self.peers if peer not in self._links]
+            for peer in missing:
+                try:
+                    sock = socket.create_connection(parse_address(peer), timeout=self.retry)
+                except OSError:
+                    continue
+                sock.settimeout(None)
+                self._start_link(sock, outgoing=True)
+            time.sleep(self.retry)
+
+    def _start_link(self, sock, outgoing: bool) -> None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = PeerLink(sock, outgoing)
+        link.send({"op": "hello", "node": self.address})
+        threading.Thread(target=self._serve, args=[link], daemon=True).start()
+
+    def _serve(self, link) -> None:
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = link.sock.recv(READ_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    header, body = decode_bus_message(payload)
+                    if header["op"] == "hello":
+                        if not self._register(link, header["node"]):
+                            return
+                    elif link.node is not None:
+                        self._handle(link, header, body)
+        except (OSError, FrameError, ValueError) as e:
+            log.warning("Federation link to %s lost: %s", link.node, e)
+        finally:
+            self._drop(link)
+
+    def _register(self, link, node: str) -> bool:
+        """
+        Adds the link of the peer and sends it the users of this node.
+        When both nodes dialed each other, both keep the link dialed by the node
+        with the lower address and close the other one.
+        :param link:
+        :param node: address of the peer
+        :return: False if the link was closed as a duplicate
+        """
+        with self._lock:
+            existing = self._links.get(node)
+            if existing is not None:
+                keep_outgoing = self.address < node
+                if link.outgoing != keep_outgoing:
+                    link.close()
+                    return False
+                existing.close()
+            link.node = node
+            self._links[node] = link
+            # sent under the lock, so no join or leave can overtake the roster
+            link.send({"op": "roster", "usernames": sorted(self._local)})
+        log.info("Federation link to %s established", node)
+        return True
+
+    def _handle(self, link, header: dict, body: bytes) -> None:
+        op = header["op"]
+        if op == "route":
+            self.handler(header, body)
+
+        elif op == "roster":
+            for username in header["usernames"]:
+                self._add_route(username, link.node)
+
+        elif op == "join":
+            self._add_route(header["username"], link.node)
+
+        elif op == "leave":
+            with self._lock:
+                if self._routes.get(header["username"]) != link.node:
+                    return
+                del self._routes[header["username"]]
+            self.handler({"op": "leave", "username": header["username"]}, b"")
+
+    def _add_route(self, username: str, node: str) -> None:
+        with self._lock:
+            self._routes[username] = node
+        self.handler({"op": "join", "username": username}, b"")
+
+    def _drop(self, link) -> None:
+        """
+        The link is gone, users of the peer are offline for this node
+        :param link:
+        :return: None
+        """
+        link.close()
+        with self._lock:
+            if link.node is None or self._links.get(link.node) is not link:
+                return
+            del self._links[link.node]
+            left = [name for name, node in self._routes.items() if node == link.node]
+            for username in left:
+                del self._routes[username]
+        log.warning("Federation link to %s lost", link.node)
+        for username in left:
+            self.handler({"op": "leave", "username": username}, b"")
@@ -0,0 +1,93 @@
+"""
+Length-prefixed framing shared by the chat server and client.
+
+Every frame on the wire is a 4 byte big-endian payload length followed by
+the payload itself (a message in one of the wire formats of codec.py):
+
+    +----------------+---------------------+
+    | length: uint32 | payload: length B   |
+    +----------------+---------------------+
+"""
+import struct
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1024 * 1024
+READ_SIZE = 65536
+
+
+class FrameError(ValueError):
+    """
+    Raised when the stream contains a frame that can not be decoded
+    """
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """
+    Prepends the length header to the payload
+    :param payload:
+    :return: frame ready to be written to the socket
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Incremental decoder, feed it with whatever recv() returned and it gives back
+    every complete frame. Incomplete data stays in an internal buffer that is
+    reused between reads, already consumed bytes are not scanned again.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._offset = 0
+        self._needed = 0
+
+    def feed(self, data: bytes) -> list:
+        """
+        Adds received data to the buffer
+        :param data: bytes from the socket
+        :return: list of complete frame payloads (bytes), may be empty
+        """
+        buffer = self._buffer
+        buffer += data
+
+        frames = []
+        while len(buffer) - self._offset >= HEADER.size:
+            if not self._needed:
+                (length,) = HEADER.unpack_from(buffer, self._offset)
+                if length > self.max_frame_size:
+                    raise FrameError(
+                        f"frame of {length} bytes exceeds {self.max_frame_size}"
+                    )
+                self._needed = HEADER.size + length
+
+            if len(buffer) - self._offset < self._needed:
+                break
+
+            start = self._offset + HEADER.size
+            self._offset += self._needed
+            self._needed = 0
+            frames.append(bytes(buffer[start : self._offset]))
+
+        self._compact()
+        return frames
+
+    def _compact(self) -> None:
+        """
+        Drops the consumed part of the buffer once it becomes large enough
+        to be worth moving the remaining bytes
+        :return: None
+        """
+        if self._offset == len(self._buffer):
+            del self._buffer[:]
+            self._offset = 0
+        elif self._offset >= READ_SIZE or self._offset * 2 >= len(self._buffer):
+            del self._buffer[: self._offset]
+            self._offset = 0
+
+    def pending(self) -> int:
+        """
+        :return: number of buffered bytes that are not a complete frame yet
+        """
+        return len(self._buffer) - self._offset
@@ -0,0 +1,544 @@
+import logging
+import time
+
+from chat_util import (
+    Message,
+    MessagePage,
+    current_datetime,
+    parse_load_command,
+    parse_search_command,
+    parse_sync_command,
+    WriterBusy,
+)
+from codec import JSON, choose_codec
+from session import SessionTokens
+from metrics import BYTES_RECEIVED, PARSE_SECONDS, THROTTLED, FLOOD_DISCONNECTS
+from config_server import (
+    SERVER_NAME,
+    HISTORY_MAX_PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+    SEARCH_MAX_RESULTS,
+)
+
+log = logging.getLogger("chat.server")
+
+
+class Handlers:
+    """
+    State of a chat server and the handling of requests, the same for the threaded
+    server (server.py) and the asyncio server (server_async.py). The servers only
+    do the I/O around it: reading frames, the calls that block (the database,
+    the bus) and closing connections.
+    """
+
+    def __init__(self, users, presence, db, admission, heartbeat, capture, call_soon):
+        """
+        :param users: UserRegistry
+        :param presence: Presence
+        :param db: DataBase
+        :param admission: ThreadedAdmission or AsyncAdmission
+        :param heartbeat: Heartbeat
+        :param capture: Capture of the received frames, None - off
+        :param call_soon: call_soon(callback, *args) runs a callback of the message writer
+        where the outboxes may be used, loop.call_soon_threadsafe for the asyncio server
+        """
+        self.users = users
+        self.presence = presence
+        self.db = db
+        self.sessions = SessionTokens()
+        self.admission = admission
+        self.heartbeat = heartbeat
+        self.capture = capture
+        self.call_soon = call_soon
+
+    def connected(self, user) -> None:
+        """
+        Starts serving a new connection, user.outbox must be set
+        :param user:
+        :return: None
+        """
+        self.users.add(user)
+        self.heartbeat.watch(user)
+        if self.capture is not None:
+            self.capture.open(user)
+        log.debug("New connection from %s", user.address)
+
+    def closed(self, user) -> None:
+        """
+        Frees the slot of a connection that is served no more
+        :param user:
+        :return: None
+        """
+        self.admission.release()
+        if self.capture is not None:
+            self.capture.close(user)
+
+    def busy_message(self) -> Message:
+        """
+        :return: "/error server is busy <seconds to wait>" for a connection that is shed
+        """
+        return Message(
+            f"/error server is busy {self.admission.retry_after():.1f}", SERVER_NAME, []
+        )
+
+    def received(self, user, data: bytes) -> None:
+        """
+        :param user:
+        :param data: bytes read from the connection
+        :return: None
+        """
+        user.last_seen = time.monotonic()
+        BYTES_RECEIVED.inc(len(data))
+
+    def decode(self, user, payload: bytes) -> Message:
+        """
+        :param user:
+        :param payload: a frame received from the user
+        :return: Message
+        """
+        if self.capture is not None:
+            self.capture.frame(user, payload)
+        start = time.perf_counter()
+        decoded_data = Message.decode(payload)
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+        log.debug("%s sent %s", user.address, decoded_data)
+        return decoded_data
+
+    def not_logged_in(self, user) -> None:
+        """
+        Answers a request sent before logging in, the server closes the connection
+        :param user:
+        :return: None
+        """
+        message = Message("/error you are not logged in", SERVER_NAME, [user.address])
+        user.send(message, essential=True)
+        self.users.remove(user)
+
+    def disconnect(self, user, error) -> None:
+        """
+        Removes the user after the connection is lost or closed because of the error,
+        the server closes the outbox
+        :param user:
+        :param error:
+        :return: None
+        """
+        log.info("%s %s disconnected: %s", user.username, user.address, error)
+        self.users.remove(user)
+        message = Message(f"{user.username} disconnected", SERVER_NAME, ["All users"])
+        self.broadcast_to_users(user, message)
+        if user.logged_in:
+            self.presence.leave(user.username)
+
+    def throttle(self, user, size: int, command: bool) -> None:
+        """
+        The frame exceeded the rate limits of the user and is dropped. The first frame
+        of a burst is answered with "/error rate limited <seconds to wait>",
+        a client that keeps flooding is disconnected.
+        :param user:
+        :param size: bytes of the frame
+        :param command: True for an expensive command
+        :return: None
+        """
+        limiter = user.limiter
+        THROTTLED.inc()
+        if limiter.flooding:
+            FLOOD_DISCONNECTS.inc()
+            raise Exception(f"{user.username} disconnected for flooding, {limiter.stats()}")
+        if limiter.streak == 1:
+            message = Message(
+                f"/error rate limited {limiter.retry_after(size, command):.2f}",
+                SERVER_NAME,
+                [user.username],
+            )
+            user.send(message, essential=True)
+
+    def negotiate_codec(self, decoded_data: Message, user) -> None:
+        """
+        Switches the connection to the binary wire format when the client asks for it
+        with "codecs" in its /login or /register. The reply "/codec <codec>" is the
+        last frame sent to it in JSON, old clients never get it.
+        :param decoded_data:
+        :param user:
+        :return: None
+        """
+        codec = choose_codec(decoded_data.codecs)
+        if codec != JSON:
+            message = Message(f"/codec {codec}", SERVER_NAME, [user.address])
+            user.send(message, essential=True)
+            user.codec = codec
+
+    @staticmethod
+    def read_credentials(data_text: str, user) -> None:
+        """
+        Sets the username and password of "/login <username>:<password>" (or /register)
+        :param data_text:
+        :param user:
+        :return: None
+        """
+        user.username = data_text.split(" ")[1].split(":")[0]
+        user.password = data_text.split(" ")[1].split(":")[1]
+
+    @staticmethod
+    def already_logged(user) -> bool:
+        """
+        :param user: a connection that could not claim its username
+        :return: False
+        """
+        log.info("User %s already logged", user.username)
+        message = Message(
+            f"/error user {user.username} already logged", SERVER_NAME, [user.username]
+        )
+        user.send(message, essential=True)
+        return False
+
+    def login_checked(self, user, valid: bool) -> bool:
+        """
+        Completes /login once the password is checked
+        :param user: a connection that claimed its username
+        :param valid: True if the password is correct
+        :return: valid
+        """
+        if not valid:
+            self.users.release(user)
+            message = Message(
+                f"/error invalid login {user.username}", SERVER_NAME, [user.username]
+            )
+            user.send(message, essential=True)
+            log.warning("Invalid login %s from %s", user.username, user.address)
+            return False
+
+        user.logged_in = True
+        message = Message(
+            f"{user.username} was connected to chat", SERVER_NAME, [user.username]
+        )
+        self.broadcast_to_users(user, message)
+        self.welcome_message(user)
+        return True
+
+    def register_checked(self, user, created: bool) -> bool:
+        """
+        Completes /register once the account is created
+        :param user:
+        :param created: False if the username is taken
+        :return: created
+        """
+        if not created:
+            self.users.release(user)
+            message = Message(
+                f"/error user {user.username} already exist", SERVER_NAME, [user.username]
+            )
+            user.send(message, essential=True)
+            return False
+
+        user.logged_in = True
+        log.info("New user %s was registered", user.username)
+        message = Message(
+            f"New user {user.username} was registered", SERVER_NAME, [user.username]
+        )
+        self.broadcast_to_users(user, message)
+        self.welcome_message(user)
+        return True
+
+    def check_session(self, data_text: str, user) -> bool:
+        """
+        Sets the username of the session token of "/resume <token> <presence_version>",
+        without a database query
+        :param data_text:
+        :param user:
+        :return: False if the token is not valid (any more)
+        """
+        username = self.sessions.verify(data_text.split(" ")[1])
+        if username is None:
+            message = Message("/error invalid session", SERVER_NAME, [user.address])
+            user.send(message, essential=True)
+            return False
+        user.username = username
+        return True
+
+    def resume(self, data_text: str, user) -> None:
+        """
+        Completes /resume once the username is claimed. The client already has the
+        server name and the roster, so instead of the welcome it gets
+        "/resumed <new token>" and only the presence deltas it missed
+        (a snapshot if they are not kept any more).
+        :param data_text:
+        :param user:
+        :return: None
+        """
+        user.logged_in = True
+        if self.users.bus is not None and self.db.history_cache is not None:
+            self.db.history_cache.discard(user.username)
+
+        message = Message(
+            f"/resumed {self.sessions.issue(user.username)}", SERVER_NAME, [user.username]
+        )
+        user.send(message, essential=True)
+
+        splitted_data = data_text.split(" ")
+        version = splitted_data[2] if len(splitted_data) > 2 else ""
+        self.presence.catch_up(user, version)
+        self.presence.join(user.username)
+
+    def welcome_message(self, user) -> None:
+        """
+        Sends the user: server name, session token for /resume, who is online now
+        and a welcome message, other users get the join in the next presence delta
+        :param user:
+        :return: None
+        """
+        if self.users.bus is not None and self.db.history_cache is not None:
+            # messages of the user may have been saved by another worker
+            self.db.history_cache.discard(user.username)
+
+        message = Message(f"/server_name {SERVER_NAME}", SERVER_NAME, [user.username])
+        user.send(message, essential=True)
+
+        message = Message(
+            f"/session {self.sessions.issue(user.username)}", SERVER_NAME, [user.username]
+        )
+        user.send(message, essential=True)
+
+        self.presence.snapshot(user)
+        self.presence.join(user.username)
+
+        message = Message(f"welcome to {SERVER_NAME}", SERVER_NAME, [user.username])
+        user.send(message, essential=True)
+
+    @staticmethod
+    def reject_recipients(user, unknown: list) -> None:
+        """
+        :param user: author of a message that is not saved
+        :param unknown: its recipients that do not have an account
+        :return: None
+        """
+        message = Message(
+            "/error unknown recipients " + " ".join(unknown), SERVER_NAME, [user.username]
+        )
+        user.send(message, essential=True)
+
+    def submit_message(self, user, text: str, recipients: list):
+        """
+        Stamps the message with the server time and queues it for saving. It is
+        delivered once it has its sequence id (message_id), the writer commits
+        messages in order, so recipients get them in the order of their ids.
+        A message that finds the queue of the writer full is dropped with
+        "/error message dropped", a message the writer fails to save with
+        "/error message not saved <reason>".
+        :param user: author, its recipients have an account
+        :param text:
+        :param recipients:
+        :return: Future of DataBase.submit_message, None if the message was dropped
+        """
+        m_datetime = current_datetime()
+        try:
+            future = user.db.submit_message(user.username, recipients, text, m_datetime)
+        except WriterBusy as e:
+            log.warning("Message from %s was dropped: %s", user.username, e)
+            message = Message(
+                "/error message dropped, server is busy", SERVER_NAME, [user.username]
+            )
+            user.send(message, essential=True)
+            return None
+        # the future is resolved on the writer thread
+        future.add_done_callback(
+            lambda done: self.call_soon(
+                self.deliver_message, user, text, recipients, m_datetime, done
+            )
+        )
+        return future
+
+    def deliver_message(self, user, text: str, recipients: list, m_datetime: str, future) -> None:
+        """
+        Sends a saved message to its recipients and "/sent <message_id>" to the author.
+        A message that could not be saved is not delivered, the author gets
+        "/error message not saved <reason>" and may send it again.
+        :param user: author
+        :param text:
+        :param recipients:
+        :param m_datetime: server time of the message
+        :param future: Future of DataBase.submit_message
+        :return: None
+        """
+        error = future.exception()
+        if error is not None:
+            # rows the writer rejects fail with ValueError, anything else is a database error
+            reason = str(error) if isinstance(error, ValueError) else "database error"
+            message = Message(f"/error message not saved {reason}", SERVER_NAME, [user.username])
+            user.send(message, essential=True)
+            return
+
+        message_id = future.result()
+        message = Message(
+            text, user.username, list(recipients), m_datetime=m_datetime, message_id=message_id
+        )
+        self.send_to_recipients(user, message, recipients)
+
+        # a message without recipients is not saved
+        if message_id is not None:
+            message = Message(f"/sent {message_id}", SERVER_NAME, [user.username])
+            user.send(message, essential=True)
+
+    def send_to_recipients(self, b_user, message, recipients: list) -> None:
+        """
+        Sends the message only to its recipients (everyone for "All users"),
+        the sender gets "/undelivered <names>" for recipients that are not online
+        :param b_user: sender
+        :param message: Message, encoded once per wire format for all recipients
+        :param recipients:
+        :return: None
+        """
+        undelivered = self.users.route(message, recipients, sender=b_user)
+        if undelivered:
+            message = Message(
+                "/undelivered " + " ".join(undelivered), SERVER_NAME, [b_user.username]
+            )
+            b_user.send(message, essential=True)
+
+    def broadcast_to_users(self, b_user, message) -> None:
+        """
+        Sends to all users (except the transmitted) message, including users of other workers.
+        The frame is only queued to the outboxes, slow users do not block the sender.
+        :param b_user:
+        :param message: Message, encoded once per wire format for all users
+        :return: None
+        """
+        self.users.route(message, ["All users"], sender=b_user)
+
+    def bus_event(self, header: dict, body: bytes) -> None:
+        """
+        Handles a message from the bus: users of other workers joining and leaving,
+        and chat frames for users of this worker
+        :param header:
+        :param body: frame of the chat message for "route"
+        :return: None
+        """
+        op = header["op"]
+        if op == "route":
+            message = Message.from_frame(body)
+            self.users.deliver(message, header["to"])
+            self.db.cache_message(message)
+
+        elif op == "join":
+            self.users.add_remote(header["username"])
+            self.presence.join(header["username"], announce=False)
+
+        elif op == "leave":
+            self.users.remove_remote(header["username"])
+            self.presence.leave(header["username"])
+
+        elif op == "roster":
+            self.users.set_remote(header["usernames"])
+
+
+class HistoryReply:
+    """
+    Reply to /load, /sync or /search: chunks of rows of the database, every chunk
+    is one page (one compressed frame for clients of the binary format), then a
+    last message with the cursor of the next page. The server runs query() the
+    way of its mode, send() is called for every chunk and end() after the last one.
+    """
+
+    def __init__(self, user, data_text: str):
+        self.user = user
+        # recipient of the messages of the pages
+        self.recipient = SERVER_NAME
+        self.count = 0
+
+    def query(self):
+        """
+        :return: generator of lists of (message_id, text, author, datetime)
+        """
+        raise NotImplementedError
+
+    def send(self, records: list) -> None:
+        """
+        :param records: a chunk of query()
+        :return: None
+        """
+        page = MessagePage(
+            [
+                Message(
+                    text,
+                    author,
+                    [self.recipient],
+                    m_datetime=m_datetime.strftime("%Y-%m-%d %H:%M:%S"),
+                    message_id=message_id,
+                )
+                for message_id, text, author, m_datetime in records
+            ]
+        )
+        self.user.send(page, essential=True)
+        self.count += len(records)
+
+    def end(self) -> None:
+        raise NotImplementedError
+
+    def _end(self, text: str) -> None:
+        self.user.send(Message(text, SERVER_NAME, [self.user.username]), essential=True)
+
+
+class LoadReply(HistoryReply):
+    """
+    A page of the user's history, newest first, and then "/history_end <message_id>",
+    the cursor for "/load <n> before <message_id>"
+    """
+
+    def __init__(self, user, data_text: str):
+        super().__init__(user, data_text)
+        self.limit, self.before = parse_load_command(data_text)
+        self.oldest_id = ""
+
+    def query(self):
+        return self.user.db.load_history(self.user.username, self.limit, self.before)
+
+    def send(self, records: list) -> None:
+        super().send(records)
+        self.oldest_id = records[-1][0]
+
+    def end(self) -> None:
+        self._end(f"/history_end {self.oldest_id}")
+
+
+class SyncReply(HistoryReply):
+    """
+    The messages saved after "/sync <message_id>", oldest first, and then
+    "/sync_end <message_id>", the id of the last message sent ("more" is appended
+    when the page was full and the client should sync again from there)
+    """
+
+    def __init__(self, user, data_text: str):
+        super().__init__(user, data_text)
+        self.recipient = user.username
+        self.last_id = parse_sync_command(data_text)
+
+    def query(self):
+        return self.user.db.load_since(self.user.username, self.last_id)
+
+    def send(self, records: list) -> None:
+        super().send(records)
+        self.last_id = records[-1][0]
+
+    def end(self) -> None:
+        more = " more" if self.count >= HISTORY_MAX_PAGE_SIZE else ""
+        self._end(f"/sync_end {self.last_id}{more}")
+
+
+class SearchReply(HistoryReply):
+    """
+    A page of the user's messages that contain all the words of "/search <words>",
+    best matches first, and then "/search_end <offset>", the offset for
+    "/search from <offset> <words>" (empty after the last page)
+    """
+
+    def __init__(self, user, data_text: str):
+        super().__init__(user, data_text)
+        self.query_text, self.offset = parse_search_command(data_text)
+
+    def query(self):
+        return self.user.db.search(self.user.username, self.query_text, offset=self.offset)
+
+    def end(self) -> None:
+        next_offset = self.offset + self.count
+        if self.count < SEARCH_PAGE_SIZE or next_offset >= SEARCH_MAX_RESULTS:
+            next_offset = ""
+        self._end(f"/search_end {next_offset}")
@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+
+from chat_util import Message
+from config_server import (
+    SERVER_NAME,
+    HEARTBEAT_IDLE,
+    HEARTBEAT_TIMEOUT,
+    HEARTBEAT_TICK,
+    HEARTBEAT_WHEEL_SLOTS,
+)
+
+log = logging.getLogger("chat.heartbeat")
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: a ring of slots of tick seconds, a timer is put into the slot
+    of its deadline (deadlines a turn or more ahead wait for their turn there).
+    Advancing the wheel only looks at the slots passed since the last advance,
+    so it costs O(expired timers), not O(timers), when a turn of the wheel is
+    longer than the timeouts. Timers are not cancelled, the owner ignores stale ones.
+    """
+
+    def __init__(self, tick: float, slots: int):
+        """
+        :param tick: seconds of a slot
+        :param slots: slots of the ring
+        """
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._current = int(time.monotonic() / tick)
+
+    def schedule(self, deadline: float, item) -> None:
+        """
+        :param deadline: time.monotonic() when the timer expires
+        :param item: returned by advance() once expired
+        :return: None
+        """
+        # a deadline in a passed slot expires at the next advance
+        ticks = max(-int(-deadline // self.tick), self._current + 1)
+        self._slots[ticks % len(self._slots)].append((ticks, item))
+
+    def advance(self, now: float) -> list:
+        """
+        :param now: time.monotonic()
+        :return: items of the expired timers
+        """
+        target = int(now / self.tick)
+        expired = []
+        # a full turn visits every slot, more turns would visit them again
+        last = min(target, self._current + len(self._slots))
+        for ticks in range(self._current + 1, last + 1):
+            slot = self._slots[ticks % len(self._slots)]
+            if not slot:
+                continue
+            waiting = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    waiting.append(entry)
+            slot[:] = waiting
+        self._current = max(self._current, target)
+        return expired
+
+
+class Heartbeat:
+    """
+    Finds dead and idle connections. Every received frame sets user.last_seen,
+    a connection silent for idle seconds gets "/ping" (answered with "/pong"),
+    without any frame within timeout seconds more it is reaped. A connection that
+    did not log in within idle seconds is reaped without a ping.
+
+    Every connection has one timer in a TimerWheel, a tick only looks at the
+    expired ones and moves the timers of active connections forward.
+    """
+
+    def __init__(
+        self,
+        timer,
+        reap,
+        idle=HEARTBEAT_IDLE,
+        timeout=HEARTBEAT_TIMEOUT,
+        tick=HEARTBEAT_TICK,
+        slots=HEARTBEAT_WHEEL_SLOTS,
+    ):
+        """
+        :param timer: timer(delay, callback) of the event loop (loop.call_later),
+        None for the threaded server: one thread of its own ticks for the life of the server
+        :param reap: reap(user) closes the connection, the server handles it
+        like any other disconnect
+        :param idle: seconds of silence before a ping
+        :param timeout: seconds to wait for an answer to the ping
+        :param tick: seconds between checks of the expired timers
+        :param slots: slots of the timer wheel
+        """
+        self.timer = timer
+        self.reap = reap
+        self.idle = idle
+        self.timeout = timeout
+
+        self._wheel = TimerWheel(tick, slots)
+        self._lock = threading.Lock()
+        self._running = False
+
+        self.pinged = 0
+        self.reaped = 0
+
+    def watch(self, user) -> None:
+        """
+        Starts watching a new connection, user.outbox must be set
+        :param user:
+        :return: None
+        """
+        if not self.idle:
+            return
+        now = time.monotonic()
+        user.last_seen = now
+        user.ping_sent = 0.0
+        with self._lock:
+            self._wheel.schedule(now + self.idle, user)
+            if self._running:
+                return
+            self._running = True
+        if self.timer is None:
+            threading.Thread(target=self._run, name="heartbeat", daemon=True).start()
+        else:
+            self.timer(self._wheel.tick, self.tick)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self._wheel.tick)
+            self._check_expired()
+
+    def tick(self) -> None:
+        """
+        Checks the connections whose timers expired, then schedules the next tick
+        :return: None
+        """
+        self._check_expired()
+        self.timer(self._wheel.tick, self.tick)
+
+    def _check_expired(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = self._wheel.advance(now)
+        for user in expired:
+            self._check(user, now)
+
+    def _check(self, user, now: float) -> None:
+        if user.outbox.closed:
+            return
+        if user.ping_sent and user.last_seen >= user.ping_sent:
+            # any frame after the ping answers it
+            user.ping_sent = 0.0
+
+        if now - user.last_seen < self.idle:
+            deadline = user.last_seen + self.idle
+        elif not user.logged_in or user.ping_sent:
+            self.reaped += 1
+            log.info(
+                "%s %s reaped, silent for %.0f s",
+                user.username,
+                user.address,
+                now - user.last_seen,
+            )
+            self.reap(user)
+            return
+        else:
+            user.ping_sent = now
+            self.pinged += 1
+            user.send(Message("/ping", SERVER_NAME, [user.username]), essential=True)
+            deadline = now + self.timeout
+
+        with self._lock:
+            self._wheel.schedule(deadline, user)
+
+    def stats(self) -> dict:
+        return {"pinged": self.pinged, "reaped": self.reaped}
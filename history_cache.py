@@ -0,0 +1,237 @@
+import collections
+import threading
+
+from config_server import (
+    HISTORY_CACHE_USER_MESSAGES,
+    HISTORY_CACHE_MAX_MESSAGES,
+    HISTORY_CACHE_MAX_BYTES,
+    HISTORY_MAX_PAGE_SIZE,
+)
+
+# Approximate memory of a cached message besides its text and author
+RECORD_OVERHEAD = 64
+
+
+class CachedHistory:
+    """
+    The newest messages of one user, newest first, without gaps.
+    complete is True when the user has no older messages.
+    """
+
+    __slots__ = ("records", "complete", "size")
+
+    def __init__(self, records: list, complete: bool):
+        self.records = records
+        self.complete = complete
+        self.size = sum(record_size(record) for record in records)
+
+
+def record_size(record: tuple) -> int:
+    return len(record[1]) + len(record[2]) + RECORD_OVERHEAD
+
+
+class HistoryCache:
+    """
+    Server-side cache of the recent history of users, in front of the storage.
+    It is filled write-through with every saved message and warmed lazily with
+    the newest page of a user on a miss. Least recently used users are evicted
+    when the cache holds more than max_messages messages or max_bytes.
+    Records are (message_id, text, author, datetime), like DataBase.load_history.
+    """
+
+    def __init__(
+        self,
+        loader,
+        user_messages=HISTORY_CACHE_USER_MESSAGES,
+        max_messages=HISTORY_CACHE_MAX_MESSAGES,
+        max_bytes=HISTORY_CACHE_MAX_BYTES,
+    ):
+        """
+        :param loader: loader(username, limit), the newest records of the user from the storage
+        :param user_messages: messages kept per user
+        :param max_messages: messages kept in total
+        :param max_bytes: approximate size of the kept messages in total
+        """
+        self.loader = loader
+        self.user_messages = user_messages
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._messages = 0
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self, username: str, limit: int, before=None):
+        """
+        :param username:
+        :param limit: page size
+        :param before: message_id, only older messages. None - newest, such a page
+        is loaded into the cache on a miss
+        :return: records newest first, None if the page is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                records = entry.records
+                if before is not None:
+                    records = [record for record in records if record[0] < before]
+                if len(records) >= limit or entry.complete:
+                    self._entries.move_to_end(username)
+                    self.hits += 1
+                    return records[:limit]
+
+            self.misses += 1
+            if before is not None or username in self._loading:
+                return None
+            self._loading[username] = []
+
+        return self._warm(username, limit)[:limit]
+
+    def load_since(self, username: str, after: int, limit: int):
+        """
+        :param username:
+        :param after: message_id of the last message the client has seen
+        :param limit: page size
+        :return: records saved after "after", oldest first, None if they are not all cached
+        """
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and (
+                entry.complete or (entry.records and entry.records[-1][0] <= after)
+            ):
+                self._entries.move_to_end(username)
+                self.hits += 1
+                records = [record for record in entry.records if record[0] > after]
+                records.reverse()
+                return records[:limit]
+
+            self.misses += 1
+            return None
+
+    def _warm(self, username: str, limit: int) -> list:
+        """
+        Loads the newest messages of the user from the storage. Messages saved
+        while they are loaded are collected in self._loading and merged in.
+        :param username:
+        :param limit: page size requested by the client
+        :return: the loaded records, newest first
+        """
+        count = min(max(limit, self.user_messages), HISTORY_MAX_PAGE_SIZE)
+        try:
+            records = self.loader(username, count)
+        except Exception:
+            with self._lock:
+                del self._loading[username]
+            raise
+
+        with self._lock:
+            complete = len(records) < count
+            pending = self._loading.pop(username)
+            if pending:
+                merged = {record[0]: record for record in records + pending}
+                records = [merged[message_id] for message_id in sorted(merged, reverse=True)]
+
+            complete = complete and len(records) <= self.user_messages
+            self._store(username, CachedHistory(records[: self.user_messages], complete))
+        return records
+
+    def add(self, message_id: int, author: str, recipients: list, text: str, m_datetime) -> None:
+        """
+        Write-through of a saved message to the cached histories of its author
+        and recipients (of everyone for "All users"), users that are not cached are skipped
+        :param message_id:
+        :param author:
+        :param recipients:
+        :param text:
+        :param m_datetime: datetime
+        :return: None
+        """
+        record = (message_id, text, author, m_datetime)
+        with self._lock:
+            usernames = [author, *recipients]
+            if "All users" in recipients:
+                usernames = [author, *self._loading, *self._entries]
+            for username in dict.fromkeys(usernames):
+                pending = self._loading.get(username)
+                if pending is not None:
+                    pending.append(record)
+                    continue
+
+                entry = self._entries.get(username)
+                if entry is None:
+                    continue
+                # messages of other workers may arrive after newer local ones
+                index = 0
+                while index < len(entry.records) and entry.records[index][0] > message_id:
+                    index += 1
+                if index < len(entry.records) and entry.records[index][0] == message_id:
+                    continue
+                entry.records.insert(index, record)
+                entry.size += record_size(record)
+                self._messages += 1
+                self._bytes += record_size(record)
+                while len(entry.records) > self.user_messages:
+                    removed = entry.records.pop()
+                    entry.size -= record_size(removed)
+                    entry.complete = False
+                    self._messages -= 1
+                    self._bytes -= record_size(removed)
+            self._evict()
+
+    def _store(self, username: str, entry: CachedHistory) -> None:
+        """
+        Replaces the cached history of the user, called under the lock
+        """
+        self._discard(username)
+        self._entries[username] = entry
+        self._messages += len(entry.records)
+        self._bytes += entry.size
+        self._evict()
+
+    def discard(self, username: str) -> None:
+        """
+        Drops the cached history of the user, with several workers it may be stale
+        after the user was connected to another worker
+        :param username:
+        :return: None
+        """
+        with self._lock:
+            self._discard(username)
+
+    def _discard(self, username: str) -> None:
+        entry = self._entries.pop(username, None)
+        if entry is not None:
+            self._messages -= len(entry.records)
+            self._bytes -= entry.size
+
+    def _evict(self) -> None:
+        """
+        Evicts least recently used users until the cache fits its bounds,
+        called under the lock
+        """
+        while self._entries and (
+            self._messages > self.max_messages or self._bytes > self.max_bytes
+        ):
+            username = next(iter(self._entries))
+            self._discard(username)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        :return: size of the cache and its hit, miss and eviction counters
+        """
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "messages": self._messages,
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,69 @@
+import logging
+import threading
+import time
+
+from metrics import LOG_SUPPRESSED
+from config_server import LOG_LEVEL, LOG_RATE_LIMIT, LOG_RATE_INTERVAL
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most limit records of one kind (logger, level and message
+    template) per interval seconds, so a flood of disconnects or failed logins
+    does not make the server spend its time writing the log. The records dropped
+    are counted and reported by the next record of the kind that passes.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL):
+        """
+        :param limit: records of one kind per interval, 0 - no limit
+        :param interval: seconds
+        """
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        # kind: [start of the interval, records passed, records dropped]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        if not self.limit:
+            return True
+        kind = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(kind)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window is not None else 0
+                self._windows[kind] = [now, 1, 0]
+            elif window[1] < self.limit:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                LOG_SUPPRESSED.inc()
+                return False
+
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} more like this were dropped)"
+        return True
+
+
+def setup_logging(level=LOG_LEVEL) -> None:
+    """
+    Logs the records of the "chat" loggers to stderr, rate limited.
+    Does nothing if the application has set up a handler for them already.
+    :param level: name of the lowest level logged
+    :return: None
+    """
+    logger = logging.getLogger("chat")
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.addFilter(RateLimitFilter())
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
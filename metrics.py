@@ -0,0 +1,379 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config_server import METRICS_HOST, METRICS_PORT, METRICS_LATENCY_BUCKETS
+
+log = logging.getLogger("chat.metrics")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: str) -> list:
+        return [(name, labels, self.value)]
+
+
+class _Gauge(_Counter):
+    __slots__ = ()
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def dec(self, amount=1) -> None:
+        self.inc(-amount)
+
+
+class _Histogram:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        # the last count is of the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name: str, labels: str) -> list:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(self.bounds + ("+Inf",), counts):
+            cumulative += count
+            samples.append((f"{name}_bucket", f'{labels}{separator}le="{bound}"', cumulative))
+        samples.append((f"{name}_sum", labels, total))
+        samples.append((f"{name}_count", labels, cumulative))
+        return samples
+
+
+class Metric:
+    """
+    A counter, gauge or histogram, optionally with labels. Without labels the
+    metric is used directly (inc, set, observe), with labels its children are
+    taken with labels(value, ...), every child is created once and kept.
+    """
+
+    _types = {"counter": _Counter, "gauge": _Gauge}
+
+    def __init__(self, name: str, help_text: str, kind: str, labels=(), buckets=None):
+        """
+        :param name: metric name, counters end with "_total"
+        :param help_text:
+        :param kind: "counter", "gauge" or "histogram"
+        :param labels: names of the labels
+        :param buckets: upper bounds of a histogram, default METRICS_LATENCY_BUCKETS
+        """
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = labels
+        self.buckets = tuple(buckets or METRICS_LATENCY_BUCKETS)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not labels:
+            # the only child, its methods are bound to the metric without a wrapper
+            child = self.labels()
+            for method in ("inc", "set", "dec", "observe"):
+                if hasattr(child, method):
+                    setattr(self, method, getattr(child, method))
+
+    def labels(self, *values):
+        """
+        :param values: values of the labels, in the order of their names
+        :return: the child of these values
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    if self.kind == "histogram":
+                        child = _Histogram(self.buckets)
+                    else:
+                        child = self._types[self.kind]()
+                    self._children[values] = child
+        return child
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            labels = ",".join(
+                f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, values)
+            )
+            for name, sample_labels, value in child.samples(self.name, labels):
+                lines.append(_sample(name, sample_labels, value))
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process and collectors, functions called at every scrape
+    that turn the stats() of a component into metrics
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels=()) -> Metric:
+        return self._add(Metric(name, help_text, "counter", labels))
+
+    def gauge(self, name: str, help_text: str, labels=()) -> Metric:
+        return self._add(Metric(name, help_text, "gauge", labels))
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=None) -> Metric:
+        return self._add(Metric(name, help_text, "histogram", labels, buckets))
+
+    def collect(self, prefix: str, help_text: str, stats, counters=(), label=None) -> None:
+        """
+        Exports the dict returned by stats() as "<prefix>_<key>" gauges, the keys of
+        counters as "<prefix>_<key>_total" counters. A collector registered again
+        with the same prefix replaces the previous one (a server started again).
+        :param prefix: metric name prefix
+        :param help_text: what the stats are of
+        :param stats: function returning a dict of numbers, with a label a dict of
+        such dicts by the value of the label (e.g. per user)
+        :param counters: keys of the values that only grow
+        :param label: name of the label, None for a single set of stats
+        :return: None
+        """
+        with self._lock:
+            self._collectors[prefix] = (help_text, stats, counters, label)
+
+    def render(self) -> str:
+        """
+        :return: all the metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors.items())
+
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for prefix, (help_text, stats, counters, label) in collectors:
+            try:
+                values = stats()
+            except Exception as e:
+                log.warning("Collector %s failed: %s", prefix, e)
+                continue
+            if label is None:
+                values = {None: values}
+            # the samples of a name follow its HELP and TYPE lines
+            samples = {}
+            for label_value, child in values.items():
+                labels = "" if label is None else f'{label}="{_escape(label_value)}"'
+                for key, value in child.items():
+                    if isinstance(value, bool):
+                        value = int(value)
+                    if isinstance(value, (int, float)):
+                        samples.setdefault(key, []).append((labels, value))
+            for key, key_samples in samples.items():
+                kind = "counter" if key in counters else "gauge"
+                name = f"{prefix}_{key}_total" if kind == "counter" else f"{prefix}_{key}"
+                lines.append(f"# HELP {name} {help_text}, {key}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines += [_sample(name, labels, value) for labels, value in key_samples]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample(name: str, labels: str, value) -> str:
+    if labels:
+        return f"{name}{{{labels}}} {value}"
+    return f"{name} {value}"
+
+
+REGISTRY = Registry()
+
+# Hot paths of the servers, the latencies are in seconds
+BYTES_RECEIVED = REGISTRY.counter("chat_bytes_received_total", "Bytes received from clients")
+PARSE_SECONDS = REGISTRY.histogram(
+    "chat_parse_seconds", "Decoding of a received frame, its count is the frames received"
+)
+FRAME_SECONDS = REGISTRY.histogram(
+    "chat_frame_seconds", "Handling of a received frame, parsing included"
+)
+ROUTE_SECONDS = REGISTRY.histogram(
+    "chat_route_seconds", "Fan-out of a message to the outboxes of its recipients"
+)
+DELIVERIES = REGISTRY.counter(
+    "chat_deliveries_total", "Messages queued to the outboxes of their recipients"
+)
+WRITE_SECONDS = REGISTRY.histogram(
+    "chat_outbox_write_seconds",
+    "Writes of queued frames to the socket of a client (or of a federation peer), "
+    "the async server waits for the transport buffer to drain",
+)
+BYTES_SENT = REGISTRY.counter("chat_bytes_sent_total", "Bytes written to clients")
+OUTBOX_DROPPED = REGISTRY.counter(
+    "chat_outbox_dropped_total", "Frames dropped because the outbox of a client was full"
+)
+OUTBOX_EVICTED = REGISTRY.counter(
+    "chat_outbox_evicted_total", "Clients disconnected because their outbox was full"
+)
+DB_SECONDS = REGISTRY.histogram(
+    "chat_db_seconds",
+    "Database calls: login and register (with the password hash), new_message "
+    "(from submit to commit), save_messages (a batch), load_history, load_since, search, "
+    "existing_users (the check of the recipients of a message)",
+    labels=("op",),
+)
+PRESENCE_SECONDS = REGISTRY.histogram(
+    "chat_presence_flush_seconds", "Sending a presence delta to all logged in users"
+)
+PRESENCE_UPDATES = REGISTRY.counter(
+    "chat_presence_updates_total",
+    "Presence frames sent to users: delta, snapshot or catch_up of a resumed session",
+    labels=("kind",),
+)
+THROTTLED = REGISTRY.counter(
+    "chat_throttled_frames_total", "Frames dropped by the rate limits of their client"
+)
+FLOOD_DISCONNECTS = REGISTRY.counter(
+    "chat_flood_disconnects_total", "Clients disconnected for ignoring the rate limits"
+)
+LOG_SUPPRESSED = REGISTRY.counter(
+    "chat_log_suppressed_total", "Log records dropped by the rate limit of the log"
+)
+
+
+def register_server(users, admission, heartbeat, db) -> None:
+    """
+    Exports the stats of the components of a server, called when it starts
+    :param users: UserRegistry
+    :param admission: Admission
+    :param heartbeat: Heartbeat
+    :param db: DataBase
+    :return: None
+    """
+    REGISTRY.collect(
+        "chat_connections",
+        "Connections of the server",
+        lambda: {"open": len(users), "logged_in": users.logged_in_count()},
+    )
+    REGISTRY.collect(
+        "chat_admission",
+        "Admission control of new connections",
+        admission.stats,
+        counters=("accepted", "admitted", "queued", "shed"),
+    )
+    REGISTRY.collect(
+        "chat_heartbeat",
+        "Idle connections pinged and dead ones reaped",
+        heartbeat.stats,
+        counters=("pinged", "reaped"),
+    )
+    REGISTRY.collect(
+        "chat_message_writer",
+        "Background writer of chat messages",
+        db.writer_stats,
+        counters=("batches", "saved", "failed"),
+    )
+    REGISTRY.collect(
+        "chat_db_pool",
+        "Connection pool of the database",
+        db.backend.pool_stats,
+        counters=("checkouts", "waits", "timeouts", "reconnects"),
+    )
+    REGISTRY.collect(
+        "chat_outbox",
+        "Outbox of the connection of a logged in user",
+        lambda: {
+            user.username: user.outbox.stats()
+            for user in users.logged_in_users()
+            if user.outbox is not None
+        },
+        counters=("dropped", "sent_frames", "sent_bytes", "writes"),
+        label="user",
+    )
+    REGISTRY.collect(
+        "chat_rate_limit",
+        "Rate limits of a logged in user",
+        lambda: {user.username: user.limiter.stats() for user in users.logged_in_users()},
+        counters=("allowed", "throttled"),
+        label="user",
+    )
+    if db.credential_cache is not None:
+        REGISTRY.collect(
+            "chat_credential_cache",
+            "Cache of verified logins",
+            db.credential_cache.stats,
+            counters=("hits", "misses"),
+        )
+    if db.history_cache is not None:
+        REGISTRY.collect(
+            "chat_history_cache",
+            "Cache of recent history",
+            db.history_cache.stats,
+            counters=("hits", "misses", "evictions"),
+        )
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics of the admin port
+    """
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        log.debug("%s " + format, self.address_string(), *args)
+
+
+def serve_metrics(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serves the metrics on the admin port in a daemon thread
+    :param host:
+    :param port: 0 - off
+    :return: the HTTP server, None if it is off or the port is taken
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        log.warning("Metrics are not served on %s:%s: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Metrics on http://%s:%s/metrics", host, port)
+    return server
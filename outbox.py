@@ -0,0 +1,269 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+from metrics import (
+    WRITE_SECONDS,
+    BYTES_SENT,
+    OUTBOX_DROPPED,
+    OUTBOX_EVICTED,
+)
+from config_server import (
+    OUTBOX_MAX_FRAMES,
+    OUTBOX_MAX_BYTES,
+    OUTBOX_COALESCE_BYTES,
+    OUTBOX_POLICY,
+)
+
+
+class Outbox:
+    """
+    Bounded queue of outgoing frames of one connection, drained by its own writer,
+    so that a slow client never blocks the sender of a message.
+
+    When the queue is full, OUTBOX_POLICY decides what happens with chat frames:
+    "drop" - the frame is dropped,
+    "disconnect" - the client is disconnected,
+    "presence_only" - the client only gets essential frames (presence and replies
+    to its own requests) until the queue drains to half of its size.
+    Essential frames are never dropped, they may use up to twice the limit,
+    beyond that the client is disconnected.
+    """
+
+    def __init__(
+        self,
+        max_frames=OUTBOX_MAX_FRAMES,
+        max_bytes=OUTBOX_MAX_BYTES,
+        policy=OUTBOX_POLICY,
+        coalesce_bytes=OUTBOX_COALESCE_BYTES,
+    ):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.coalesce_bytes = coalesce_bytes
+
+        self._frames = collections.deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.closed = False
+        self.degraded = False
+        self.evicted = False
+
+        self.max_depth = 0
+        self.dropped = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.writes = 0
+
+    def put(self, frame: bytes, essential=False) -> bool:
+        """
+        Queues the frame
+        :param frame:
+        :param essential: presence or a reply to the client's own request
+        :return: True if the frame was queued
+        """
+        with self._lock:
+            if self.closed:
+                return False
+
+            if self.degraded and not essential:
+                self.dropped += 1
+                OUTBOX_DROPPED.inc()
+                return False
+
+            if (
+                len(self._frames) >= self.max_frames
+                or self._bytes + len(frame) > self.max_bytes
+            ):
+                if essential and self._bytes + len(frame) <= 2 * self.max_bytes:
+                    pass
+                elif self.policy == "drop" and not essential:
+                    self.dropped += 1
+                    OUTBOX_DROPPED.inc()
+                    return False
+                elif self.policy == "presence_only" and not essential:
+                    self.degraded = True
+                    self.dropped += 1
+                    OUTBOX_DROPPED.inc()
+                    return False
+                else:
+                    self._evict()
+                    return False
+
+            self._frames.append(frame)
+            self._bytes += len(frame)
+            self.max_depth = max(self.max_depth, len(self._frames))
+            self._wakeup()
+            return True
+
+    def _take_batch(self) -> list:
+        """
+        Takes queued frames up to coalesce_bytes (at least one frame),
+        they are written with a single syscall
+        :return: list of frames, empty if the queue is empty
+        """
+        with self._lock:
+            batch = []
+            size = 0
+            while self._frames and (not batch or size < self.coalesce_bytes):
+                frame = self._frames.popleft()
+                batch.append(frame)
+                size += len(frame)
+            self._bytes -= size
+
+            if self.degraded and self._bytes <= self.max_bytes // 2:
+                self.degraded = False
+
+        self.sent_frames += len(batch)
+        self.sent_bytes += size
+        if batch:
+            self.writes += 1
+            BYTES_SENT.inc(size)
+        return batch
+
+    def _evict(self) -> None:
+        """
+        Drops the queue and disconnects the slow client, called under the lock
+        :return: None
+        """
+        self.evicted = True
+        self.closed = True
+        OUTBOX_EVICTED.inc()
+        self._frames.clear()
+        self._bytes = 0
+        self._abort()
+
+    def _wakeup(self) -> None:
+        raise NotImplementedError
+
+    def _abort(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+        Sends the frames that are still queued and closes the connection
+        :return: None
+        """
+        with self._lock:
+            self.closed = True
+            self._wakeup()
+
+    def stats(self) -> dict:
+        """
+        :return: queue depth and counters of the connection
+        """
+        with self._lock:
+            return {
+                "depth": len(self._frames),
+                "bytes": self._bytes,
+                "max_depth": self.max_depth,
+                "dropped": self.dropped,
+                "degraded": self.degraded,
+                "evicted": self.evicted,
+                "sent_frames": self.sent_frames,
+                "sent_bytes": self.sent_bytes,
+                "writes": self.writes,
+            }
+
+
+class ThreadedOutbox(Outbox):
+    """
+    Outbox of the threaded server, drained by a writer thread
+    """
+
+    def __init__(self, sock, **kwargs):
+        super().__init__(**kwargs)
+        self.sock = sock
+        self._cond = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _wakeup(self) -> None:
+        self._cond.notify()
+
+    def _abort(self) -> None:
+        self._shutdown()
+        self._cond.notify()
+
+    def _shutdown(self) -> None:
+        """
+        Shutting the socket down wakes up the reading thread of the connection,
+        it then goes through the usual disconnect path
+        :return: None
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._frames and not self.closed:
+                    self._cond.wait()
+                if not self._frames:
+                    break
+
+            batch = self._take_batch()
+            start = time.perf_counter()
+            try:
+                self.sock.sendall(b"".join(batch))
+                WRITE_SECONDS.observe(time.perf_counter() - start)
+            except OSError:
+                with self._lock:
+                    self.closed = True
+                break
+
+        self._shutdown()
+        self.sock.close()
+
+
+class AsyncOutbox(Outbox):
+    """
+    Outbox of the asyncio server, drained by a task on the event loop
+    """
+
+    def __init__(self, writer, **kwargs):
+        super().__init__(**kwargs)
+        self.writer = writer
+        self._event = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _wakeup(self) -> None:
+        self._event.set()
+
+    def _abort(self) -> None:
+        self.writer.transport.abort()
+        self._event.set()
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                await self._event.wait()
+                self._event.clear()
+
+                batch = self._take_batch()
+                while batch:
+                    start = time.perf_counter()
+                    self.writer.write(b"".join(batch))
+                    await self.writer.drain()
+                    WRITE_SECONDS.observe(time.perf_counter() - start)
+                    batch = self._take_batch()
+
+                if self.closed:
+                    break
+        except (ConnectionError, OSError):
+            with self._lock:
+                self.closed = True
+        finally:
+            self.writer.close()
+
+    async def wait_closed(self) -> None:
+        """
+        Waits until the queued frames are written and the connection is closed
+        :return: None
+        """
+        await self._task
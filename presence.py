@@ -0,0 +1,153 @@
+import collections
+import secrets
+import threading
+import time
+
+from chat_util import Message
+from metrics import PRESENCE_SECONDS, PRESENCE_UPDATES
+from config_server import SERVER_NAME, PRESENCE_COALESCE_INTERVAL, PRESENCE_HISTORY
+
+
+def thread_timer(delay: float, callback) -> None:
+    """
+    Calls callback after delay seconds on a timer thread, scheduler of the threaded server
+    :param delay:
+    :param callback:
+    :return: None
+    """
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+
+class Presence:
+    """
+    Versioned roster of online users.
+    A newcomer gets one snapshot: "/now_online <version> <name> <name> ...",
+    everyone else gets small deltas: "/presence <version> +<joined> -<left> ...".
+    A version is "<epoch>.<number>", the epoch is random for every roster, so
+    the numbers of another worker or node (or of a restarted one) are never
+    mistaken for the numbers of this roster.
+    Joins and leaves within PRESENCE_COALESCE_INTERVAL are sent as one delta,
+    a join and a leave of the same user within the interval cancel out.
+    Applying a delta is idempotent, so a delta that is already contained in
+    a snapshot does no harm.
+    """
+
+    def __init__(self, users, schedule, interval=PRESENCE_COALESCE_INTERVAL):
+        """
+        :param users: UserRegistry, source of the snapshot and of delta recipients
+        :param schedule: schedule(delay, callback), runs callback after delay seconds
+        :param interval: coalescing window in seconds
+        """
+        self.users = users
+        self.schedule = schedule
+        self.interval = interval
+
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self._pending = {}
+        self._history = collections.deque(maxlen=PRESENCE_HISTORY)
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def join(self, username: str, announce=True) -> None:
+        """
+        :param username:
+        :param announce: tell the other workers through the bus (if any),
+        False for joins reported by the bus
+        :return: None
+        """
+        self._change(username, "+")
+        if announce and self.users.bus is not None:
+            self.users.bus.join(username)
+
+    def leave(self, username: str) -> None:
+        """
+        The bus announces leaves itself, when the username is released
+        :param username:
+        :return: None
+        """
+        self._change(username, "-")
+
+    def _change(self, username: str, sign: str) -> None:
+        with self._lock:
+            previous = self._pending.get(username)
+            if previous is not None and previous != sign:
+                del self._pending[username]
+            else:
+                self._pending[username] = sign
+
+            if self._scheduled:
+                return
+            self._scheduled = True
+
+        self.schedule(self.interval, self.flush)
+
+    def flush(self) -> None:
+        """
+        Sends the pending changes as one delta to all logged in users
+        :return: None
+        """
+        with self._lock:
+            self._scheduled = False
+            if not self._pending:
+                return
+            self.version += 1
+            changes = " ".join(sign + name for name, sign in self._pending.items())
+            self._pending = {}
+            version = self.version
+
+            message = Message(
+                f"/presence {self.epoch}.{version} {changes}", SERVER_NAME, ["All users"]
+            )
+            self._history.append((version, message))
+
+        start = time.perf_counter()
+        users = self.users.logged_in_users()
+        for user in users:
+            user.send(message, essential=True)
+        PRESENCE_SECONDS.observe(time.perf_counter() - start)
+        PRESENCE_UPDATES.labels("delta").inc(len(users))
+
+    def catch_up(self, user, version: str) -> None:
+        """
+        Brings the roster of a resumed client up to date: nothing if it has not
+        changed, the missed deltas if they are all still kept, a snapshot otherwise
+        (also when the version comes from another roster)
+        :param user:
+        :param version: presence version "<epoch>.<number>" the client has applied
+        :return: None
+        """
+        epoch, _, number = version.partition(".")
+        if epoch != self.epoch or not number.isdigit():
+            self.snapshot(user)
+            return
+        number = int(number)
+
+        with self._lock:
+            missed = [message for delta, message in self._history if delta > number]
+            complete = number <= self.version and len(missed) == self.version - number
+
+        if not complete:
+            self.snapshot(user)
+            return
+        for message in missed:
+            user.send(message, essential=True)
+        PRESENCE_UPDATES.labels("catch_up").inc(len(missed))
+
+    def snapshot(self, user) -> None:
+        """
+        Sends the full roster to one user
+        :param user:
+        :return: None
+        """
+        with self._lock:
+            version = self.version
+        message = Message(
+            f"/now_online {self.epoch}.{version} " + " ".join(self.users.usernames()),
+            SERVER_NAME,
+            [user.username],
+        )
+        user.send(message, essential=True)
+        PRESENCE_UPDATES.labels("snapshot").inc()
@@ -0,0 +1,133 @@
+import time
+
+from config_server import (
+    RATE_MESSAGES,
+    RATE_MESSAGES_BURST,
+    RATE_BYTES,
+    RATE_BYTES_BURST,
+    RATE_COMMANDS,
+    RATE_COMMANDS_BURST,
+    RATE_DISCONNECT_AFTER,
+)
+
+# Commands that cost a database query or a large reply, they have their own budget
+EXPENSIVE_COMMANDS = ("/load", "/sync", "/search", "/now_online")
+
+
+def is_expensive(text: str) -> bool:
+    """
+    :param text: text of a message from a logged in user
+    :return: True for the commands of EXPENSIVE_COMMANDS, like the server dispatches them
+    """
+    return text.startswith(EXPENSIVE_COMMANDS) or "/load" in text
+
+
+class TokenBucket:
+    """
+    Up to burst tokens (at least one second of the rate), refilled with rate tokens
+    per second. A rate of 0 never limits.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def has(self, cost: float) -> bool:
+        # a cost above the burst passes with a full bucket, it would never pass otherwise
+        return not self.rate or self.tokens >= min(cost, self.burst)
+
+    def wait(self, cost: float) -> float:
+        """
+        :param cost:
+        :return: seconds until the bucket has the tokens
+        """
+        if self.has(cost):
+            return 0.0
+        return (min(cost, self.burst) - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Flood protection of one connection: token buckets of chat messages and bytes
+    per second and a separate budget of expensive commands. A frame is allowed only
+    if all its buckets have the tokens, a throttled frame takes none of them.
+    Checking a frame allocates nothing, the counters are kept for stats().
+    """
+
+    __slots__ = ("messages", "bytes", "commands", "allowed", "throttled", "streak")
+
+    def __init__(
+        self,
+        messages=RATE_MESSAGES,
+        messages_burst=RATE_MESSAGES_BURST,
+        bytes_rate=RATE_BYTES,
+        bytes_burst=RATE_BYTES_BURST,
+        commands=RATE_COMMANDS,
+        commands_burst=RATE_COMMANDS_BURST,
+    ):
+        """
+        :param messages: chat messages per second, 0 - no limit
+        :param messages_burst: chat messages sent at once after a pause
+        :param bytes_rate: bytes per second of all frames, 0 - no limit
+        :param bytes_burst:
+        :param commands: expensive commands per second, 0 - no limit
+        :param commands_burst:
+        """
+        self.messages = TokenBucket(messages, messages_burst)
+        self.bytes = TokenBucket(bytes_rate, bytes_burst)
+        self.commands = TokenBucket(commands, commands_burst)
+
+        self.allowed = 0
+        self.throttled = 0
+        # throttled frames since the last allowed one
+        self.streak = 0
+
+    def allow(self, size: int, command=False) -> bool:
+        """
+        :param size: bytes of the frame
+        :param command: True for an expensive command, False for a chat message
+        :return: True if the frame may be handled, its tokens are taken
+        """
+        now = time.monotonic()
+        bucket = self.commands if command else self.messages
+        bucket.refill(now)
+        self.bytes.refill(now)
+
+        if bucket.has(1) and self.bytes.has(size):
+            bucket.tokens -= 1
+            self.bytes.tokens -= min(size, self.bytes.burst)
+            self.allowed += 1
+            self.streak = 0
+            return True
+
+        self.throttled += 1
+        self.streak += 1
+        return False
+
+    def retry_after(self, size: int, command=False) -> float:
+        """
+        :param size: bytes of the throttled frame
+        :param command:
+        :return: seconds until such a frame would be allowed
+        """
+        bucket = self.commands if command else self.messages
+        return max(bucket.wait(1), self.bytes.wait(size))
+
+    @property
+    def flooding(self) -> bool:
+        """
+        :return: True if the client kept sending RATE_DISCONNECT_AFTER throttled frames
+        in a row, it ignores the errors and should be disconnected
+        """
+        return 0 < RATE_DISCONNECT_AFTER <= self.streak
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "throttled": self.throttled}
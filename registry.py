@@ -0,0 +1,206 @@
+import threading
+import time
+
+from codec import JSON
+from metrics import ROUTE_SECONDS, DELIVERIES
+
+
+class UserRegistry:
+    """
+    Thread-safe registry of connected users. Connections are indexed by socket,
+    logged in users by username, so admission, login and disconnect checks are
+    constant time regardless of the number of connections.
+    With several worker processes, usernames are claimed through the bus and
+    users of other workers are kept as remote names, their messages go over the bus.
+    """
+
+    def __init__(self, bus=None):
+        """
+        :param bus: BusClient of the worker, None for a single process
+        """
+        self.bus = bus
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._by_name = {}
+        self._remote = set()
+
+    def add(self, user) -> None:
+        """
+        Registers a new (not yet logged in) connection
+        :param user:
+        :return: None
+        """
+        with self._lock:
+            self._connections[user.socket] = user
+
+    def remove(self, user) -> None:
+        """
+        Removes the connection and frees its username
+        :param user:
+        :return: None
+        """
+        with self._lock:
+            self._connections.pop(user.socket, None)
+            if self._by_name.get(user.username) is not user:
+                return
+            del self._by_name[user.username]
+        if self.bus is not None:
+            self.bus.release(user.username)
+
+    def claim(self, user) -> bool:
+        """
+        Reserves user.username for the connection before checking the password,
+        so two connections can not log in with the same name at once.
+        With a bus, this blocks until the hub confirms the name for the cluster.
+        :param user:
+        :return: False if the username is already taken by another connection
+        """
+        with self._lock:
+            owner = self._by_name.get(user.username)
+            if owner is not None and owner is not user:
+                return False
+            self._by_name[user.username] = user
+
+        if self.bus is not None and not self.bus.claim(user.username):
+            with self._lock:
+                if self._by_name.get(user.username) is user:
+                    del self._by_name[user.username]
+            return False
+        return True
+
+    def release(self, user) -> None:
+        """
+        Frees the username claimed by the connection (failed login)
+        :param user:
+        :return: None
+        """
+        with self._lock:
+            if self._by_name.get(user.username) is not user:
+                return
+            del self._by_name[user.username]
+        if self.bus is not None:
+            self.bus.release(user.username)
+
+    def get(self, username: str):
+        """
+        :param username:
+        :return: logged in user or None
+        """
+        user = self._by_name.get(username)
+        if user is not None and user.logged_in:
+            return user
+        return None
+
+    def get_by_socket(self, sock):
+        """
+        :param sock:
+        :return: user of the connection or None
+        """
+        return self._connections.get(sock)
+
+    def logged_in_count(self) -> int:
+        """
+        :return: number of logged in (or logging in) users
+        """
+        return len(self._by_name)
+
+    def logged_in_users(self) -> list:
+        """
+        :return: snapshot of the logged in users
+        """
+        with self._lock:
+            users = list(self._by_name.values())
+        return [user for user in users if user.logged_in]
+
+    def usernames(self) -> list:
+        """
+        :return: names of the logged in users, including users of other workers
+        """
+        with self._lock:
+            remote = list(self._remote)
+        return [user.username for user in self.logged_in_users()] + remote
+
+    def set_remote(self, usernames: list) -> None:
+        """
+        Replaces the users of other workers (roster from the bus)
+        :param usernames:
+        :return: None
+        """
+        with self._lock:
+            self._remote = set(usernames)
+
+    def add_remote(self, username: str) -> None:
+        with self._lock:
+            self._remote.add(username)
+
+    def remove_remote(self, username: str) -> None:
+        with self._lock:
+            self._remote.discard(username)
+
+    def route(self, message, recipients: list, sender=None) -> list:
+        """
+        Sends the message only to its recipients, "All users" sends it to everyone.
+        Each recipient is a dict lookup, so the cost depends on the number of
+        recipients, not on the number of connections. Recipients connected to
+        other workers get it through the bus, in one bus message, in JSON.
+        :param message: Message
+        :param recipients: usernames or ["All users"]
+        :param sender: never gets its own message back
+        :return: recipients that are not online
+        """
+        start = time.perf_counter()
+        if "All users" in recipients:
+            self.deliver(message, recipients, sender)
+            if self.bus is not None:
+                self.bus.publish(message.encode(JSON), ["All users"])
+            ROUTE_SECONDS.observe(time.perf_counter() - start)
+            return []
+
+        undelivered = []
+        remote = []
+        delivered = 0
+        for username in dict.fromkeys(recipients):
+            user = self.get(username)
+            if user is None:
+                if username in self._remote:
+                    remote.append(username)
+                else:
+                    undelivered.append(username)
+            elif user is not sender:
+                user.send(message)
+                delivered += 1
+
+        if remote:
+            self.bus.publish(message.encode(JSON), remote)
+        DELIVERIES.inc(delivered)
+        ROUTE_SECONDS.observe(time.perf_counter() - start)
+        return undelivered
+
+    def deliver(self, message, recipients: list, sender=None) -> None:
+        """
+        Sends the message to the recipients connected to this process,
+        used for messages that come from the bus
+        :param message: Message
+        :param recipients: usernames or ["All users"]
+        :param sender:
+        :return: None
+        """
+        delivered = 0
+        if "All users" in recipients:
+            for user in self.logged_in_users():
+                if user is not sender:
+                    user.send(message)
+                    delivered += 1
+        else:
+            for username in recipients:
+                user = self.get(username)
+                if user is not None and user is not sender:
+                    user.send(message)
+                    delivered += 1
+        DELIVERIES.inc(delivered)
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def __contains__(self, user) -> bool:
+        return self._connections.get(user.socket) is user
@@ -0,0 +1,512 @@
+"""
+Replays a capture of real traffic (python3 server.py --capture FILE) against a
+chat server and reports throughput and latencies, to compare builds on the same
+traffic shape:
+
+    python3 replay.py traffic.cap --mode async --output before.json
+    (change the server)
+    python3 replay.py traffic.cap --mode async --compare before.json
+
+By default a server with in-memory storage is started in a child process, like
+benchmark.py does. Every connection sends its frames in the order and (scaled)
+at the times they were captured, --speed 2 replays twice as fast, --speed max as
+fast as the server takes them. Frames of all connections are sent by one
+scheduler in their captured order, so a replay is deterministic.
+
+Sessions are replayed as they were captured: the accounts that logged in are
+registered first with the password of --password, the redacted /login, /register
+and /resume of the capture are sent as /login or /register with that password
+and the wire formats the client asked for. Later frames are sent exactly as
+they were received, "/pong" is not replayed, the replaying client answers the
+pings of the server itself. Latencies are measured from a frame to its reply:
+login - "welcome to", chat message - "/sent", /load - "/history_end",
+/sync - "/sync_end", /search - "/search_end", /now_online - the snapshot.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import time
+
+from benchmark import serve_in_process, raise_fd_limit, summary
+from capture import read_capture, OPEN, FRAME, LOGIN, CLOSE
+from chat_util import Message
+from codec import JSON
+from framing import FrameDecoder, FrameError, encode_frame, READ_SIZE
+
+AUTH = "auth"
+REGISTER = "register"
+MESSAGE = "message"
+LOAD = "load"
+SYNC = "sync"
+SEARCH = "search"
+NOW_ONLINE = "now_online"
+# frames that are sent without waiting for a reply
+OTHER = "other"
+
+# Reply that ends the request of a kind, see ReplayClient.on_message
+REPLIES = {
+    MESSAGE: "/sent ",
+    LOAD: "/history_end",
+    SYNC: "/sync_end",
+    SEARCH: "/search_end",
+    NOW_ONLINE: "/now_online ",
+}
+
+
+def classify(payload: bytes, logged_in: bool) -> tuple:
+    """
+    Sorts a captured frame like the server dispatches it
+    :param payload: captured frame payload
+    :param logged_in: the connection has logged in before this frame
+    :return: (kind, Message or None if it can not be decoded)
+    """
+    try:
+        message = Message.decode(payload)
+    except (FrameError, ValueError):
+        return OTHER, None
+    text = message.text
+    if not logged_in:
+        if text.startswith("/resume ") or "/login" in text:
+            return AUTH, message
+        if "/register" in text:
+            return REGISTER, message
+        return OTHER, message
+    if text.startswith("/pong"):
+        return None, message
+    if text.startswith("/search"):
+        return SEARCH, message
+    if "/load" in text:
+        return LOAD, message
+    if text.startswith("/sync"):
+        return SYNC, message
+    if text.startswith("/now_online"):
+        return NOW_ONLINE, message
+    if not message.recipients:
+        # saved without a message_id, the server does not answer it
+        return OTHER, message
+    return MESSAGE, message
+
+
+class Session:
+    """
+    One captured connection
+    """
+
+    def __init__(self, connection: int):
+        self.connection = connection
+        # recorded when the captured session logged in, None if it did not
+        self.username = None
+
+
+def load_sessions(path: str, password: str) -> tuple:
+    """
+    Reads a capture and rewrites the logins with password
+    :param path: capture file
+    :param password: password of all the replayed accounts
+    :return: (schedule, usernames), schedule is a list of (time in microseconds,
+    session, kind, payload) in the captured order, usernames are the accounts
+    to register before the replay (those that logged in without /register)
+    """
+    records = list(read_capture(path))
+    sessions = {}
+    for _, connection, kind, body in records:
+        if kind == LOGIN:
+            sessions.setdefault(connection, Session(connection)).username = body.decode(
+                "utf-8"
+            )
+
+    schedule = []
+    registered = set()
+    usernames = {}
+    logged_in = set()
+    for timestamp, connection, kind, body in records:
+        session = sessions.setdefault(connection, Session(connection))
+        if kind in (OPEN, CLOSE):
+            schedule.append((timestamp, session, kind, b""))
+        elif kind == LOGIN:
+            logged_in.add(connection)
+        elif kind == FRAME:
+            frame_kind, message = classify(body, connection in logged_in)
+            if frame_kind in (AUTH, REGISTER):
+                name = login_name(message, session)
+                if name is not None:
+                    # a login that failed in the capture is replayed as it was
+                    if frame_kind == REGISTER:
+                        registered.add(name)
+                    elif session.username is not None and name not in registered:
+                        usernames.setdefault(name, None)
+                    command = "/register" if frame_kind == REGISTER else "/login"
+                    body = Message(
+                        f"{command} {name}:{password}", name, [], codecs=message.codecs
+                    ).payload(JSON)
+                frame_kind = AUTH
+            if frame_kind is not None:
+                schedule.append((timestamp, session, frame_kind, body))
+    return schedule, list(usernames)
+
+
+def login_name(message: Message, session: Session):
+    """
+    :param message: captured /login, /register or /resume
+    :param session:
+    :return: username of the login, None for a /resume that failed
+    """
+    if message.text.startswith("/resume "):
+        return session.username
+    try:
+        return message.text.split(" ")[1].split(":")[0]
+    except IndexError:
+        return None
+
+
+class ReplayClient:
+    """
+    Connection of one captured session
+    """
+
+    def __init__(self, replay, session: Session):
+        self.replay = replay
+        self.session = session
+        self.codec = JSON
+        self.reader = None
+        self.writer = None
+        self.authenticated = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.failed = False
+        self.error = None
+        # kind: send times of the requests waiting for their reply
+        self.pending = collections.defaultdict(collections.deque)
+        self.last_kind = None
+
+    async def connect(self, host: str, port: int) -> None:
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        asyncio.get_running_loop().create_task(self.read_loop())
+
+    def send(self, kind: str, payload: bytes) -> None:
+        if self.failed or self.writer is None:
+            return
+        now = time.perf_counter()
+        if kind == AUTH or kind in REPLIES:
+            self.pending[kind].append(now)
+        self.last_kind = kind
+        self.writer.write(encode_frame(payload))
+        self.replay.frames += 1
+
+    async def read_loop(self) -> None:
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    for decoded_data in Message.decode_all(payload):
+                        self.on_message(decoded_data)
+        except (ConnectionError, OSError, FrameError):
+            pass
+        finally:
+            self.closed.set()
+            if not self.authenticated.is_set():
+                self.fail("connection closed")
+
+    def fail(self, error: str) -> None:
+        self.error = error
+        self.failed = True
+        self.pending.clear()
+        self.authenticated.set()
+
+    def answered(self, kind: str) -> None:
+        if self.pending[kind]:
+            self.replay.latencies[kind].append(
+                time.perf_counter() - self.pending[kind].popleft()
+            )
+
+    def on_message(self, decoded_data) -> None:
+        data_text = decoded_data.text
+        if data_text.startswith("/codec "):
+            self.codec = data_text.split(" ")[1]
+        elif data_text.startswith("/server_name "):
+            self.replay.server_name = data_text.split(" ", 1)[1]
+        elif data_text == "/ping":
+            self.writer.write(Message("/pong", self.session.username, []).encode(self.codec))
+        elif data_text.startswith("welcome to"):
+            self.answered(AUTH)
+            self.authenticated.set()
+        elif data_text.startswith("/error rate limited"):
+            # the throttled request gets no reply
+            self.replay.throttled += 1
+            if self.pending[self.last_kind]:
+                self.pending[self.last_kind].pop()
+        elif data_text.startswith("/error") and not self.authenticated.is_set():
+            self.fail(data_text)
+        elif not self.authenticated.is_set():
+            # the roster sent before the welcome is not a reply to /now_online
+            pass
+        elif data_text.startswith("/"):
+            for kind, reply in REPLIES.items():
+                if data_text.startswith(reply):
+                    self.answered(kind)
+                    break
+        elif self.pending[LOAD] or self.pending[SYNC] or self.pending[SEARCH]:
+            # a record of the history page or the search results asked for
+            self.replay.history_records += 1
+        elif decoded_data.author != self.replay.server_name:
+            self.replay.deliveries += 1
+
+    def finish(self) -> None:
+        """
+        The captured client closed the connection, the replies to its last
+        requests can still be read
+        :return: None
+        """
+        if self.writer is not None and self.writer.can_write_eof():
+            self.writer.write_eof()
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Replay:
+    """
+    Replays a capture against one server
+    """
+
+    def __init__(self, args, schedule: list, usernames: list):
+        self.args = args
+        self.schedule = schedule
+        self.usernames = usernames
+        self.server_name = None
+        self.latencies = collections.defaultdict(list)
+        self.frames = 0
+        self.deliveries = 0
+        self.history_records = 0
+        self.throttled = 0
+        self.lag = 0.0
+        self.failed = []
+        self.unanswered = 0
+
+    async def register(self) -> int:
+        """
+        Creates the accounts of the sessions that logged in without /register,
+        an account left by an earlier replay is fine
+        :return: accounts created
+        """
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def create(username):
+            async with semaphore:
+                reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+                message = Message(f"/register {username}:{self.args.password}", username, [])
+                writer.write(message.encode(JSON))
+                decoder = FrameDecoder()
+                try:
+                    while True:
+                        data = await reader.read(READ_SIZE)
+                        if not data:
+                            return False
+                        for payload in decoder.feed(data):
+                            text = Message.decode(payload).text
+                            if text.startswith("/server_name "):
+                                self.server_name = text.split(" ", 1)[1]
+                            if text.startswith("welcome to"):
+                                return True
+                            if text.startswith("/error"):
+                                return False
+                finally:
+                    writer.close()
+
+        created = await asyncio.gather(*(create(name) for name in self.usernames))
+        return sum(created)
+
+    async def replay(self) -> float:
+        """
+        Sends the captured frames on schedule
+        :return: seconds the replay took
+        """
+        clients = {}
+        speed = self.args.speed
+        first = self.schedule[0][0] if self.schedule else 0
+        start = time.perf_counter()
+        for timestamp, session, kind, payload in self.schedule:
+            if speed:
+                due = (timestamp - first) / 1e6 / speed
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.lag = max(self.lag, -delay)
+
+            client = clients.get(session.connection)
+            if kind == OPEN:
+                client = clients[session.connection] = ReplayClient(self, session)
+                try:
+                    await client.connect(self.args.host, self.args.port)
+                except OSError as e:
+                    client.fail(str(e))
+            elif client is None or client.failed:
+                continue
+            elif kind == CLOSE:
+                client.finish()
+                # the captured session was gone before the frames that follow,
+                # e.g. the /resume of the same user
+                try:
+                    await asyncio.wait_for(client.closed.wait(), self.args.timeout)
+                except asyncio.TimeoutError:
+                    client.close()
+            elif kind == AUTH:
+                client.send(kind, payload)
+                # the session goes on once it is logged in, like the captured one did
+                try:
+                    await asyncio.wait_for(client.authenticated.wait(), self.args.timeout)
+                except asyncio.TimeoutError:
+                    client.fail("login timed out")
+            else:
+                client.send(kind, payload)
+                if not speed and self.frames % 100 == 0:
+                    # let the readers run
+                    await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+
+        # replies still on their way
+        deadline = time.perf_counter() + self.args.drain
+        while time.perf_counter() < deadline and any(
+            queue for client in clients.values() for queue in client.pending.values()
+        ):
+            await asyncio.sleep(0.05)
+
+        self.failed = [client.error for client in clients.values() if client.failed]
+        self.unanswered = sum(
+            len(queue) for client in clients.values() for queue in client.pending.values()
+        )
+        for client in clients.values():
+            client.close()
+        return elapsed
+
+    async def run(self) -> dict:
+        registered = await self.register()
+        elapsed = await self.replay()
+        captured = (
+            (self.schedule[-1][0] - self.schedule[0][0]) / 1e6 if self.schedule else 0.0
+        )
+        return {
+            "capture": self.args.capture,
+            "mode": self.args.mode if not self.args.target else "external",
+            "speed": self.args.speed or "max",
+            "sessions": len({entry[1].connection for entry in self.schedule}),
+            "accounts_registered": registered,
+            "captured_s": round(captured, 3),
+            "elapsed_s": round(elapsed, 3),
+            "lag_max_ms": round(self.lag * 1000, 3),
+            "frames": self.frames,
+            "frames_per_s": round(self.frames / elapsed, 1) if elapsed else 0.0,
+            "deliveries": self.deliveries,
+            "deliveries_per_s": round(self.deliveries / elapsed, 1) if elapsed else 0.0,
+            "history_records": self.history_records,
+            "throttled": self.throttled,
+            "unanswered": self.unanswered,
+            "failed_sessions": len(self.failed),
+            "errors": sorted(set(self.failed))[:10],
+            "latency": {kind: summary(values) for kind, values in self.latencies.items()},
+        }
+
+
+def compare(baseline: dict, results: dict) -> dict:
+    """
+    :param baseline: results of an earlier replay of the same capture
+    :param results:
+    :return: {metric: {"baseline", "current", "change_pct"}} of the throughput and
+    the p50 and p99 latencies present in both
+    """
+    metrics = {}
+    for key in ("elapsed_s", "frames_per_s", "deliveries_per_s", "throttled", "unanswered"):
+        metrics[key] = (baseline.get(key), results.get(key))
+    for kind, current in results.get("latency", {}).items():
+        for key in ("p50_ms", "p99_ms"):
+            before = baseline.get("latency", {}).get(kind, {}).get(key)
+            metrics[f"latency.{kind}.{key}"] = (before, current.get(key))
+
+    differences = {}
+    for key, (before, current) in metrics.items():
+        if not isinstance(before, (int, float)) or not isinstance(current, (int, float)):
+            continue
+        change = round((current - before) / before * 100, 1) if before else None
+        differences[key] = {"baseline": before, "current": current, "change_pct": change}
+    return differences
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay of captured chat traffic")
+    parser.add_argument("capture", help="file written by server.py --capture")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="async")
+    parser.add_argument(
+        "--target",
+        help="host:port of a running server, by default a server with "
+        "in-memory storage is started in a child process",
+    )
+    parser.add_argument("--port", type=int, default=8766, help="port of the child server")
+    parser.add_argument(
+        "--storage",
+        choices=["memory", "sqlite", "postgres"],
+        default="memory",
+        help="storage backend of the child server",
+    )
+    parser.add_argument(
+        "--speed",
+        default="1",
+        help="1 - captured pace, 2 - twice as fast, max - as fast as possible",
+    )
+    parser.add_argument(
+        "--password", default="replay", help="password of the replayed accounts"
+    )
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel registrations")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for a login")
+    parser.add_argument(
+        "--drain", type=float, default=10, help="seconds to wait for the last replies"
+    )
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--compare", metavar="FILE", help="results of a baseline replay")
+    args = parser.parse_args()
+    args.speed = 0.0 if args.speed == "max" else float(args.speed)
+    if args.speed < 0:
+        parser.error("--speed must be positive or max")
+
+    raise_fd_limit()
+    schedule, usernames = load_sessions(args.capture, args.password)
+
+    server = None
+    if args.target:
+        args.host, port = args.target.rsplit(":", 1)
+        args.port = int(port)
+    else:
+        args.host = "127.0.0.1"
+        sessions = len({entry[1].connection for entry in schedule})
+        server = multiprocessing.Process(
+            target=serve_in_process,
+            args=(args.mode, args.host, args.port, sessions + 1, args.storage, 1),
+        )
+        server.start()
+        time.sleep(1)
+
+    try:
+        results = asyncio.run(Replay(args, schedule, usernames).run())
+    finally:
+        if server is not None:
+            server.kill()
+
+    if args.compare:
+        with open(args.compare) as file:
+            results["compare"] = compare(json.load(file), results)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
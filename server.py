@@ -1,39 +1,117 @@
+import argparse
+import logging
+import selectors
 import socket
 import threading
-import json
-
-from chat_util import make_message, User, DataBase
+import time
+from contextlib import closing
+
+from chat_util import User, DataBase
+from handlers import Handlers, LoadReply, SyncReply, SearchReply
+from framing import FrameDecoder, READ_SIZE
+from codec import JSON
+from outbox import ThreadedOutbox
+from admission import ThreadedAdmission
+from registry import UserRegistry
+from ratelimit import is_expensive
+from presence import Presence, thread_timer
+from heartbeat import Heartbeat
+from capture import start_capture
+from logs import setup_logging
+from metrics import FRAME_SECONDS, register_server, serve_metrics
+from federation import Federation
+from storage import get_backend
 from config_server import (
-    SERVER_NAME,
     MAX_CONNECTIONS,
     HOST,
     PORT,
+    SERVER_MODE,
+    SERVER_WORKERS,
+    FEDERATION_ADDRESS,
+    FEDERATION_PEERS,
+    DB_WRITE_DURABILITY,
+    LISTEN_BACKLOG,
+    METRICS_HOST,
+    METRICS_PORT,
+    CAPTURE_PATH,
 )
 
+log = logging.getLogger("chat.server")
+
 
 def accept_client():
     """
-    Handles new connections
-    :return: None
+    Handles new connections. The server socket is non-blocking, every wakeup accepts
+    all the pending connections of the backlog. Each one is admitted, queued or shed
+    by the admission control without blocking, the work of a connection is done
+    in its own thread.
+    :return: None, when the server socket is closed
     """
+    selector = selectors.DefaultSelector()
+    selector.register(ser_sock, selectors.EVENT_READ)
     while True:
-        cli_sock, cli_add = ser_sock.accept()
-        db = DataBase()
-        user = User(cli_sock, db, address=cli_add)
+        try:
+            selector.select()
+        except (OSError, ValueError):
+            return
+
+        while True:
+            try:
+                cli_sock, cli_add = ser_sock.accept()
+            except BlockingIOError:
+                break
+            except OSError:
+                return
+
+            cli_sock.setblocking(True)
+            admitted = HANDLERS.admission.arrive()
+            if admitted is None:
+                shed(cli_sock)
+            else:
+                thread_client = threading.Thread(
+                    target=serve_client, args=[cli_sock, cli_add, admitted]
+                )
+                thread_client.start()
+
+
+def serve_client(cli_sock, cli_add, admitted) -> None:
+    """
+    Thread of one connection, a queued connection waits for a free slot first
+    :param cli_sock:
+    :param cli_add:
+    :param admitted: True, or the waiter returned by admission.arrive()
+    :return: None
+    """
+    if admitted is not True and not HANDLERS.admission.wait(admitted):
+        shed(cli_sock)
+        return
 
-        logged_users_count = 0
-        for l_user in USER_LIST:
-            if l_user.logged_in:
-                logged_users_count += 1
+    user = User(cli_sock, HANDLERS.db, address=cli_add)
+    user.outbox = ThreadedOutbox(cli_sock)
+    HANDLERS.connected(user)
+    try:
+        broadcast_user(user)
+    finally:
+        HANDLERS.closed(user)
 
-        if logged_users_count < MAX_CONNECTIONS:
-            USER_LIST.append(user)
-            print(f" new connection from {user.address}")
-            thread_client = threading.Thread(target=broadcast_user, args=[user])
-            thread_client.start()
-        else:
-            message = make_message("/error server is busy", SERVER_NAME, [user.address])
-            cli_sock.send(message.encode("utf-8"))
+
+def shed(cli_sock) -> None:
+    """
+    Turns the connection away with "/error server is busy <seconds to wait>",
+    the socket is non-blocking, so a client that does not read never blocks the server
+    :param cli_sock:
+    :return: None
+    """
+    message = HANDLERS.busy_message()
+    try:
+        cli_sock.setblocking(False)
+        cli_sock.send(message.encode(JSON))
+        cli_sock.shutdown(socket.SHUT_WR)
+        # unread data at close would reset the connection before the client reads
+        cli_sock.recv(READ_SIZE)
+    except OSError:
+        pass
+    cli_sock.close()
 
 
 def broadcast_user(user):
@@ -42,57 +120,87 @@ def broadcast_user(user):
     :param user:
     :return: None
     """
+    decoder = FrameDecoder()
     while True:
         try:
-            data = user.socket.recv(2048)
-            if data:
-                print(data.decode("utf-8"))
-                decoded_data = json.loads(data.decode("utf-8"))
+            data = user.socket.recv(READ_SIZE)
+            if not data:
+                raise ConnectionResetError(f"{user.address} closed the connection")
+            HANDLERS.received(user, data)
 
-                data_text = decoded_data.get("text")
+            for payload in decoder.feed(data):
+                start = time.perf_counter()
+                decoded_data = HANDLERS.decode(user, payload)
+                data_text = decoded_data.text
 
                 if not user.logged_in:
 
-                    if "/login" in data_text:
+                    if data_text.startswith("/resume "):
+                        HANDLERS.negotiate_codec(decoded_data, user)
+                        if not resume_chat(data_text, user):
+                            raise Exception("Invalid session")
+
+                    elif "/login" in data_text:
+                        HANDLERS.negotiate_codec(decoded_data, user)
                         if not login_chat(data_text, user):
                             raise Exception("Invalid login")
 
                     elif "/register" in data_text:
+                        HANDLERS.negotiate_codec(decoded_data, user)
                         if not register_chat(data_text, user):
                             raise Exception("Invalid registration")
 
                     else:
-                        message = make_message(
-                            f"/error you are not logged in", SERVER_NAME, [user.address]
-                        )
-                        user.socket.send(message.encode("utf-8"))
-                        USER_LIST.remove(user)
-                        break
+                        HANDLERS.not_logged_in(user)
+                        user.outbox.close()
+                        return
+
+                    if HANDLERS.capture is not None:
+                        HANDLERS.capture.login(user)
+
+                elif not user.limiter.allow(len(payload), is_expensive(data_text)):
+                    HANDLERS.throttle(user, len(payload), is_expensive(data_text))
+
+                elif data_text == "/pong":
+                    # the answer to /ping, receiving it was enough
+                    pass
+
+                elif data_text.startswith("/search"):
+                    send_history(SearchReply(user, data_text))
 
                 elif "/load" in data_text:
-                    load_message_chat(decoded_data, user)
+                    send_history(LoadReply(user, data_text))
 
-                else:
-                    broadcast_to_users(user, data)
+                elif data_text.startswith("/sync"):
+                    send_history(SyncReply(user, data_text))
 
-                    author = decoded_data.get("author")
-                    recipient = decoded_data.get("recipient")
-                    text = decoded_data.get("text")
-                    datetime = decoded_data.get("datetime")
+                elif data_text.startswith("/now_online"):
+                    HANDLERS.presence.snapshot(user)
 
-                    user.db.new_message(author, recipient, text, datetime)
+                else:
+                    chat_message(user, data_text, decoded_data.recipients)
+
+                FRAME_SECONDS.observe(time.perf_counter() - start)
 
         except Exception as x:
-            print(x)
-            USER_LIST.remove(user)
-            message = make_message(
-                f"{user.username} disconnected", SERVER_NAME, ["All users"]
-            )
-            broadcast_to_users(user, message.encode("utf-8"))
-            online_to_all_users()
+            HANDLERS.disconnect(user, x)
+            user.outbox.close()
             break
 
 
+def reap(user) -> None:
+    """
+    Closes a dead or idle connection found by the heartbeat, the thread of the
+    connection gets the end of the stream and disconnects the user as usual
+    :param user:
+    :return: None
+    """
+    try:
+        user.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
 def login_chat(data_text: str, user) -> bool:
     """
     Checking the correctness of information for authorization
@@ -100,37 +208,10 @@ def login_chat(data_text: str, user) -> bool:
     :param user:
     :return: True if the data is correct, False if not
     """
-    user.username = data_text.split(" ")[1].split(":")[0]
-    user.password = data_text.split(" ")[1].split(":")[1]
-
-    for logged_users in USER_LIST:
-        if user.username == logged_users.username and logged_users.logged_in:
-            print(f"/error user {user.username} already logged")
-            message = make_message(
-                f"/error user {user.username} already logged",
-                SERVER_NAME,
-                [user.username],
-            )
-            user.socket.send(message.encode("utf-8"))
-            return False
-
-    if user.login():
-        message = make_message(
-            f"{user.username} was connected to chat", SERVER_NAME, [user.username]
-        )
-        broadcast_to_users(user, message.encode("utf-8"))
-
-        welcome_message(user)
-
-        return True
-
-    else:
-        message = make_message(
-            f"/error invalid login {user.username}", SERVER_NAME, [user.username]
-        )
-        user.socket.send(message.encode("utf-8"))
-        print(f"Invalid login {user.username}:{user.password}")
-        return False
+    HANDLERS.read_credentials(data_text, user)
+    if not HANDLERS.users.claim(user):
+        return HANDLERS.already_logged(user)
+    return HANDLERS.login_checked(user, user.login())
 
 
 def register_chat(data_text: str, user) -> bool:
@@ -140,110 +221,198 @@ def register_chat(data_text: str, user) -> bool:
     :param user:
     :return: True if the data is correct, False if not
     """
-    user.username = data_text.split(" ")[1].split(":")[0]
-    user.password = data_text.split(" ")[1].split(":")[1]
-
-    if user.register():
-        print(f"New user {user.username} was registered")
-
-        message = make_message(
-            f"New user {user.username} was registered", SERVER_NAME, [user.username]
-        )
-        broadcast_to_users(user, message.encode("utf-8"))
-
-        welcome_message(user)
-
-        return True
-    else:
-        message = make_message(
-            f"/error user {user.username} already exist", SERVER_NAME, [user.username]
-        )
-        user.socket.send(message.encode("utf-8"))
-        return False
+    HANDLERS.read_credentials(data_text, user)
+    created = HANDLERS.users.claim(user) and user.register()
+    return HANDLERS.register_checked(user, created)
 
 
-def welcome_message(user) -> None:
+def resume_chat(data_text: str, user) -> bool:
     """
-    Sends the user: server name, who is online now and a welcome message
+    Restores a session from "/resume <token> <presence_version>"
+    :param data_text:
     :param user:
-    :return: None
+    :return: True if the token is valid and the user is not logged in elsewhere
     """
-    message = make_message(f"/server_name {SERVER_NAME}", SERVER_NAME, [user.username])
-    user.socket.send(message.encode("utf-8"))
-
-    online_to_all_users(split_char=True)
-
-    message = make_message(f"welcome to {SERVER_NAME}", SERVER_NAME, [user.username])
-    user.socket.send(message.encode("utf-8"))
+    if not HANDLERS.check_session(data_text, user):
+        return False
+    if not HANDLERS.users.claim(user):
+        return HANDLERS.already_logged(user)
+    HANDLERS.resume(data_text, user)
+    return True
 
 
-def load_message_chat(decoded_data: str, user) -> None:
+def send_history(reply) -> None:
     """
-    Loads records of user messages
-    :param decoded_data:
-    :param user:
+    Sends the reply to /load, /sync or /search, the rows are fetched on the
+    thread of the connection
+    :param reply: HistoryReply
     :return: None
     """
-    splitted_data = decoded_data.get("text").split(" ")
-    if len(splitted_data) >= 2:
-        limit = splitted_data[1]
-    else:
-        limit = 10
-    for message in user.db.load_message(user.username, limit):
-        new_message = make_message(
-            message[0],
-            message[1],
-            [SERVER_NAME],
-            m_datetime=message[2].strftime("%Y-%m-%d %H:%M:%S"),
-        )
-        user.socket.send((new_message + "__+\|SPLIT|/+__").encode("utf-8"))
-        print(new_message)
+    with closing(reply.query()) as chunks:
+        for records in chunks:
+            reply.send(records)
+    reply.end()
 
 
-def broadcast_to_users(b_user, msg: str) -> None:
+def chat_message(user, text: str, recipients: list) -> None:
     """
-    Sends to all users (except the transmitted) message
-    :param b_user:
-    :param msg:
+    Saves and delivers the message, see Handlers.submit_message. A message to users
+    without an account is dropped with "/error unknown recipients <names>".
+    :param user: author
+    :param text:
+    :param recipients:
     :return: None
     """
-    for user in USER_LIST:
-        if user.socket != b_user.socket and user.logged_in:
-            user.socket.send(msg)
-
-
-def online_to_all_users(split_char=False) -> None:
+    unknown = user.db.unknown_recipients(recipients)
+    if unknown:
+        HANDLERS.reject_recipients(user, unknown)
+        return
+
+    future = HANDLERS.submit_message(user, text, recipients)
+    if future is not None and DB_WRITE_DURABILITY == "flush":
+        # waits without raising, a failed save is answered by deliver_message
+        future.exception()
+
+
+def run(
+    host: str,
+    port: int,
+    db=None,
+    bus=None,
+    reuse_port=False,
+    metrics_port=METRICS_PORT,
+    capture_path=CAPTURE_PATH,
+) -> None:
     """
-    Sends a message to all users about which users are currently in the chat
-    If split_char = True there will be a separating character at the end of the message
-    :param split_char:
+    Runs the threaded chat server, connections are accepted in a separate thread,
+    returns when the server socket is closed
+    :param host:
+    :param port:
+    :param db: storage used for accounts and messages, default is DataBase()
+    :param bus: link to users connected elsewhere, BusClient of a worker process
+    or Federation of a node, None for a standalone server
+    :param reuse_port: share the port with other worker processes (SO_REUSEPORT)
+    :param metrics_port: admin port of the Prometheus metrics, 0 - off
+    :param capture_path: file the received frames are recorded to, "" - off
     :return: None
     """
-    online_users = []
-    for l_user in USER_LIST:
-        if l_user.logged_in:
-            online_users.append(l_user.username)
-
-    for user in USER_LIST:
-        if user.logged_in:
-            msg = make_message(
-                f"/now_online " + " ".join(online_users), SERVER_NAME, ["All users"]
-            )
-            if split_char:
-                user.socket.send((msg + "__+\|SPLIT|/+__").encode("utf-8"))
-            else:
-                user.socket.send(msg.encode("utf-8"))
-
-
-if __name__ == "__main__":
-    USER_LIST = []
+    global HANDLERS, ser_sock
+
+    setup_logging()
+    users = UserRegistry(bus)
+    HANDLERS = Handlers(
+        users,
+        Presence(users, thread_timer),
+        db or DataBase(),
+        ThreadedAdmission(MAX_CONNECTIONS),
+        Heartbeat(None, reap),
+        start_capture(capture_path),
+        # the messages are delivered on the writer thread
+        call_soon=lambda callback, *args: callback(*args),
+    )
+    if bus is not None:
+        bus.connect(HANDLERS.bus_event)
+    register_server(users, HANDLERS.admission, HANDLERS.heartbeat, HANDLERS.db)
+    serve_metrics(METRICS_HOST, metrics_port)
 
     ser_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    ser_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        ser_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-    ser_sock.bind((HOST, PORT))
+    ser_sock.bind((host, port))
 
-    ser_sock.listen(1)
-    print(f"Chat server started on {HOST}:{PORT}")
+    ser_sock.listen(LISTEN_BACKLOG)
+    ser_sock.setblocking(False)
+    log.info("Chat server started on %s:%s", host, port)
 
     thread_ac = threading.Thread(target=accept_client)
     thread_ac.start()
+    # executors (the password hasher) take no work once the main thread has exited
+    thread_ac.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simple chat server")
+    parser.add_argument(
+        "--mode",
+        choices=["threaded", "async"],
+        default=SERVER_MODE,
+        help="threaded: one thread per connection, async: single asyncio event loop",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=SERVER_WORKERS,
+        help="worker processes sharing the port, started and restarted by a supervisor",
+    )
+    parser.add_argument(
+        "--federation",
+        default=FEDERATION_ADDRESS,
+        metavar="HOST:PORT",
+        help="address this node listens on for the other nodes of a federation",
+    )
+    parser.add_argument(
+        "--peer",
+        action="append",
+        default=list(FEDERATION_PEERS),
+        metavar="HOST:PORT",
+        help="federation address of another node, can be repeated",
+    )
+    parser.add_argument("--port", type=int, default=PORT, help="port for clients")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="admin port of the Prometheus metrics (0 - off), workers use the next ports",
+    )
+    parser.add_argument(
+        "--capture",
+        default=CAPTURE_PATH,
+        metavar="FILE",
+        help="record the received frames to FILE for replay.py",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="only bring the database schema up to date and exit",
+    )
+    args = parser.parse_args()
+
+    # once per start, before any worker serves a request
+    setup_logging()
+    get_backend().migrate()
+    if args.migrate:
+        raise SystemExit(0)
+
+    bus = None
+    if args.federation:
+        if args.workers > 1:
+            parser.error("a federation node runs as a single process")
+        bus = Federation(args.federation, args.peer)
+
+    if args.capture and args.workers > 1:
+        parser.error("a capture records a single process")
+
+    if args.workers > 1:
+        import supervisor
+
+        supervisor.run(args.mode, HOST, args.port, args.workers, args.metrics_port)
+    elif args.mode == "async":
+        import server_async
+
+        server_async.run(
+            HOST,
+            args.port,
+            bus=bus,
+            metrics_port=args.metrics_port,
+            capture_path=args.capture,
+        )
+    else:
+        run(
+            HOST,
+            args.port,
+            bus=bus,
+            metrics_port=args.metrics_port,
+            capture_path=args.capture,
+        )
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_util import User, DataBase
+from handlers import Handlers, LoadReply, SyncReply, SearchReply
+from framing import FrameDecoder, READ_SIZE
+from codec import JSON
+from outbox import AsyncOutbox
+from admission import AsyncAdmission
+from registry import UserRegistry
+from ratelimit import is_expensive
+from presence import Presence
+from heartbeat import Heartbeat
+from capture import start_capture
+from logs import setup_logging
+from metrics import FRAME_SECONDS, register_server, serve_metrics
+from config_server import (
+    MAX_CONNECTIONS,
+    ASYNC_DB_WORKERS,
+    DB_WRITE_DURABILITY,
+    LISTEN_BACKLOG,
+    METRICS_HOST,
+    METRICS_PORT,
+    CAPTURE_PATH,
+)
+
+log = logging.getLogger("chat.server")
+
+HANDLERS = None
+
+
+async def accept_client(reader, writer):
+    """
+    Handles new connections, called by the event loop for every accepted socket.
+    The admission control decides if the connection is served, waits for a free
+    slot or is shed.
+    :param reader: asyncio.StreamReader of the connection
+    :param writer: asyncio.StreamWriter of the connection
+    :return: None
+    """
+    admission = HANDLERS.admission
+    admitted = admission.arrive()
+    if admitted is not True:
+        # shed at once, or queued until a connection closes
+        if admitted is None or not await admission.wait(admitted):
+            writer.write(HANDLERS.busy_message().encode(JSON))
+            writer.close()
+            return
+
+    user = User(writer, HANDLERS.db, address=writer.get_extra_info("peername"))
+    user.outbox = AsyncOutbox(writer)
+    HANDLERS.connected(user)
+    try:
+        await broadcast_user(reader, user)
+        user.outbox.close()
+        await user.outbox.wait_closed()
+    finally:
+        HANDLERS.closed(user)
+
+
+async def broadcast_user(reader, user):
+    """
+    Handles the message and connection with the user
+    :param reader:
+    :param user:
+    :return: None
+    """
+    decoder = FrameDecoder()
+    while True:
+        try:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionResetError(f"{user.address} closed the connection")
+            HANDLERS.received(user, data)
+
+            for payload in decoder.feed(data):
+                start = time.perf_counter()
+                decoded_data = HANDLERS.decode(user, payload)
+                data_text = decoded_data.text
+
+                if not user.logged_in:
+
+                    if data_text.startswith("/resume "):
+                        HANDLERS.negotiate_codec(decoded_data, user)
+                        if not await resume_chat(data_text, user):
+                            raise Exception("Invalid session")
+
+                    elif "/login" in data_text:
+                        HANDLERS.negotiate_codec(decoded_data, user)
+                        if not await login_chat(data_text, user):
+                            raise Exception("Invalid login")
+
+                    elif "/register" in data_text:
+                        HANDLERS.negotiate_codec(decoded_data, user)
+                        if not await register_chat(data_text, user):
+                            raise Exception("Invalid registration")
+
+                    else:
+                        HANDLERS.not_logged_in(user)
+                        return
+
+                    if HANDLERS.capture is not None:
+                        HANDLERS.capture.login(user)
+
+                elif not user.limiter.allow(len(payload), is_expensive(data_text)):
+                    HANDLERS.throttle(user, len(payload), is_expensive(data_text))
+
+                elif data_text == "/pong":
+                    # the answer to /ping, receiving it was enough
+                    pass
+
+                elif data_text.startswith("/search"):
+                    await send_history(SearchReply(user, data_text))
+
+                elif "/load" in data_text:
+                    await send_history(LoadReply(user, data_text))
+
+                elif data_text.startswith("/sync"):
+                    await send_history(SyncReply(user, data_text))
+
+                elif data_text.startswith("/now_online"):
+                    HANDLERS.presence.snapshot(user)
+
+                else:
+                    await chat_message(user, data_text, decoded_data.recipients)
+
+                FRAME_SECONDS.observe(time.perf_counter() - start)
+
+        except Exception as x:
+            HANDLERS.disconnect(user, x)
+            break
+
+
+def reap(user) -> None:
+    """
+    Closes a dead or idle connection found by the heartbeat, its reader gets the end
+    of the stream and the user is disconnected as usual
+    :param user:
+    :return: None
+    """
+    user.socket.transport.abort()
+
+
+async def login_chat(data_text: str, user) -> bool:
+    """
+    Checking the correctness of information for authorization
+    :param data_text:
+    :param user:
+    :return: True if the data is correct, False if not
+    """
+    HANDLERS.read_credentials(data_text, user)
+    if not await claim(user):
+        return HANDLERS.already_logged(user)
+
+    # the password is checked on the hasher pool of the database, not on the executor
+    valid = await asyncio.wrap_future(user.db.submit_login(user.username, user.password))
+    return HANDLERS.login_checked(user, valid)
+
+
+async def register_chat(data_text: str, user) -> bool:
+    """
+    Creates a record with new user data, if they are not already there
+    :param data_text:
+    :param user:
+    :return: True if the data is correct, False if not
+    """
+    HANDLERS.read_credentials(data_text, user)
+    created = await claim(user) and await asyncio.wrap_future(
+        user.db.submit_register(user.username, user.password)
+    )
+    return HANDLERS.register_checked(user, created)
+
+
+async def claim(user) -> bool:
+    """
+    UserRegistry.claim, with a bus the hub is asked on the executor, so the loop
+    is not blocked
+    :param user:
+    :return: False if the username is already taken
+    """
+    users = HANDLERS.users
+    if users.bus is None:
+        return users.claim(user)
+    return await asyncio.get_running_loop().run_in_executor(None, users.claim, user)
+
+
+async def resume_chat(data_text: str, user) -> bool:
+    """
+    Restores a session from "/resume <token> <presence_version>"
+    :param data_text:
+    :param user:
+    :return: True if the token is valid and the user is not logged in elsewhere
+    """
+    if not HANDLERS.check_session(data_text, user):
+        return False
+    if not await claim(user):
+        return HANDLERS.already_logged(user)
+    HANDLERS.resume(data_text, user)
+    return True
+
+
+async def send_history(reply) -> None:
+    """
+    Sends the reply to /load, /sync or /search, chunks of rows are fetched on
+    the executor, so the loop is never blocked
+    :param reply: HistoryReply
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    chunks = reply.query()
+    try:
+        while True:
+            records = await loop.run_in_executor(None, next, chunks, None)
+            if records is None:
+                break
+            reply.send(records)
+    finally:
+        await loop.run_in_executor(None, chunks.close)
+    reply.end()
+
+
+async def chat_message(user, text: str, recipients: list) -> None:
+    """
+    Saves and delivers the message, see Handlers.submit_message. A message to users
+    without an account is dropped with "/error unknown recipients <names>".
+    :param user: author
+    :param text:
+    :param recipients:
+    :return: None
+    """
+    if not user.db.recipients_known(recipients):
+        loop = asyncio.get_running_loop()
+        unknown = await loop.run_in_executor(None, user.db.unknown_recipients, recipients)
+        if unknown:
+            HANDLERS.reject_recipients(user, unknown)
+            return
+
+    future = HANDLERS.submit_message(user, text, recipients)
+    if future is not None and DB_WRITE_DURABILITY == "flush":
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            # a failed save is answered by deliver_message
+            pass
+
+
+async def serve(
+    host: str,
+    port: int,
+    db=None,
+    bus=None,
+    reuse_port=False,
+    metrics_port=METRICS_PORT,
+    capture_path=CAPTURE_PATH,
+) -> None:
+    """
+    Starts listening on host:port and serves clients until cancelled
+    :param host:
+    :param port:
+    :param db: storage used for accounts and messages, default is DataBase()
+    :param bus: link to users connected elsewhere, BusClient of a worker process
+    or Federation of a node, None for a standalone server
+    :param reuse_port: share the port with other worker processes (SO_REUSEPORT)
+    :param metrics_port: admin port of the Prometheus metrics, 0 - off
+    :param capture_path: file the received frames are recorded to, "" - off
+    :return: None
+    """
+    global HANDLERS
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS))
+
+    users = UserRegistry(bus)
+    HANDLERS = Handlers(
+        users,
+        Presence(users, loop.call_later),
+        db or DataBase(),
+        AsyncAdmission(MAX_CONNECTIONS),
+        Heartbeat(loop.call_later, reap),
+        start_capture(capture_path),
+        # the messages are delivered on the loop, outboxes are only used there
+        call_soon=loop.call_soon_threadsafe,
+    )
+    if bus is not None:
+        # bus messages are read on its threads and handled on the loop
+        bus.connect(
+            lambda header, body: loop.call_soon_threadsafe(HANDLERS.bus_event, header, body)
+        )
+    # scrapes are served by a thread, the stats of the components are thread-safe
+    register_server(users, HANDLERS.admission, HANDLERS.heartbeat, HANDLERS.db)
+    serve_metrics(METRICS_HOST, metrics_port)
+
+    # the loop accepts up to LISTEN_BACKLOG pending connections per wakeup
+    server = await asyncio.start_server(
+        accept_client, host, port, backlog=LISTEN_BACKLOG, reuse_port=reuse_port
+    )
+    log.info("Chat server (async) started on %s:%s", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def run(
+    host: str,
+    port: int,
+    db=None,
+    bus=None,
+    reuse_port=False,
+    metrics_port=METRICS_PORT,
+    capture_path=CAPTURE_PATH,
+) -> None:
+    """
+    Runs the asyncio chat server in the current thread
+    :param host:
+    :param port:
+    :param db: storage used for accounts and messages, default is DataBase()
+    :param bus: BusClient of a worker process or Federation of a node
+    :param reuse_port: share the port with other worker processes (SO_REUSEPORT)
+    :param metrics_port: admin port of the Prometheus metrics, 0 - off
+    :param capture_path: file the received frames are recorded to, "" - off
+    :return: None
+    """
+    setup_logging()
+    asyncio.run(serve(host, port, db, bus, reuse_port, metrics_port, capture_path))
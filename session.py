@@ -0,0 +1,64 @@
+import hashlib
+import hmac
+import os
+import time
+
+from config_server import SESSION_SECRET, SESSION_TTL
+
+# Workers of one supervisor share a generated secret through the environment
+SECRET_ENV = "CHAT_SESSION_SECRET"
+
+
+def session_secret() -> bytes:
+    """
+    SESSION_SECRET of config_server.py, if it is empty a random secret is generated
+    once and put to the environment, so the processes started later accept the same
+    tokens (federation nodes need the same SESSION_SECRET)
+    :return: secret key of the session tokens
+    """
+    secret = SESSION_SECRET or os.environ.get(SECRET_ENV)
+    if not secret:
+        secret = os.environ[SECRET_ENV] = os.urandom(32).hex()
+    return secret.encode("utf-8")
+
+
+class SessionTokens:
+    """
+    Signed, expiring session tokens "<username>:<expires>:<signature>".
+    A token is checked with the secret alone, so "/resume <token>" restores
+    a session without a database query.
+    """
+
+    def __init__(self, secret=None, ttl=SESSION_TTL):
+        """
+        :param secret: bytes, default is session_secret()
+        :param ttl: seconds a token is valid
+        """
+        self.secret = secret or session_secret()
+        self.ttl = ttl
+
+    def issue(self, username: str) -> str:
+        """
+        :param username: a logged in user
+        :return: token
+        """
+        body = f"{username}:{int(time.time()) + self.ttl}"
+        return f"{body}:{self._sign(body)}"
+
+    def verify(self, token: str):
+        """
+        :param token:
+        :return: username, None if the token is forged, malformed or expired
+        """
+        try:
+            username, expires, signature = token.rsplit(":", 2)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(signature, self._sign(f"{username}:{expires}")):
+            return None
+        if not expires.isdigit() or int(expires) < time.time():
+            return None
+        return username
+
+    def _sign(self, body: str) -> str:
+        return hmac.new(self.secret, body.encode("utf-8"), hashlib.sha256).hexdigest()
@@ -0,0 +1,1169 @@
+import bisect
+import collections
+import datetime
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:  # only the postgres backend needs it
+    psycopg2 = None
+
+from config_server import (
+    STORAGE_BACKEND,
+    SQLITE_PATH,
+    DATABASE,
+    DB_USER,
+    DB_PASSWORD,
+    DB_HOST,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_CHECK_IDLE,
+    HISTORY_PAGE_SIZE,
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_CHUNK_SIZE,
+    SEARCH_PAGE_SIZE,
+    SEARCH_MAX_RESULTS,
+    SERVER_NAME,
+    SERVER_ACCOUNT_PASSWORD,
+)
+from credentials import hash_password
+
+log = logging.getLogger("chat.db")
+
+WORD = re.compile(r"\w+")
+# Owner word of the broadcasts in the full-text index of SQLite, see owner_token
+BROADCAST_TOKEN = "all"
+# Longest text of a message, the text column of PostgreSQL is VARCHAR ( 2048 )
+MAX_TEXT_LENGTH = 2048
+# Words of a query beyond this are ignored, every word is one more index lookup
+MAX_SEARCH_TERMS = 16
+# Indexes of PostgreSQL, built by PostgresBackend.migrate without blocking writes.
+# The "simple" configuration does not stem words, like the other backends, search
+# repeats the expression of messages_text_idx
+POSTGRES_INDEXES = (
+    ("messages_author_id_idx", "messages (author, message_id DESC)"),
+    ("accounts_messages_recipient_id_idx", "accounts_messages (recipient, message_id DESC)"),
+    ("messages_broadcast_id_idx", "messages (message_id DESC) WHERE broadcast"),
+    ("messages_text_idx", "messages USING GIN (to_tsvector('simple', text))"),
+)
+
+
+class StorageBackend:
+    """
+    Interface of the storages behind DataBase.
+    Messages are saved in batches by MessageWriter through save_messages().
+    """
+
+    # errors of save_messages caused by a row of the batch (e.g. a violated
+    # constraint), not by the database being unavailable
+    data_errors = (ValueError,)
+
+    def init(self) -> None:
+        """
+        Creates the tables (and indexes) and the account for messages from the server
+        :return: None
+        """
+        raise NotImplementedError
+
+    def migrate(self) -> None:
+        """
+        Brings the schema of an existing database up to date, run once at the start
+        of the server (or "python3 server.py --migrate"), never on the request path.
+        Backends that do it when they are opened have nothing to do here
+        :return: None
+        """
+
+    def pool_stats(self) -> dict:
+        """
+        :return: usage of the connection pool, empty for backends without one
+        """
+        return {}
+
+    def register(self, username: str, password: str) -> bool:
+        """
+        :param username:
+        :param password: salted hash, see credentials.hash_password
+        :return: True if the account has been added, False if it already exists
+        """
+        raise NotImplementedError
+
+    def get_password(self, username: str):
+        """
+        :param username:
+        :return: stored password hash, None if there is no such account
+        """
+        raise NotImplementedError
+
+    def set_password(self, username: str, password: str) -> None:
+        """
+        Replaces the stored password, used to rehash old passwords
+        :param username:
+        :param password: salted hash
+        :return: None
+        """
+        raise NotImplementedError
+
+    def existing_users(self, usernames: list) -> set:
+        """
+        :param usernames:
+        :return: those of the usernames that have an account
+        """
+        raise NotImplementedError
+
+    def save_messages(self, messages: list) -> list:
+        """
+        Saves the messages in one transaction. A message to "All users" is saved
+        as a broadcast, without recipient rows, it is in the history of everyone.
+        All the authors and recipients must have an account.
+        :param messages: list of (author, recipients, text, m_datetime)
+        :return: message_id of every message, in the same order
+        """
+        raise NotImplementedError
+
+    def load_history(
+        self, username: str, limit=HISTORY_PAGE_SIZE, before=None, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        """
+        Loads a page of messages written by the user, received by the user
+        or broadcast, newest first, pages are addressed by message_id (keyset pagination)
+        :param username:
+        :param limit: page size, capped at HISTORY_MAX_PAGE_SIZE
+        :param before: message_id, only older messages are loaded. None - newest
+        :param chunk_size: rows yielded at once
+        :return: generator of lists of (message_id, text, author, datetime)
+        """
+        raise NotImplementedError
+
+    def load_since(
+        self, username: str, after: int, limit=HISTORY_MAX_PAGE_SIZE, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        """
+        Loads the messages of the user saved after message_id "after", oldest first
+        :param username:
+        :param after: message_id of the last message the user has seen
+        :param limit: page size, capped at HISTORY_MAX_PAGE_SIZE
+        :param chunk_size: rows yielded at once
+        :return: generator of lists of (message_id, text, author, datetime)
+        """
+        raise NotImplementedError
+
+    def search(
+        self,
+        username: str,
+        terms: list,
+        limit=SEARCH_PAGE_SIZE,
+        offset=0,
+        chunk_size=HISTORY_CHUNK_SIZE,
+    ):
+        """
+        Full-text search in the messages written by, received by the user or
+        broadcast, a message matches if it contains all the terms. Best matches first,
+        newest first among equal ones, pages are addressed by offset
+        :param username:
+        :param terms: lower case words, see search_terms
+        :param limit: page size
+        :param offset: matches skipped, pages end at SEARCH_MAX_RESULTS matches
+        :param chunk_size: rows yielded at once
+        :return: generator of lists of (message_id, text, author, datetime)
+        """
+        raise NotImplementedError
+
+
+def history_query(newer: bool, param) -> str:
+    """
+    UNION of three index range scans, messages written by the user, messages
+    the user received and broadcasts, limited on every side before they are joined
+    :param newer: True - messages after the cursor, oldest first,
+    False - messages before the cursor, newest first
+    :param param: formats the placeholder of a named parameter for the driver
+    :return: SQL with the parameters username, cursor and limit
+    """
+    compare, order = (">", "ASC") if newer else ("<", "DESC")
+    return (
+        "SELECT message_id, text, author, datetime FROM messages "
+        "WHERE message_id IN ("
+        "SELECT message_id FROM (SELECT message_id FROM messages "
+        f"WHERE author = {param('username')} AND message_id {compare} {param('cursor')} "
+        f"ORDER BY message_id {order} LIMIT {param('limit')}) AS authored "
+        "UNION "
+        "SELECT message_id FROM (SELECT message_id FROM accounts_messages "
+        f"WHERE recipient = {param('username')} AND message_id {compare} {param('cursor')} "
+        f"ORDER BY message_id {order} LIMIT {param('limit')}) AS received "
+        "UNION "
+        "SELECT message_id FROM (SELECT message_id FROM messages "
+        f"WHERE broadcast AND message_id {compare} {param('cursor')} "
+        f"ORDER BY message_id {order} LIMIT {param('limit')}) AS broadcasts) "
+        f"ORDER BY message_id {order} LIMIT {param('limit')};"
+    )
+
+
+def page_limit(limit) -> int:
+    return max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+
+
+def split_words(text: str) -> list:
+    return WORD.findall(text.lower())
+
+
+def search_terms(query: str) -> list:
+    """
+    :param query: text of a search
+    :return: its distinct words in lower case, at most MAX_SEARCH_TERMS
+    """
+    return list(dict.fromkeys(split_words(query)))[:MAX_SEARCH_TERMS]
+
+
+def owner_token(username: str) -> str:
+    """
+    :param username:
+    :return: a single word of the full-text index standing for the user,
+    "u" and the hex of the UTF-8 username, like 'u' || hex(username) of SQLite
+    """
+    return "u" + username.encode("utf-8").hex().upper()
+
+
+def search_window(limit, offset) -> tuple:
+    """
+    :param limit: page size
+    :param offset: matches skipped
+    :return: (limit, offset) of a search page within the first SEARCH_MAX_RESULTS
+    matches, limit is 0 past them
+    """
+    offset = max(0, min(int(offset), SEARCH_MAX_RESULTS))
+    return min(page_limit(limit), SEARCH_MAX_RESULTS - offset), offset
+
+
+def parse_datetime(m_datetime: str) -> datetime.datetime:
+    return datetime.datetime.strptime(m_datetime, "%Y-%m-%d %H:%M:%S")
+
+
+class PostgresBackend(StorageBackend):
+    """
+    PostgreSQL storage, connections are taken from the shared ConnectionPool.
+    All queries are parameterized, values are never formatted into the SQL.
+    """
+
+    def __init__(self, pool=None):
+        if psycopg2 is None:
+            raise RuntimeError("the postgres storage backend requires psycopg2")
+        self.pool = pool
+        self.data_errors = (psycopg2.IntegrityError, psycopg2.DataError, ValueError)
+
+    def init(self) -> None:
+        with DataConn(self.pool) as cursor:
+            cursor.execute(
+                "CREATE TABLE accounts ("
+                "user_id serial PRIMARY KEY,"
+                "username VARCHAR ( 50 ) UNIQUE NOT NULL,"
+                "password VARCHAR ( 255 ) NOT NULL);"
+            )
+
+            cursor.execute(
+                "CREATE TABLE messages ("
+                "message_id serial PRIMARY KEY,"
+                "author VARCHAR ( 50 ) NOT NULL,"
+                "text VARCHAR ( 2048 ) NOT NULL,"
+                "datetime timestamp NOT NULL,"
+                "broadcast BOOLEAN NOT NULL DEFAULT FALSE,"
+                "FOREIGN KEY (author) REFERENCES accounts(username) ON DELETE CASCADE);"
+            )
+
+            cursor.execute(
+                "CREATE TABLE accounts_messages ("
+                "message_id integer,"
+                "recipient VARCHAR ( 50 ),"
+                "FOREIGN KEY (recipient) REFERENCES accounts(username) ON DELETE CASCADE,"
+                "FOREIGN KEY (message_id) REFERENCES messages(message_id) ON DELETE CASCADE,"
+                "PRIMARY KEY (message_id, recipient));"
+            )
+
+            cursor.execute(
+                "INSERT INTO accounts (username, password) VALUES (%s, %s);",
+                (SERVER_NAME, hash_password(SERVER_ACCOUNT_PASSWORD)),
+            )
+
+        self._create_indexes()
+
+    def migrate(self) -> None:
+        """
+        Only what is missing is changed, the catalog is read first. The changes of
+        the columns touch the catalog only, the indexes are built CONCURRENTLY,
+        so the messages are not rewritten and writes go on meanwhile
+        """
+        with DataConn(self.pool) as cursor:
+            cursor.execute(
+                "SELECT table_name, column_name, character_maximum_length "
+                "FROM information_schema.columns "
+                "WHERE table_schema = current_schema() "
+                "AND table_name IN ('accounts', 'messages');"
+            )
+            columns = {(table, column): size for table, column, size in cursor.fetchall()}
+            if columns:
+                # passwords of old databases were plaintext, a hash is longer
+                if (columns[("accounts", "password")] or 255) < 255:
+                    log.info("Widening accounts.password for password hashes")
+                    cursor.execute(
+                        "ALTER TABLE accounts ALTER COLUMN password TYPE VARCHAR ( 255 );"
+                    )
+                if ("messages", "broadcast") not in columns:
+                    log.info("Adding messages.broadcast")
+                    cursor.execute(
+                        "ALTER TABLE messages ADD COLUMN "
+                        "broadcast BOOLEAN NOT NULL DEFAULT FALSE;"
+                    )
+                # stored search column of an earlier version, replaced by messages_text_idx
+                if ("messages", "text_search") in columns:
+                    log.info("Dropping messages.text_search")
+                    cursor.execute("ALTER TABLE messages DROP COLUMN text_search;")
+
+        if not columns:
+            self.init()
+            return
+        self._create_indexes()
+
+    def _create_indexes(self) -> None:
+        """
+        Builds the missing POSTGRES_INDEXES with CREATE INDEX CONCURRENTLY, which can
+        not run in a transaction. An index left invalid by an interrupted build is
+        dropped and built again
+        :return: None
+        """
+        pool = self.pool or get_pool()
+        conn = pool.getconn()
+        broken = False
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                for name, definition in POSTGRES_INDEXES:
+                    cursor.execute(
+                        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);",
+                        (name,),
+                    )
+                    record = cursor.fetchone()
+                    if record is not None and record[0]:
+                        continue
+                    if record is not None:
+                        log.warning("Index %s is invalid, building it again", name)
+                        cursor.execute(f"DROP INDEX CONCURRENTLY {name};")
+                    log.info("Creating index %s", name)
+                    cursor.execute(f"CREATE INDEX CONCURRENTLY {name} ON {definition};")
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not broken:
+                conn.autocommit = False
+            pool.putconn(conn, broken=broken)
+
+    def pool_stats(self) -> dict:
+        return (self.pool or get_pool()).stats()
+
+    def register(self, username: str, password: str) -> bool:
+        # init() runs after DataConn gave its connection back, it borrows one of its own
+        try:
+            with DataConn(self.pool) as cursor:
+                try:
+                    cursor.execute(
+                        "INSERT INTO accounts (username, password) VALUES (%s, %s);",
+                        (username, password),
+                    )
+                except psycopg2.errors.UniqueViolation:
+                    log.info("User %s already exist", username)
+                    return False
+        except psycopg2.errors.UndefinedTable:
+            self.init()
+            return self.register(username, password)
+
+        return True
+
+    def get_password(self, username: str):
+        try:
+            with DataConn(self.pool) as cursor:
+                cursor.execute(
+                    "SELECT password FROM accounts WHERE username = %s;", (username,)
+                )
+                record = cursor.fetchone()
+        except psycopg2.errors.UndefinedTable:
+            self.init()
+            return self.get_password(username)
+
+        return record[0] if record else None
+
+    def set_password(self, username: str, password: str) -> None:
+        with DataConn(self.pool) as cursor:
+            cursor.execute(
+                "UPDATE accounts SET password = %s WHERE username = %s;",
+                (password, username),
+            )
+
+    def existing_users(self, usernames: list) -> set:
+        with DataConn(self.pool) as cursor:
+            cursor.execute(
+                "SELECT username FROM accounts WHERE username = ANY(%s);", (list(usernames),)
+            )
+            return {record[0] for record in cursor.fetchall()}
+
+    def save_messages(self, messages: list) -> list:
+        with DataConn(self.pool) as cursor:
+            records = psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO messages (author, text, datetime, broadcast) VALUES %s "
+                "RETURNING message_id;",
+                [
+                    (author, text, m_datetime, "All users" in recipients)
+                    for author, recipients, text, m_datetime in messages
+                ],
+                page_size=len(messages),
+                fetch=True,
+            )
+            message_ids = [record[0] for record in records]
+
+            rows = []
+            for message_id, (_, recipients, _, _) in zip(message_ids, messages):
+                if "All users" not in recipients:
+                    for recip in recipients:
+                        rows.append((message_id, recip))
+            if rows:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    "INSERT INTO accounts_messages (message_id, recipient) VALUES %s;",
+                    rows,
+                    page_size=len(rows),
+                )
+        return message_ids
+
+    def load_history(
+        self, username: str, limit=HISTORY_PAGE_SIZE, before=None, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        if before is None:
+            before = 2 ** 31 - 1
+        return self._load(False, username, before, limit, chunk_size)
+
+    def load_since(
+        self, username: str, after: int, limit=HISTORY_MAX_PAGE_SIZE, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        return self._load(True, username, after, limit, chunk_size)
+
+    def _load(self, newer: bool, username: str, cursor_id: int, limit, chunk_size):
+        """
+        Rows are fetched through a server-side cursor and yielded in chunks
+        """
+        with DataConn(self.pool, cursor_name="load_history") as cursor:
+            cursor.execute(
+                history_query(newer, lambda name: f"%({name})s"),
+                {"username": username, "cursor": cursor_id, "limit": page_limit(limit)},
+            )
+            while True:
+                records = cursor.fetchmany(chunk_size)
+                if not records:
+                    break
+                yield records
+
+    def search(
+        self,
+        username: str,
+        terms: list,
+        limit=SEARCH_PAGE_SIZE,
+        offset=0,
+        chunk_size=HISTORY_CHUNK_SIZE,
+    ):
+        """
+        UNION of the messages written, received by the user and broadcast that match, like
+        history_query, the planner either starts from the GIN index or from the
+        messages of the user, whichever has fewer rows
+        """
+        limit, offset = search_window(limit, offset)
+        if not terms or not limit:
+            return
+        with DataConn(self.pool, cursor_name="search") as cursor:
+            cursor.execute(
+                "SELECT message_id, text, author, datetime FROM ("
+                "SELECT message_id, text, author, datetime, "
+                "ts_rank_cd(to_tsvector('simple', text), query) AS rank "
+                "FROM messages, plainto_tsquery('simple', %(query)s) AS query "
+                "WHERE author = %(username)s AND to_tsvector('simple', text) @@ query "
+                "UNION "
+                "SELECT message_id, text, author, datetime, "
+                "ts_rank_cd(to_tsvector('simple', text), query) AS rank "
+                "FROM accounts_messages JOIN messages USING (message_id), "
+                "plainto_tsquery('simple', %(query)s) AS query "
+                "WHERE recipient = %(username)s AND to_tsvector('simple', text) @@ query "
+                "UNION "
+                "SELECT message_id, text, author, datetime, "
+                "ts_rank_cd(to_tsvector('simple', text), query) AS rank "
+                "FROM messages, plainto_tsquery('simple', %(query)s) AS query "
+                "WHERE broadcast AND to_tsvector('simple', text) @@ query) AS matches "
+                "ORDER BY rank DESC, message_id DESC "
+                "LIMIT %(limit)s OFFSET %(offset)s;",
+                {
+                    "query": " ".join(terms),
+                    "username": username,
+                    "limit": limit,
+                    "offset": offset,
+                },
+            )
+            while True:
+                records = cursor.fetchmany(chunk_size)
+                if not records:
+                    break
+                yield records
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded storage in a local SQLite file in WAL mode, every thread has its own
+    connection (SQLite caches the prepared statements per connection).
+    """
+
+    data_errors = (sqlite3.IntegrityError, sqlite3.DataError, ValueError)
+
+    def __init__(self, path=SQLITE_PATH):
+        """
+        :param path: database file, ":memory:" is not supported because every
+        thread would get its own empty database, use MemoryBackend instead
+        """
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            self._create_tables(conn)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=DB_POOL_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("PRAGMA foreign_keys=ON;")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return SQLiteTransaction(self._connection())
+
+    @staticmethod
+    def _create_tables(conn) -> None:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS accounts ("
+            "user_id INTEGER PRIMARY KEY,"
+            "username TEXT UNIQUE NOT NULL,"
+            "password TEXT NOT NULL);"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "message_id INTEGER PRIMARY KEY,"
+            "author TEXT NOT NULL,"
+            "text TEXT NOT NULL,"
+            "datetime TEXT NOT NULL,"
+            "broadcast INTEGER NOT NULL DEFAULT 0,"
+            "FOREIGN KEY (author) REFERENCES accounts(username) ON DELETE CASCADE);"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS accounts_messages ("
+            "message_id INTEGER,"
+            "recipient TEXT,"
+            "FOREIGN KEY (recipient) REFERENCES accounts(username) ON DELETE CASCADE,"
+            "FOREIGN KEY (message_id) REFERENCES messages(message_id) ON DELETE CASCADE,"
+            "PRIMARY KEY (message_id, recipient)) WITHOUT ROWID;"
+        )
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(messages);")]
+        if "broadcast" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN broadcast INTEGER NOT NULL DEFAULT 0;")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS messages_broadcast_id_idx "
+            "ON messages (message_id DESC) WHERE broadcast;"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS messages_author_id_idx "
+            "ON messages (author, message_id DESC);"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS accounts_messages_recipient_id_idx "
+            "ON accounts_messages (recipient, message_id DESC);"
+        )
+        # full-text index of the messages (FTS5, part of the SQLite of Python) with
+        # the author and the recipients as owner_token words (BROADCAST_TOKEN for
+        # broadcasts), so a search
+        # intersects the words with the messages of the user inside the index.
+        # Rows are added by save_messages, those of an older database here
+        created = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_search';"
+        ).fetchone() is None
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_search USING fts5("
+            "text, owners, content='');"
+        )
+        if created:
+            conn.execute(
+                "INSERT INTO messages_search (rowid, text, owners) "
+                "SELECT message_id, text, 'u' || hex(author) || coalesce(("
+                "SELECT ' ' || group_concat('u' || hex(recipient), ' ') "
+                "FROM accounts_messages "
+                "WHERE accounts_messages.message_id = messages.message_id), '') "
+                f"|| CASE WHEN broadcast THEN ' {BROADCAST_TOKEN}' ELSE '' END "
+                "FROM messages;"
+            )
+        # hashing is slow on purpose, only done when the account is added
+        exists = conn.execute(
+            "SELECT 1 FROM accounts WHERE username = ?;", (SERVER_NAME,)
+        ).fetchone()
+        if exists is None:
+            conn.execute(
+                "INSERT INTO accounts (username, password) VALUES (?, ?);",
+                (SERVER_NAME, hash_password(SERVER_ACCOUNT_PASSWORD)),
+            )
+
+    def init(self) -> None:
+        with self._transaction() as conn:
+            self._create_tables(conn)
+
+    def register(self, username: str, password: str) -> bool:
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    "INSERT INTO accounts (username, password) VALUES (?, ?);",
+                    (username, password),
+                )
+        except sqlite3.IntegrityError:
+            log.info("User %s already exist", username)
+            return False
+        return True
+
+    def get_password(self, username: str):
+        record = self._connection().execute(
+            "SELECT password FROM accounts WHERE username = ?;", (username,)
+        ).fetchone()
+        return record[0] if record else None
+
+    def set_password(self, username: str, password: str) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE accounts SET password = ? WHERE username = ?;", (password, username)
+            )
+
+    def existing_users(self, usernames: list) -> set:
+        usernames = list(usernames)
+        if not usernames:
+            return set()
+        records = self._connection().execute(
+            "SELECT username FROM accounts WHERE username IN "
+            f"({', '.join('?' * len(usernames))});",
+            usernames,
+        ).fetchall()
+        return {record[0] for record in records}
+
+    def save_messages(self, messages: list) -> list:
+        message_ids = []
+        with self._transaction() as conn:
+            for author, recipients, text, m_datetime in messages:
+                broadcast = "All users" in recipients
+                cursor = conn.execute(
+                    "INSERT INTO messages (author, text, datetime, broadcast) "
+                    "VALUES (?, ?, ?, ?);",
+                    (author, text, m_datetime, broadcast),
+                )
+                message_ids.append(cursor.lastrowid)
+                if broadcast:
+                    owners = [owner_token(author), BROADCAST_TOKEN]
+                else:
+                    conn.executemany(
+                        "INSERT INTO accounts_messages (message_id, recipient) VALUES (?, ?);",
+                        [(cursor.lastrowid, recip) for recip in recipients],
+                    )
+                    owners = [owner_token(username) for username in {author, *recipients}]
+                conn.execute(
+                    "INSERT INTO messages_search (rowid, text, owners) VALUES (?, ?, ?);",
+                    (cursor.lastrowid, text, " ".join(owners)),
+                )
+        return message_ids
+
+    def load_history(
+        self, username: str, limit=HISTORY_PAGE_SIZE, before=None, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        if before is None:
+            before = 2 ** 63 - 1
+        return self._load(False, username, before, limit, chunk_size)
+
+    def load_since(
+        self, username: str, after: int, limit=HISTORY_MAX_PAGE_SIZE, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        return self._load(True, username, after, limit, chunk_size)
+
+    def _load(self, newer: bool, username: str, cursor_id: int, limit, chunk_size):
+        # the page (at most HISTORY_MAX_PAGE_SIZE rows) is read at once, SQLite cursors
+        # can not be moved between threads and the async server resumes the
+        # generator on any thread of its executor
+        records = self._connection().execute(
+            history_query(newer, lambda name: f":{name}"),
+            {"username": username, "cursor": cursor_id, "limit": page_limit(limit)},
+        ).fetchall()
+
+        for start in range(0, len(records), chunk_size):
+            yield [
+                (message_id, text, author, parse_datetime(m_datetime))
+                for message_id, text, author, m_datetime in records[start : start + chunk_size]
+            ]
+
+    def search(
+        self,
+        username: str,
+        terms: list,
+        limit=SEARCH_PAGE_SIZE,
+        offset=0,
+        chunk_size=HISTORY_CHUNK_SIZE,
+    ):
+        """
+        Matches are ranked by bm25 of their text (its length normalization also counts
+        the owner words, a message to many recipients ranks a little lower),
+        read at once like the pages of _load
+        """
+        limit, offset = search_window(limit, offset)
+        if not terms or not limit:
+            return
+
+        # every word is quoted, so words like AND or NEAR are not operators of FTS5
+        query = " AND ".join(
+            [f'(owners : "{owner_token(username)}" OR owners : "{BROADCAST_TOKEN}")']
+            + [f'text : "{term}"' for term in terms]
+        )
+        records = self._connection().execute(
+            "SELECT message_id, text, author, datetime FROM messages "
+            "JOIN (SELECT rowid, bm25(messages_search, 1.0, 0.0) AS rank "
+            "FROM messages_search WHERE messages_search MATCH :query) AS matches "
+            "ON matches.rowid = messages.message_id "
+            "ORDER BY matches.rank, message_id DESC LIMIT :limit OFFSET :offset;",
+            {"query": query, "limit": limit, "offset": offset},
+        ).fetchall()
+
+        for start in range(0, len(records), chunk_size):
+            yield [
+                (message_id, text, author, parse_datetime(m_datetime))
+                for message_id, text, author, m_datetime in records[start : start + chunk_size]
+            ]
+
+
+class SQLiteTransaction:
+    """
+    Context manager, BEGIN ... COMMIT (or ROLLBACK on error) on a SQLite connection
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN;")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT;")
+        else:
+            self.conn.execute("ROLLBACK;")
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Pure in-memory storage for tests, benchmarks and throwaway servers,
+    everything is lost when the server stops
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accounts = {SERVER_NAME: hash_password(SERVER_ACCOUNT_PASSWORD)}
+        self.messages = {}
+        self._by_user = collections.defaultdict(list)
+        # word: message_ids containing it, ascending
+        self._words = collections.defaultdict(list)
+        self._broadcasts = []
+        self._last_id = 0
+
+    def init(self) -> None:
+        pass
+
+    def register(self, username: str, password: str) -> bool:
+        with self._lock:
+            if username in self.accounts:
+                log.info("User %s already exist", username)
+                return False
+            self.accounts[username] = password
+        return True
+
+    def get_password(self, username: str):
+        return self.accounts.get(username)
+
+    def existing_users(self, usernames: list) -> set:
+        return {username for username in usernames if username in self.accounts}
+
+    def set_password(self, username: str, password: str) -> None:
+        with self._lock:
+            if username in self.accounts:
+                self.accounts[username] = password
+
+    def save_messages(self, messages: list) -> list:
+        message_ids = []
+        with self._lock:
+            for author, recipients, text, m_datetime in messages:
+                self._last_id += 1
+                message_id = self._last_id
+                self.messages[message_id] = (
+                    text,
+                    author,
+                    parse_datetime(m_datetime),
+                )
+                if "All users" in recipients:
+                    self._broadcasts.append(message_id)
+                else:
+                    for username in {author, *recipients}:
+                        self._by_user[username].append(message_id)
+                for word in set(split_words(text)):
+                    self._words[word].append(message_id)
+                message_ids.append(message_id)
+        return message_ids
+
+    def load_history(
+        self, username: str, limit=HISTORY_PAGE_SIZE, before=None, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        limit = page_limit(limit)
+        with self._lock:
+            page = []
+            for message_ids in (self._by_user.get(username, []), self._broadcasts):
+                end = len(message_ids)
+                if before is not None:
+                    end = bisect.bisect_left(message_ids, before)
+                page += message_ids[max(0, end - limit) : end]
+            records = [
+                (message_id, *self.messages[message_id])
+                for message_id in sorted(page, reverse=True)[:limit]
+            ]
+
+        for start in range(0, len(records), chunk_size):
+            yield records[start : start + chunk_size]
+
+    def load_since(
+        self, username: str, after: int, limit=HISTORY_MAX_PAGE_SIZE, chunk_size=HISTORY_CHUNK_SIZE
+    ):
+        limit = page_limit(limit)
+        with self._lock:
+            page = []
+            for message_ids in (self._by_user.get(username, []), self._broadcasts):
+                start = bisect.bisect_right(message_ids, after)
+                page += message_ids[start : start + limit]
+            records = [
+                (message_id, *self.messages[message_id]) for message_id in sorted(page)[:limit]
+            ]
+
+        for start in range(0, len(records), chunk_size):
+            yield records[start : start + chunk_size]
+
+    def search(
+        self,
+        username: str,
+        terms: list,
+        limit=SEARCH_PAGE_SIZE,
+        offset=0,
+        chunk_size=HISTORY_CHUNK_SIZE,
+    ):
+        """
+        Matches are ranked by how often the terms occur in them
+        """
+        limit, offset = search_window(limit, offset)
+        if not terms or not limit:
+            return
+
+        with self._lock:
+            matches = set(self._by_user.get(username, ())).union(self._broadcasts).intersection(
+                *(self._words.get(term, ()) for term in terms)
+            )
+            ranked = []
+            for message_id in matches:
+                record = (message_id, *self.messages[message_id])
+                words = split_words(record[1])
+                ranked.append((-sum(words.count(term) for term in terms), -message_id, record))
+            ranked.sort()
+            records = [record for _, _, record in ranked[offset : offset + limit]]
+
+        for start in range(0, len(records), chunk_size):
+            yield records[start : start + chunk_size]
+
+
+_BACKEND = None
+_BACKEND_LOCK = threading.Lock()
+
+
+def create_backend(name=STORAGE_BACKEND) -> StorageBackend:
+    """
+    :param name: "postgres", "sqlite" or "memory"
+    :return: new storage backend
+    """
+    if name == "postgres":
+        return PostgresBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"unknown storage backend {name}")
+
+
+def get_backend() -> StorageBackend:
+    """
+    :return: the backend chosen by STORAGE_BACKEND, shared by the server
+    """
+    global _BACKEND
+    if _BACKEND is None:
+        with _BACKEND_LOCK:
+            if _BACKEND is None:
+                _BACKEND = create_backend()
+    return _BACKEND
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no database connection became free within the pool timeout
+    """
+
+
+class ConnectionPool:
+    """
+    Bounded thread-safe pool of persistent PostgreSQL connections.
+    Connections are opened lazily up to max_size, checked on checkout and replaced
+    when they turn out to be broken.
+    """
+
+    def __init__(
+        self,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        check_idle=DB_POOL_CHECK_IDLE,
+        **connect_kwargs,
+    ):
+        """
+        :param min_size: connections opened on the first checkout
+        :param max_size: upper bound of open connections
+        :param timeout: seconds to wait for a free connection before PoolTimeout
+        :param check_idle: connections idle longer than this are pinged on checkout
+        :param connect_kwargs: passed to psycopg2.connect
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = collections.deque()
+        self._size = 0
+        self._started = False
+        self._cond = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def _start(self) -> None:
+        """
+        Opens min_size connections, called once under the lock
+        :return: None
+        """
+        while self._size < self.min_size:
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+        self._started = True
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        """
+        Health check, a cheap round-trip to the server
+        :param conn:
+        :return: False if the connection can not be used anymore
+        """
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        """
+        Takes a connection from the pool, opening a new one if there is no idle
+        connection and the pool is not full. Waits up to self.timeout otherwise.
+        :return: psycopg2 connection
+        """
+        start = time.monotonic()
+        waited = False
+        conn = None
+        with self._cond:
+            if not self._started:
+                self._start()
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                waited = True
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if not self._idle and self._size >= self.max_size:
+                        self.timeouts += 1
+                        raise PoolTimeout(
+                            f"no free database connection in {self.timeout}s"
+                        )
+
+            wait_time = time.monotonic() - start
+            self.checkouts += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            if waited:
+                self.waits += 1
+
+        if conn is not None:
+            if not conn.closed and (
+                time.monotonic() - last_used <= self.check_idle
+                or self._is_alive(conn)
+            ):
+                return conn
+            # broken connection, reconnect keeping its pool slot
+            self._close(conn)
+            with self._cond:
+                self.reconnects += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn, broken=False) -> None:
+        """
+        Returns the connection to the pool
+        :param conn:
+        :param broken: True if the connection failed and must not be reused
+        :return: None
+        """
+        if broken or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn) -> None:
+        self._close(conn)
+        self._release_slot()
+
+    @staticmethod
+    def _close(conn) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _release_slot(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def close_all(self) -> None:
+        """
+        Closes the idle connections, used on server shutdown
+        :return: None
+        """
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._size -= 1
+
+    def stats(self) -> dict:
+        """
+        :return: pool usage and checkout wait-time statistics
+        """
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+                "wait_time_avg": self.wait_time_total / self.checkouts
+                if self.checkouts
+                else 0.0,
+                "wait_time_max": self.wait_time_max,
+            }
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    :return: the connection pool shared by all DataConn, created on first use
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ConnectionPool(
+                    dbname=DATABASE, user=DB_USER, password=DB_PASSWORD, host=DB_HOST
+                )
+    return _POOL
+
+
+class DataConn:
+    """
+    Context manager for working with the database.
+    Borrows a connection from the shared pool and gives it back on exit.
+    """
+
+    def __init__(self, pool=None, cursor_name=None):
+        """
+        :param pool: default is the shared pool
+        :param cursor_name: if set, a server-side (named) cursor is used,
+        rows are transferred on fetch instead of all at once on execute
+        """
+        self.pool = pool or get_pool()
+        self.cursor_name = cursor_name
+
+    def __enter__(self):
+        self.conn = self.pool.getconn()
+        self.cursor = self.conn.cursor(name=self.cursor_name)
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        broken = exc_type is not None and issubclass(
+            exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError)
+        )
+        try:
+            if exc_val:
+                self.conn.rollback()
+            else:
+                self.conn.commit()
+            self.cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            if not exc_val:
+                raise
+        finally:
+            self.pool.putconn(self.conn, broken=broken)
+        # the error propagates with its own type, callers outside the block catch
+        # e.g. psycopg2.errors.UndefinedTable
+        return False
@@ -0,0 +1,166 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from bus import BusHub, BusClient
+from session import session_secret
+from logs import setup_logging
+from config_server import BUS_PATH, SUPERVISOR_CHECK_INTERVAL, METRICS_PORT
+
+log = logging.getLogger("chat.supervisor")
+
+
+def worker_main(
+    mode: str, host: str, port: int, bus_path: str, worker_init=None, metrics_port=0
+) -> None:
+    """
+    Target of a worker process, runs one chat server sharing the port with the others
+    :param mode: "threaded" or "async"
+    :param host:
+    :param port:
+    :param bus_path: Unix socket of the bus hub
+    :param worker_init: worker_init(chat_server) is called before the server starts,
+    returns the DataBase of the worker or None for the default
+    :param metrics_port: admin port of the worker, 0 - off
+    :return: None
+    """
+    if mode == "async":
+        import server_async as chat_server
+    else:
+        import server as chat_server
+
+    db = worker_init(chat_server) if worker_init is not None else None
+    chat_server.run(
+        host,
+        port,
+        db=db,
+        bus=BusClient(bus_path),
+        reuse_port=True,
+        metrics_port=metrics_port,
+    )
+
+
+class Supervisor:
+    """
+    Starts the worker processes and the bus hub between them,
+    a worker that exits is started again
+    """
+
+    def __init__(
+        self,
+        mode: str,
+        host: str,
+        port: int,
+        workers: int,
+        bus_path=BUS_PATH,
+        worker_init=None,
+        check_interval=SUPERVISOR_CHECK_INTERVAL,
+        metrics_port=METRICS_PORT,
+    ):
+        """
+        :param mode: "threaded" or "async"
+        :param host:
+        :param port:
+        :param workers: number of worker processes
+        :param bus_path: Unix socket of the bus, "" - in the temp directory
+        :param worker_init: picklable, see worker_main
+        :param check_interval: seconds between checks of the workers
+        :param metrics_port: worker i serves its metrics on metrics_port + 1 + i, 0 - off
+        """
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.bus_path = bus_path or os.path.join(
+            tempfile.gettempdir(), f"chat-bus-{os.getpid()}.sock"
+        )
+        self.worker_init = worker_init
+        self.check_interval = check_interval
+        self.metrics_port = metrics_port
+
+        # workers do not inherit the threads and sockets of the supervisor
+        self._context = multiprocessing.get_context("spawn")
+        self._hub = BusHub(self.bus_path)
+        self._processes = []
+        self.restarts = 0
+
+    def _start_worker(self, index: int):
+        metrics_port = self.metrics_port + 1 + index if self.metrics_port else 0
+        process = self._context.Process(
+            target=worker_main,
+            args=(
+                self.mode,
+                self.host,
+                self.port,
+                self.bus_path,
+                self.worker_init,
+                metrics_port,
+            ),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def start(self) -> None:
+        # generated before the workers start, so they all accept the same session tokens
+        session_secret()
+        self._hub.start()
+        self._processes = [self._start_worker(index) for index in range(self.workers)]
+        log.info(
+            "Supervisor started %s %s workers on %s:%s",
+            self.workers,
+            self.mode,
+            self.host,
+            self.port,
+        )
+
+    def check(self) -> None:
+        """
+        Starts again the workers that have exited
+        :return: None
+        """
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                log.warning(
+                    "Worker %s exited with %s, restarting", process.pid, process.exitcode
+                )
+                self._processes[index] = self._start_worker(index)
+                self.restarts += 1
+
+    def stop(self) -> None:
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+        self._hub.close()
+
+    def run(self) -> None:
+        """
+        Runs the cluster until interrupted
+        :return: None
+        """
+        setup_logging()
+        self.start()
+        try:
+            while True:
+                time.sleep(self.check_interval)
+                self.check()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def run(mode: str, host: str, port: int, workers: int, metrics_port=METRICS_PORT) -> None:
+    """
+    Runs the chat server as several worker processes
+    :param mode: "threaded" or "async"
+    :param host:
+    :param port:
+    :param workers:
+    :param metrics_port: worker i serves its metrics on metrics_port + 1 + i, 0 - off
+    :return: None
+    """
+    Supervisor(mode, host, port, workers, metrics_port=metrics_port).run()
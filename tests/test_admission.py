@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import unittest
+
+from admission import AsyncAdmission, ThreadedAdmission
+
+
+class ThreadedAdmissionTest(unittest.TestCase):
+    def test_admit_queue_and_shed(self):
+        admission = ThreadedAdmission(2, queue_size=1, queue_timeout=5)
+        self.assertIs(admission.arrive(), True)
+        self.assertIs(admission.arrive(), True)
+        waiter = admission.arrive()
+        self.assertIsInstance(waiter, threading.Event)
+        self.assertIsNone(admission.arrive())
+
+        admission.release()
+        self.assertTrue(admission.wait(waiter))
+        stats = admission.stats()
+        self.assertEqual(
+            [stats[key] for key in ("active", "waiting", "accepted", "admitted", "queued", "shed")],
+            [2, 0, 4, 3, 1, 1],
+        )
+
+    def test_slot_is_freed_without_waiters(self):
+        admission = ThreadedAdmission(1, queue_size=1)
+        admission.arrive()
+        admission.release()
+        self.assertIs(admission.arrive(), True)
+
+    def test_queue_timeout(self):
+        admission = ThreadedAdmission(1, queue_size=1, queue_timeout=0.01)
+        admission.arrive()
+        waiter = admission.arrive()
+        self.assertFalse(admission.wait(waiter))
+        self.assertEqual(admission.stats()["waiting"], 0)
+        self.assertEqual(admission.stats()["shed"], 1)
+        # the slot is not handed to the connection that gave up
+        admission.release()
+        self.assertEqual(admission.stats()["active"], 0)
+
+    def test_retry_after_is_jittered(self):
+        admission = ThreadedAdmission(1, retry_after=2.0)
+        hints = {admission.retry_after() for _ in range(20)}
+        self.assertGreater(len(hints), 1)
+        self.assertTrue(all(2.0 <= hint <= 4.0 for hint in hints))
+
+
+class AsyncAdmissionTest(unittest.TestCase):
+    def test_queued_connection_gets_the_slot(self):
+        async def scenario():
+            admission = AsyncAdmission(1, queue_size=2, queue_timeout=5)
+            admission.arrive()
+            first, second = admission.arrive(), admission.arrive()
+            waiting = asyncio.ensure_future(admission.wait(first))
+            await asyncio.sleep(0)
+            admission.release()
+            self.assertTrue(await waiting)
+            self.assertFalse(second.done())
+            return admission.stats()
+
+        stats = asyncio.run(scenario())
+        self.assertEqual((stats["active"], stats["waiting"]), (1, 1))
+
+    def test_queue_timeout(self):
+        async def scenario():
+            admission = AsyncAdmission(1, queue_size=2, queue_timeout=0.01)
+            admission.arrive()
+            first, second = admission.arrive(), admission.arrive()
+            self.assertFalse(await admission.wait(first))
+            admission.release()
+            self.assertTrue(second.done())
+            return admission.stats()
+
+        stats = asyncio.run(scenario())
+        self.assertEqual((stats["active"], stats["waiting"], stats["shed"]), (1, 0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
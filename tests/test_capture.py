@@ -0,0 +1,126 @@
+import os
+import tempfile
+import unittest
+
+from capture import CLOSE, FRAME, LOGIN, OPEN, CaptureWriter, read_capture, redact
+from chat_util import Message, User
+from codec import JSON
+from replay import AUTH, LOAD, MESSAGE, OTHER, REGISTER, classify, compare, load_sessions
+
+
+def payload(text: str, author="alice", recipients=()) -> bytes:
+    return Message(text, author, list(recipients)).payload(JSON)
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "traffic.cap")
+
+    def capture_session(self, username: str, texts: list) -> None:
+        capture = CaptureWriter(self.path)
+        user = User(None, None, username=username)
+        capture.open(user)
+        capture.frame(user, payload(f"/login {username}:secret", username))
+        user.logged_in = True
+        capture.login(user)
+        for text in texts:
+            capture.frame(user, payload(text, username, ["bob"]))
+        capture.close(user)
+        capture.shutdown()
+
+    def test_redact(self):
+        for text, redacted in (
+            ("/login alice:secret", "/login alice:*"),
+            ("/register alice:secret", "/register alice:*"),
+            ("/resume alice:123:signature 4f.2", "/resume * 4f.2"),
+        ):
+            message = Message.decode(redact(payload(text)))
+            self.assertEqual(message.text, redacted)
+        self.assertEqual(redact(payload("hello")), payload("hello"))
+        self.assertEqual(redact(b"not a frame"), b"not a frame")
+
+    def test_write_and_read(self):
+        self.capture_session("alice", ["hello"])
+        records = list(read_capture(self.path))
+        self.assertEqual([record[2] for record in records], [OPEN, FRAME, LOGIN, FRAME, CLOSE])
+        self.assertEqual({record[1] for record in records}, {1})
+        self.assertEqual(Message.decode(records[1][3]).text, "/login alice:*")
+        self.assertEqual(records[2][3], b"alice")
+        self.assertEqual(Message.decode(records[3][3]).text, "hello")
+
+    def test_appended_capture_numbers_new_connections(self):
+        self.capture_session("alice", [])
+        self.capture_session("carol", [])
+        connections = [record[1] for record in read_capture(self.path) if record[2] == OPEN]
+        self.assertEqual(connections, [1, 2])
+
+    def test_record_cut_off_is_skipped(self):
+        self.capture_session("alice", ["hello"])
+        with open(self.path, "rb+") as file:
+            file.truncate(os.path.getsize(self.path) - 1)
+        kinds = [record[2] for record in read_capture(self.path)]
+        self.assertEqual(kinds, [OPEN, FRAME, LOGIN, FRAME])
+
+    def test_not_a_capture(self):
+        with open(self.path, "wb") as file:
+            file.write(b"something else")
+        with self.assertRaises(ValueError):
+            list(read_capture(self.path))
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "traffic.cap")
+
+    def test_classify(self):
+        self.assertEqual(classify(payload("/login alice:*"), False)[0], AUTH)
+        self.assertEqual(classify(payload("/register alice:*"), False)[0], REGISTER)
+        self.assertEqual(classify(payload("/load 10"), True)[0], LOAD)
+        self.assertEqual(classify(payload("hi", recipients=["bob"]), True)[0], MESSAGE)
+        self.assertEqual(classify(payload("hi"), True)[0], OTHER)
+        self.assertIsNone(classify(payload("/pong"), True)[0])
+        self.assertEqual(classify(b"garbage", True), (OTHER, None))
+
+    def test_load_sessions(self):
+        capture = CaptureWriter(self.path)
+        alice, bob = User(None, None, username="alice"), User(None, None, username="bob")
+        for user, command in ((alice, "/login"), (bob, "/register")):
+            capture.open(user)
+            capture.frame(user, payload(f"{command} {user.username}:secret", user.username))
+            user.logged_in = True
+            capture.login(user)
+        capture.frame(alice, payload("/pong"))
+        capture.frame(alice, payload("hi", recipients=["bob"]))
+        capture.shutdown()
+
+        schedule, usernames = load_sessions(self.path, "replay")
+        # the account of bob is created by the replayed /register
+        self.assertEqual(usernames, ["alice"])
+        frames = [(entry[1].connection, entry[2], entry[3]) for entry in schedule if entry[3]]
+        self.assertEqual(
+            [(connection, kind, Message.decode(body).text) for connection, kind, body in frames],
+            [
+                (1, AUTH, "/login alice:replay"),
+                (2, AUTH, "/register bob:replay"),
+                (1, MESSAGE, "hi"),
+            ],
+        )
+
+    def test_compare(self):
+        baseline = {"frames_per_s": 100.0, "latency": {"message": {"p50_ms": 2.0}}}
+        results = {"frames_per_s": 150.0, "latency": {"message": {"p50_ms": 1.0, "p99_ms": 3}}}
+        self.assertEqual(
+            compare(baseline, results),
+            {
+                "frames_per_s": {"baseline": 100.0, "current": 150.0, "change_pct": 50.0},
+                "latency.message.p50_ms": {"baseline": 2.0, "current": 1.0, "change_pct": -50.0},
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+"""
+Replies of the server as the client parses them, client.py itself needs PyQt5
+"""
+import unittest
+
+from chat_util import Message, server_reply
+
+SERVER = "server"
+
+
+class ServerReplyTest(unittest.TestCase):
+    def test_reply_of_the_server(self):
+        message = Message("/presence 4f2a.3 +alice -bob", SERVER, ["carol"])
+        self.assertEqual(server_reply(message, SERVER, "/presence"), ["4f2a.3", "+alice", "-bob"])
+        self.assertEqual(server_reply(Message("/ping", SERVER, []), SERVER, "/ping"), [])
+
+    def test_chat_message_of_a_user_is_not_a_reply(self):
+        for text in ("/now_online", "/now_online 1.1 mallory", "see /now_online", "type /presence"):
+            message = Message(text, "mallory", ["carol"])
+            self.assertIsNone(server_reply(message, SERVER, "/now_online"), text)
+            self.assertIsNone(server_reply(message, SERVER, "/presence"), text)
+
+    def test_command_is_a_whole_word(self):
+        message = Message("/now_onlinex 1.1", SERVER, [])
+        self.assertIsNone(server_reply(message, SERVER, "/now_online"))
+        self.assertIsNone(server_reply(message, SERVER, "/presence"))
+
+    def test_history_end(self):
+        for text, words in (("/history_end 42", ["42"]), ("/history_end ", [""])):
+            message = Message(text, SERVER, [])
+            self.assertEqual(server_reply(message, SERVER, "/history_end"), words)
+        for text in ("/history_end", "/history_end 1", "before /history_end 1"):
+            message = Message(text, "mallory", ["carol"])
+            self.assertIsNone(server_reply(message, SERVER, "/history_end"), text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import zlib
+
+from chat_util import Message, MessagePage
+from codec import (
+    JSON,
+    BINARY,
+    BINARY_ZLIB,
+    BATCH,
+    COMPRESSED,
+    MESSAGE,
+    choose_codec,
+    decode_binary,
+    encode_binary,
+    pack,
+    unpack,
+)
+from framing import FrameDecoder, FrameError, HEADER
+
+
+def frames(data: bytes) -> list:
+    return FrameDecoder().feed(data)
+
+
+class CodecTest(unittest.TestCase):
+    def test_choose_codec(self):
+        self.assertEqual(choose_codec(None), JSON)
+        self.assertEqual(choose_codec(["json"]), JSON)
+        self.assertEqual(choose_codec(["binary"]), BINARY)
+        self.assertEqual(choose_codec(["binary", "zlib"]), BINARY_ZLIB)
+
+    def test_round_trip_every_codec(self):
+        message = Message("héllo", "alice", ["bob", "carol"], "2024-01-01 10:00:00", 42)
+        for codec in (JSON, BINARY, BINARY_ZLIB):
+            (payload,) = frames(message.encode(codec))
+            decoded = Message.decode(payload)
+            self.assertEqual(decoded.to_dict(), message.to_dict(), codec)
+
+    def test_binary_without_message_id(self):
+        author, recipients, text, m_datetime, message_id = decode_binary(
+            encode_binary("a", [], "t", "2024-01-01 10:00:00")
+        )
+        self.assertEqual((author, recipients, text, message_id), ("a", [], "t", None))
+
+    def test_long_names(self):
+        message = Message("hi", "x" * 300000, ["y" * 70000], "2024-01-01 10:00:00")
+        (payload,) = frames(message.encode(BINARY))
+        decoded = Message.decode(payload)
+        self.assertEqual(decoded.author, "x" * 300000)
+        self.assertEqual(decoded.recipients, ("y" * 70000,))
+
+    def test_batch_is_compressed(self):
+        messages = [
+            Message(f"message {i} " * 20, "a", ["b"], "2024-01-01 10:00:00", i)
+            for i in range(1, 51)
+        ]
+        data = MessagePage(messages).encode(BINARY_ZLIB)
+        (payload,) = frames(data)
+        self.assertEqual(payload[0], BATCH | COMPRESSED)
+        decoded = Message.decode_all(payload)
+        self.assertEqual([m.message_id for m in decoded], list(range(1, 51)))
+        self.assertEqual(decoded[7].text, messages[7].text)
+
+    def test_json_batch_is_one_frame_per_message(self):
+        messages = [Message("t", "a", ["b"], "2024-01-01 10:00:00") for _ in range(3)]
+        self.assertEqual(len(frames(MessagePage(messages).encode(JSON))), 3)
+
+    def test_non_message_tag_rejected(self):
+        payload = encode_binary("a", ["b"], "t", "2024-01-01 10:00:00")
+        with self.assertRaises(FrameError):
+            decode_binary(bytes([BATCH]) + payload[1:])
+        # a batch inside a batch
+        nested = bytes([BATCH]) + HEADER.pack(1) + bytes([BATCH])
+        with self.assertRaises(FrameError):
+            Message.decode_all(bytes([BATCH]) + HEADER.pack(len(nested)) + nested)
+
+    def test_malformed(self):
+        payload = encode_binary("a", ["b"], "text", "2024-01-01 10:00:00")
+        for bad in (payload[:-1], payload + b"x", payload[:5], b"", bytes([9]) + payload[1:]):
+            with self.assertRaises(FrameError):
+                Message.decode_all(bad)
+        with self.assertRaises(FrameError):
+            unpack(bytes([BATCH]) + HEADER.pack(100) + b"short")
+        with self.assertRaises(FrameError):
+            unpack(bytes([MESSAGE | COMPRESSED]) + b"not zlib")
+
+    def test_decompression_bomb(self):
+        body = zlib.compress(b"\0" * (2 * 1024 * 1024))
+        with self.assertRaises(FrameError):
+            unpack(bytes([MESSAGE | COMPRESSED]) + body)
+
+    def test_single_payload_is_not_batched(self):
+        payload = encode_binary("a", ["b"], "t", "2024-01-01 10:00:00")
+        (framed,) = frames(pack([payload], BINARY))
+        self.assertEqual(framed, payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+from chat_util import DataBase
+from credentials import CredentialCache, hash_password, needs_rehash, verify_password
+from storage import MemoryBackend
+from tests.test_ratelimit import Clock
+
+
+class PasswordTest(unittest.TestCase):
+    def test_hash_and_verify(self):
+        stored = hash_password("secret", iterations=1000)
+        self.assertTrue(stored.startswith("pbkdf2_sha256$1000$"))
+        self.assertNotEqual(stored, hash_password("secret", iterations=1000))
+        self.assertTrue(verify_password("secret", stored))
+        self.assertFalse(verify_password("Secret", stored))
+        self.assertFalse(verify_password("secret", "pbkdf2_sha256$1000$zz$zz"))
+
+    def test_plaintext_of_an_old_database(self):
+        self.assertTrue(verify_password("secret", "secret"))
+        self.assertFalse(verify_password("other", "secret"))
+        self.assertTrue(needs_rehash("secret"))
+
+    def test_needs_rehash(self):
+        stored = hash_password("secret", iterations=1000)
+        self.assertFalse(needs_rehash(stored, iterations=1000))
+        self.assertTrue(needs_rehash(stored, iterations=2000))
+
+
+class CredentialCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("credentials.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_check(self):
+        cache = CredentialCache(ttl=60)
+        self.assertFalse(cache.check("alice", "secret"))
+        cache.add("alice", "secret")
+        self.assertTrue(cache.check("alice", "secret"))
+        self.assertFalse(cache.check("alice", "other"))
+        self.assertFalse(cache.check("bob", "secret"))
+        self.assertEqual(cache.stats(), {"users": 1, "hits": 1, "misses": 3})
+
+    def test_expires(self):
+        cache = CredentialCache(ttl=60)
+        cache.add("alice", "secret")
+        self.clock.now += 61
+        self.assertFalse(cache.check("alice", "secret"))
+
+    def test_evicts_least_recently_used(self):
+        cache = CredentialCache(ttl=60, max_size=2)
+        cache.add("alice", "a")
+        cache.add("bob", "b")
+        cache.check("alice", "a")
+        cache.add("carol", "c")
+        self.assertTrue(cache.check("alice", "a"))
+        self.assertFalse(cache.check("bob", "b"))
+
+    def test_discard(self):
+        cache = CredentialCache(ttl=60)
+        cache.add("alice", "secret")
+        cache.discard("alice")
+        self.assertFalse(cache.check("alice", "secret"))
+
+
+class DataBaseLoginTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.db = DataBase(self.backend)
+        self.db.credential_cache = CredentialCache(ttl=60)
+
+    def test_repeated_login_skips_the_storage(self):
+        self.assertTrue(self.db.register("alice", "secret"))
+        self.assertTrue(self.backend.get_password("alice").startswith("pbkdf2_sha256$"))
+        with mock.patch.object(self.backend, "get_password") as get_password:
+            self.assertTrue(self.db.login("alice", "secret"))
+            get_password.assert_not_called()
+
+    def test_wrong_password_is_verified(self):
+        self.db.register("alice", "secret")
+        self.assertFalse(self.db.login("alice", "other"))
+        self.assertFalse(self.db.login("bob", "secret"))
+
+    def test_plaintext_password_is_rehashed(self):
+        self.backend.register("alice", "secret")
+        self.assertTrue(self.db.login("alice", "secret"))
+        stored = self.backend.get_password("alice")
+        self.assertTrue(verify_password("secret", stored))
+        self.assertFalse(needs_rehash(stored))
+
+
+if __name__ == "__main__":
+    unittest.main()
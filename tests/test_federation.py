@@ -0,0 +1,293 @@
+"""
+Federation of several nodes on localhost: every node is a server process of its own
+(started like "python3 server.py --federation ... --peer ..."), the nodes share
+one SQLite database, clients connect to different nodes.
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from chat_util import Message
+from codec import JSON
+from federation import Federation
+from framing import FrameDecoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 10
+
+# config_server is patched before server.py imports its settings
+NODE = """
+import runpy, sys
+import config_server
+config_server.STORAGE_BACKEND = "sqlite"
+config_server.SQLITE_PATH = sys.argv[1]
+config_server.MAX_CONNECTIONS = 100
+config_server.FEDERATION_RETRY = 0.2
+config_server.PASSWORD_HASH_ITERATIONS = 1000
+config_server.LOG_LEVEL = "WARNING"
+sys.argv = ["server.py"] + sys.argv[2:]
+runpy.run_path("server.py", run_name="__main__")
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(predicate, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError("timed out")
+
+
+class Client:
+    """
+    Minimal JSON client, received messages are collected by a reader thread
+    """
+
+    def __init__(self, port: int, username: str, command="/register"):
+        self.username = username
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=TIMEOUT)
+        self.messages = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._read, daemon=True).start()
+        self.send(f"{command} {username}:password", [])
+
+    def _read(self) -> None:
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    with self._lock:
+                        self.messages.append(json.loads(payload))
+        except OSError:
+            pass
+
+    def send(self, text: str, recipients: list) -> None:
+        self.sock.sendall(Message(text, self.username, recipients).encode(JSON))
+
+    def texts(self) -> list:
+        with self._lock:
+            return [message["text"] for message in self.messages]
+
+    def wait_for(self, predicate) -> str:
+        return wait_until(lambda: next((t for t in self.texts() if predicate(t)), None))
+
+    def roster(self) -> set:
+        """
+        :return: who is online according to the snapshot and the presence deltas
+        """
+        online = set()
+        for text in self.texts():
+            words = text.split(" ")
+            if words[0] == "/now_online":
+                online = set(words[2:])
+            elif words[0] == "/presence":
+                for change in words[2:]:
+                    if change.startswith("+"):
+                        online.add(change[1:])
+                    else:
+                        online.discard(change[1:])
+        return online
+
+    def close(self) -> None:
+        # the reader thread is blocked in recv(), close() alone would not end the connection
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class FederationLinkTest(unittest.TestCase):
+    """
+    Federation objects of three nodes in this process, without the chat servers
+    """
+
+    def setUp(self):
+        self.addresses = [f"127.0.0.1:{free_port()}" for _ in range(3)]
+        self.events = {address: [] for address in self.addresses}
+        self.nodes = {}
+        for address in self.addresses:
+            node = Federation(address, self.addresses, retry=0.1)
+            node.connect(
+                lambda header, body, address=address: self.events[address].append((header, body))
+            )
+            self.nodes[address] = node
+        for node in self.nodes.values():
+            wait_until(lambda node=node: len(node.nodes()) == 2)
+
+    def tearDown(self):
+        for node in self.nodes.values():
+            node._sock.close()
+            with node._lock:
+                links = list(node._links.values())
+            for link in links:
+                link.sock.shutdown(socket.SHUT_RDWR)
+
+    def ops(self, address, op) -> list:
+        return [header for header, _ in self.events[address] if header["op"] == op]
+
+    def test_join_claim_and_route(self):
+        first, second, third = (self.nodes[address] for address in self.addresses)
+        first.join("alice")
+        second.join("bob")
+        wait_until(lambda: not third.claim("alice") and not third.claim("bob"))
+        self.assertTrue(first.claim("carol"))
+        self.assertFalse(second.claim("alice"))
+
+        first.publish(b"frame to bob", ["bob", "nobody"])
+        route = wait_until(lambda: self.ops(self.addresses[1], "route"))
+        self.assertEqual(route[0]["to"], ["bob"])
+        events = self.events[self.addresses[1]]
+        bodies = [body for header, body in events if header["op"] == "route"]
+        self.assertEqual(bodies, [b"frame to bob"])
+
+        first.publish(b"frame to all", ["All users"])
+        wait_until(lambda: self.ops(self.addresses[2], "route"))
+        wait_until(lambda: len(self.ops(self.addresses[1], "route")) == 2)
+        # a chat frame crosses a link once, the nodes do not forward it
+        time.sleep(0.2)
+        self.assertEqual(self.ops(self.addresses[0], "route"), [])
+        self.assertEqual(len(self.ops(self.addresses[2], "route")), 1)
+
+    def test_release(self):
+        first, third = self.nodes[self.addresses[0]], self.nodes[self.addresses[2]]
+        first.join("alice")
+        wait_until(lambda: not third.claim("alice"))
+        first.release("alice")
+        wait_until(lambda: third.claim("alice"))
+        leaves = self.ops(self.addresses[2], "leave")
+        self.assertEqual([header["username"] for header in leaves], ["alice"])
+
+    def test_late_node_gets_the_roster(self):
+        first = self.nodes[self.addresses[0]]
+        first.join("alice")
+        address = f"127.0.0.1:{free_port()}"
+        events = []
+        late = Federation(address, self.addresses, retry=0.1)
+        late.connect(lambda header, body: events.append(header))
+        try:
+            wait_until(lambda: not late.claim("alice"))
+            self.assertIn({"op": "join", "username": "alice"}, events)
+        finally:
+            late._sock.close()
+
+
+class FederatedServersTest(unittest.TestCase):
+    """
+    Three server processes, threaded and async, federated on localhost
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        database = os.path.join(cls.directory.name, "chat.sqlite3")
+        federation = [f"127.0.0.1:{free_port()}" for _ in range(3)]
+        cls.ports = [free_port() for _ in range(3)]
+        cls.processes = []
+        peers = [arg for peer in federation for arg in ("--peer", peer)]
+        for i, mode in enumerate(("threaded", "async", "threaded")):
+            cls.processes.append(
+                subprocess.Popen(
+                    [sys.executable, "-c", NODE, database, "--mode", mode,
+                     "--port", str(cls.ports[i]), "--metrics-port", "0",
+                     "--federation", federation[i]] + peers,
+                    cwd=ROOT,
+                )
+            )
+            # one at a time, nodes opening a new SQLite file at once can find it locked
+            wait_until(lambda port=cls.ports[i]: cls._listening(port))
+
+    @classmethod
+    def tearDownClass(cls):
+        for process in cls.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        cls.directory.cleanup()
+
+    @staticmethod
+    def _listening(port) -> bool:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            return False
+
+    def connect(self, node: int, username: str, command="/register") -> Client:
+        client = Client(self.ports[node], username, command)
+        self.addCleanup(client.close)
+        return client
+
+    def logged_in(self, node: int, username: str) -> Client:
+        client = self.connect(node, username)
+        client.wait_for(lambda text: text.startswith("/session "))
+        return client
+
+    def test_messages_cross_nodes(self):
+        alice = self.logged_in(0, "alice")
+        bob = self.logged_in(1, "bob")
+        carol = self.logged_in(2, "carol")
+        for client in (alice, bob, carol):
+            wait_until(lambda client=client: {"alice", "bob", "carol"} <= client.roster())
+
+        alice.send("hello bob", ["bob"])
+        bob.wait_for(lambda text: text == "hello bob")
+
+        carol.send("hello everyone", ["All users"])
+        alice.wait_for(lambda text: text == "hello everyone")
+        bob.wait_for(lambda text: text == "hello everyone")
+
+        bob.send("hello alice and carol", ["alice", "carol"])
+        alice.wait_for(lambda text: text == "hello alice and carol")
+        carol.wait_for(lambda text: text == "hello alice and carol")
+
+        time.sleep(0.3)
+        self.assertEqual(alice.texts().count("hello everyone"), 1)
+        self.assertNotIn("hello bob", carol.texts())
+
+    def test_one_login_in_the_federation(self):
+        self.logged_in(0, "dave")
+        other = self.connect(2, "dave", command="/login")
+        other.wait_for(lambda text: text.startswith("/error user dave already logged"))
+
+    def test_leave_is_announced(self):
+        erin = self.logged_in(1, "erin")
+        frank = self.logged_in(2, "frank")
+        wait_until(lambda: "frank" in erin.roster())
+        frank.close()
+        wait_until(lambda: "frank" not in erin.roster())
+
+    def test_history_is_shared(self):
+        grace = self.logged_in(0, "grace")
+        heidi = self.logged_in(1, "heidi")
+        wait_until(lambda: "heidi" in grace.roster())
+        grace.send("saved once", ["heidi"])
+        heidi.wait_for(lambda text: text == "saved once")
+
+        ivan = self.logged_in(2, "ivan")
+        ivan.send("/load", [])
+        ivan.wait_for(lambda text: text.startswith("/history_end"))
+        heidi.send("/load", [])
+        heidi.wait_for(lambda text: text.startswith("/history_end"))
+        self.assertEqual(heidi.texts().count("saved once"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from framing import encode_frame, FrameDecoder, FrameError, HEADER
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_round_trip(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b"first") + encode_frame(b"") + encode_frame(b"third")
+        self.assertEqual(decoder.feed(data), [b"first", b"", b"third"])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_frame_split_across_reads(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b"x" * 1000) + encode_frame(b"tail")
+        frames = []
+        for i in range(0, len(data), 7):
+            frames += decoder.feed(data[i : i + 7])
+        self.assertEqual(frames, [b"x" * 1000, b"tail"])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_header_split_across_reads(self):
+        decoder = FrameDecoder()
+        frame = encode_frame(b"payload")
+        self.assertEqual(decoder.feed(frame[:2]), [])
+        self.assertEqual(decoder.pending(), 2)
+        self.assertEqual(decoder.feed(frame[2:]), [b"payload"])
+
+    def test_oversized_frame(self):
+        decoder = FrameDecoder(max_frame_size=10)
+        with self.assertRaises(FrameError):
+            decoder.feed(HEADER.pack(11) + b"x" * 11)
+
+    def test_many_frames_keep_buffer_small(self):
+        decoder = FrameDecoder()
+        frame = encode_frame(b"y" * 100)
+        for _ in range(2000):
+            self.assertEqual(decoder.feed(frame), [b"y" * 100])
+        self.assertEqual(len(decoder._buffer), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
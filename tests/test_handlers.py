@@ -0,0 +1,156 @@
+import unittest
+from concurrent.futures import Future
+
+from chat_util import DataBase, Message, User
+from framing import FrameDecoder
+from handlers import Handlers, LoadReply, SearchReply, SyncReply
+from presence import Presence
+from registry import UserRegistry
+from storage import MemoryBackend
+from tests.test_presence import ManualScheduler
+from tests.test_storage import DATETIME
+
+
+class Outbox:
+    closed = False
+
+    def __init__(self):
+        self.frames = []
+
+    def put(self, frame: bytes, essential=False) -> bool:
+        self.frames.append(frame)
+        return True
+
+    def messages(self) -> list:
+        payloads = FrameDecoder().feed(b"".join(self.frames))
+        return [message for payload in payloads for message in Message.decode_all(payload)]
+
+    def texts(self) -> list:
+        return [message.text for message in self.messages()]
+
+
+class HandlersTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.db = DataBase(self.backend)
+        users = UserRegistry()
+        self.handlers = Handlers(
+            users,
+            Presence(users, ManualScheduler()),
+            self.db,
+            admission=None,
+            heartbeat=None,
+            capture=None,
+            call_soon=lambda callback, *args: callback(*args),
+        )
+
+    def online(self, username: str) -> User:
+        self.backend.register(username, "hash")
+        user = User(object(), self.db, username=username)
+        user.outbox = Outbox()
+        self.handlers.users.add(user)
+        self.handlers.users.claim(user)
+        user.logged_in = True
+        return user
+
+    def save(self, text: str, recipients=("bob",)) -> int:
+        (message_id,) = self.backend.save_messages([("alice", list(recipients), text, DATETIME)])
+        return message_id
+
+    @staticmethod
+    def reply(reply) -> None:
+        # what the servers do, without the I/O
+        for records in reply.query():
+            reply.send(records)
+        reply.end()
+
+    def test_load_reply(self):
+        bob = self.online("bob")
+        first, second = self.save("first"), self.save("second")
+        self.reply(LoadReply(bob, "/load 1"))
+        self.assertEqual(bob.outbox.texts(), ["second", f"/history_end {second}"])
+
+        self.reply(LoadReply(bob, f"/load 5 before {second}"))
+        messages = bob.outbox.messages()[2:]
+        self.assertEqual([message.message_id for message in messages[:1]], [first])
+        self.assertEqual(messages[0].author, "alice")
+        self.assertEqual(messages[-1].text, f"/history_end {first}")
+
+    def test_sync_reply(self):
+        bob = self.online("bob")
+        first = self.save("first")
+        second = self.save("second")
+        self.reply(SyncReply(bob, f"/sync {first}"))
+        self.assertEqual(bob.outbox.texts(), ["second", f"/sync_end {second}"])
+        self.assertEqual(bob.outbox.messages()[0].recipients, ("bob",))
+
+        self.reply(SyncReply(bob, f"/sync {second}"))
+        self.assertEqual(bob.outbox.texts()[-1], f"/sync_end {second}")
+
+    def test_search_reply(self):
+        bob = self.online("bob")
+        self.save("apple pie")
+        self.save("pear")
+        self.reply(SearchReply(bob, "/search apple"))
+        self.assertEqual(bob.outbox.texts(), ["apple pie", "/search_end "])
+
+    def test_message_is_delivered_once_saved(self):
+        alice, bob = self.online("alice"), self.online("bob")
+        self.backend.register("carol", "hash")
+        future = self.handlers.submit_message(alice, "hello", ["bob", "carol"])
+        message_id = future.result(timeout=5)
+        # delivered by the done callback on the writer thread
+        self.db.message_writer().close()
+
+        (received,) = bob.outbox.messages()
+        self.assertEqual((received.text, received.message_id), ("hello", message_id))
+        self.assertEqual(alice.outbox.texts(), ["/undelivered carol", f"/sent {message_id}"])
+
+    def test_message_without_recipients_is_not_sent(self):
+        alice = self.online("alice")
+        future = self.handlers.submit_message(alice, "hello", [])
+        self.assertIsNone(future.result(timeout=5))
+        self.assertEqual(alice.outbox.texts(), [])
+
+    def test_message_not_saved_is_not_delivered(self):
+        alice, bob = self.online("alice"), self.online("bob")
+        future = Future()
+        future.set_exception(ValueError("text longer than 2048 characters"))
+        self.handlers.deliver_message(alice, "x" * 3000, ["bob"], DATETIME, future)
+        self.assertEqual(bob.outbox.texts(), [])
+        self.assertEqual(
+            alice.outbox.texts(), ["/error message not saved text longer than 2048 characters"]
+        )
+
+    def test_resume(self):
+        token = self.handlers.sessions.issue("alice")
+        user = User(object(), self.db, address="127.0.0.1:5000")
+        user.outbox = Outbox()
+        self.assertTrue(self.handlers.check_session(f"/resume {token}", user))
+        self.assertEqual(user.username, "alice")
+
+        self.handlers.resume(f"/resume {token}", user)
+        self.assertTrue(user.logged_in)
+        resumed = user.outbox.texts()[0].split(" ")
+        self.assertEqual(resumed[0], "/resumed")
+        self.assertEqual(self.handlers.sessions.verify(resumed[1]), "alice")
+
+    def test_resume_with_an_invalid_token(self):
+        user = User(object(), self.db, address="127.0.0.1:5000")
+        user.outbox = Outbox()
+        self.assertFalse(self.handlers.check_session("/resume alice:1:forged", user))
+        self.assertEqual(user.username, "UNKNOWN_USER")
+        self.assertEqual(user.outbox.texts(), ["/error invalid session"])
+
+    def test_invalid_login_frees_the_username(self):
+        alice = self.online("alice")
+        alice.logged_in = False
+        self.assertFalse(self.handlers.login_checked(alice, False))
+        self.assertEqual(alice.outbox.texts(), ["/error invalid login alice"])
+        other = User(object(), self.db, username="alice")
+        self.handlers.users.add(other)
+        self.assertTrue(self.handlers.users.claim(other))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from heartbeat import Heartbeat, TimerWheel
+from tests.test_ratelimit import Clock
+
+
+class FakeOutbox:
+    closed = False
+
+
+class FakeConnection:
+    def __init__(self, username="alice", logged_in=True):
+        self.username = username
+        self.address = ("127.0.0.1", 5000)
+        self.logged_in = logged_in
+        self.outbox = FakeOutbox()
+        self.received = []
+
+    def send(self, message, essential=False) -> bool:
+        self.received.append(message.text)
+        return True
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("heartbeat.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_expires_in_order_of_deadline(self):
+        wheel = TimerWheel(tick=1, slots=8)
+        now = self.clock.now
+        wheel.schedule(now + 3, "c")
+        wheel.schedule(now + 1, "a")
+        wheel.schedule(now + 2, "b")
+        self.assertEqual(wheel.advance(now + 0.5), [])
+        self.assertEqual(wheel.advance(now + 1), ["a"])
+        self.assertEqual(wheel.advance(now + 3), ["b", "c"])
+        self.assertEqual(wheel.advance(now + 10), [])
+
+    def test_deadline_more_than_a_turn_ahead(self):
+        wheel = TimerWheel(tick=1, slots=4)
+        now = self.clock.now
+        wheel.schedule(now + 10, "late")
+        wheel.schedule(now + 2, "early")
+        # the same slot is passed twice before "late" is due
+        self.assertEqual(wheel.advance(now + 2), ["early"])
+        self.assertEqual(wheel.advance(now + 6), [])
+        self.assertEqual(wheel.advance(now + 9), [])
+        self.assertEqual(wheel.advance(now + 10), ["late"])
+
+    def test_passed_deadline_expires_at_the_next_advance(self):
+        wheel = TimerWheel(tick=1, slots=4)
+        now = self.clock.now
+        wheel.advance(now + 5)
+        wheel.schedule(now, "past")
+        self.assertEqual(wheel.advance(now + 6), ["past"])
+
+    def test_long_pause_visits_every_slot_once(self):
+        wheel = TimerWheel(tick=1, slots=4)
+        now = self.clock.now
+        for i in range(1, 4):
+            wheel.schedule(now + i, i)
+        self.assertEqual(sorted(wheel.advance(now + 100)), [1, 2, 3])
+
+
+class HeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("heartbeat.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.reaped = []
+        self.timers = []
+        self.heartbeat = Heartbeat(
+            lambda delay, callback: self.timers.append(callback),
+            self.reaped.append,
+            idle=10,
+            timeout=5,
+            tick=1,
+            slots=8,
+        )
+
+    def run_for(self, seconds: int, connection=None, receive_every=0) -> None:
+        """
+        Advances the clock a tick at a time, the connection receives a frame every
+        receive_every seconds
+        """
+        for second in range(1, seconds + 1):
+            self.clock.now += 1
+            if receive_every and second % receive_every == 0:
+                connection.last_seen = self.clock.now
+            callbacks, self.timers = self.timers, []
+            for callback in callbacks:
+                callback()
+
+    def test_active_connection_is_never_pinged(self):
+        connection = FakeConnection()
+        self.heartbeat.watch(connection)
+        self.run_for(60, connection, receive_every=3)
+        self.assertEqual(connection.received, [])
+        self.assertEqual(self.reaped, [])
+
+    def test_idle_connection_is_pinged_and_answered(self):
+        connection = FakeConnection()
+        self.heartbeat.watch(connection)
+        self.run_for(10)
+        self.assertEqual(connection.received, ["/ping"])
+
+        connection.last_seen = self.clock.now
+        self.run_for(9)
+        self.assertEqual(self.reaped, [])
+        self.assertEqual(connection.ping_sent, 0.0)
+        self.assertEqual(self.heartbeat.stats(), {"pinged": 1, "reaped": 0})
+
+    def test_dead_connection_is_reaped(self):
+        connection = FakeConnection()
+        self.heartbeat.watch(connection)
+        self.run_for(14)
+        self.assertEqual(self.reaped, [])
+        self.run_for(1)
+        self.assertEqual(self.reaped, [connection])
+        self.run_for(30)
+        self.assertEqual(self.reaped, [connection])
+
+    def test_connection_without_login_is_reaped_without_ping(self):
+        connection = FakeConnection(logged_in=False)
+        self.heartbeat.watch(connection)
+        self.run_for(10)
+        self.assertEqual(connection.received, [])
+        self.assertEqual(self.reaped, [connection])
+
+    def test_closed_connection_is_forgotten(self):
+        connection = FakeConnection()
+        self.heartbeat.watch(connection)
+        connection.outbox.closed = True
+        self.run_for(30)
+        self.assertEqual((connection.received, self.reaped), ([], []))
+
+    def test_one_timer_for_all_connections(self):
+        for i in range(100):
+            self.heartbeat.watch(FakeConnection(f"user{i}"))
+        self.assertEqual(len(self.timers), 1)
+
+    def test_one_thread_ticks_in_threaded_mode(self):
+        heartbeat = Heartbeat(None, self.reaped.append, idle=10, timeout=5, tick=0.01, slots=8)
+        connections = [FakeConnection(f"user{i}") for i in range(3)]
+        for connection in connections:
+            heartbeat.watch(connection)
+        self.clock.now += 10
+        deadline = time.monotonic() + 5
+        while heartbeat.stats()["pinged"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([connection.received for connection in connections], [["/ping"]] * 3)
+        threads = [thread for thread in threading.enumerate() if thread.name == "heartbeat"]
+        self.assertEqual(len(threads), 1)
+
+    def test_disabled(self):
+        heartbeat = Heartbeat(self.timers.append, self.reaped.append, idle=0)
+        heartbeat.watch(FakeConnection())
+        self.assertEqual(self.timers, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
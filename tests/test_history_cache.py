@@ -0,0 +1,84 @@
+import unittest
+
+from history_cache import HistoryCache, record_size
+
+
+def record(message_id: int, author="alice") -> tuple:
+    return (message_id, f"text {message_id}", author, "2024-01-01 00:00:00")
+
+
+class Loader:
+    """
+    Storage of one user's history, records are newest first
+    """
+
+    def __init__(self, records: list):
+        self.records = records
+        self.calls = 0
+
+    def __call__(self, username: str, limit: int) -> list:
+        self.calls += 1
+        return self.records[:limit]
+
+
+class HistoryCacheTest(unittest.TestCase):
+    def test_miss_warms_the_cache(self):
+        loader = Loader([record(i) for i in range(10, 0, -1)])
+        cache = HistoryCache(loader, user_messages=5)
+        self.assertEqual(cache.load("bob", 2), [record(10), record(9)])
+        self.assertEqual(cache.load("bob", 3, before=9), [record(8), record(7), record(6)])
+        self.assertEqual(loader.calls, 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+        # older than the cached messages
+        self.assertIsNone(cache.load("bob", 3, before=7))
+        self.assertEqual(loader.calls, 1)
+
+    def test_complete_history(self):
+        loader = Loader([record(2), record(1)])
+        cache = HistoryCache(loader, user_messages=5)
+        self.assertEqual(cache.load("bob", 5), [record(2), record(1)])
+        self.assertEqual(cache.load("bob", 5, before=1), [])
+        self.assertEqual(cache.load_since("bob", 0, 10), [record(1), record(2)])
+
+    def test_write_through(self):
+        cache = HistoryCache(Loader([record(1)]), user_messages=2)
+        cache.load("bob", 2)
+        cache.add(2, "alice", ["bob"], "text 2", "2024-01-01 00:00:00")
+        # not cached
+        cache.add(3, "alice", ["carol"], "text 3", "2024-01-01 00:00:00")
+        self.assertEqual(cache.load("bob", 5), [record(2), record(1)])
+
+        cache.add(4, "alice", ["All users"], "text 4", "2024-01-01 00:00:00")
+        self.assertEqual(cache.load("bob", 2), [record(4), record(2)])
+        # the oldest message was dropped, the history is not complete any more
+        self.assertIsNone(cache.load_since("bob", 0, 10))
+        self.assertEqual(cache.load_since("bob", 2, 10), [record(4)])
+        self.assertEqual(cache.stats()["messages"], 2)
+
+    def test_evicts_least_recently_used(self):
+        size = record_size(record(1))
+        cache = HistoryCache(Loader([record(1)]), max_messages=10, max_bytes=2 * size)
+        cache.load("alice", 1)
+        cache.load("bob", 1)
+        cache.load("alice", 1)
+        cache.load("carol", 1)
+        stats = cache.stats()
+        self.assertEqual((stats["users"], stats["bytes"], stats["evictions"]), (2, 2 * size, 1))
+        self.assertIsNone(cache.load_since("bob", 0, 1))
+        self.assertEqual(cache.load_since("alice", 0, 1), [record(1)])
+
+    def test_failed_load_is_not_cached(self):
+        def loader(username, limit):
+            raise OSError("database is down")
+
+        cache = HistoryCache(loader)
+        with self.assertRaises(OSError):
+            cache.load("bob", 1)
+        self.assertEqual(cache.stats()["users"], 0)
+        with self.assertRaises(OSError):
+            cache.load("bob", 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
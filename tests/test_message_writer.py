@@ -0,0 +1,118 @@
+import threading
+import unittest
+
+from chat_util import MessageWriter, WriterBusy
+from storage import MemoryBackend, MAX_TEXT_LENGTH
+from tests.test_storage import DATETIME, ids
+
+
+class CountingBackend(MemoryBackend):
+    """
+    Counts the transactions, a batch containing a "fail" text is rolled back,
+    one containing "down" finds the database unavailable
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.transactions = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def save_messages(self, messages: list) -> list:
+        self.release.wait()
+        self.transactions.append(len(messages))
+        if any(text == "fail" for _, _, text, _ in messages):
+            raise ValueError("rolled back")
+        if any(text == "down" for _, _, text, _ in messages):
+            raise ConnectionError("connection refused")
+        return super().save_messages(messages)
+
+
+class MessageWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = CountingBackend()
+        for username in ("alice", "bob"):
+            self.backend.register(username, "hash")
+
+    def writer(self, **kwargs) -> MessageWriter:
+        writer = MessageWriter(self.backend, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def submit_all(self, writer, messages) -> list:
+        # held back, so everything lands in the same batch
+        self.backend.release.clear()
+        futures = [
+            writer.submit("alice", recipients, text, DATETIME) for recipients, text in messages
+        ]
+        self.backend.release.set()
+        for future in futures:
+            future.exception(timeout=5)
+        return futures
+
+    def test_one_transaction_per_batch(self):
+        writer = self.writer(interval=0.05)
+        futures = self.submit_all(writer, [(["bob"], f"m{i}") for i in range(100)])
+        message_ids = [future.result() for future in futures]
+        self.assertEqual(message_ids, sorted(message_ids))
+        self.assertLessEqual(len(self.backend.transactions), 2)
+        self.assertEqual(writer.stats()["saved"], 100)
+
+    def test_invalid_rows_fail_alone(self):
+        writer = self.writer(interval=0.05)
+        futures = self.submit_all(
+            writer,
+            [
+                (["bob"], "first"),
+                (["nobody"], "unknown"),
+                (["All users"], "x" * (MAX_TEXT_LENGTH + 1)),
+            ]
+            + [(["bob"], f"m{i}") for i in range(20)],
+        )
+        self.assertIsInstance(futures[1].exception(), ValueError)
+        self.assertIsInstance(futures[2].exception(), ValueError)
+        self.assertIsNone(futures[0].exception())
+        self.assertEqual(len(ids(self.backend.load_history("bob", limit=100))), 21)
+        # the valid rows are still saved together
+        self.assertLessEqual(len(self.backend.transactions), 2)
+        self.assertEqual(writer.stats()["failed"], 2)
+
+    def test_failed_batch_is_split(self):
+        writer = self.writer(interval=0.05)
+        messages = [(["bob"], f"m{i}") for i in range(63)]
+        messages.insert(40, (["bob"], "fail"))
+        futures = self.submit_all(writer, messages)
+
+        failed = [future for future in futures if future.exception() is not None]
+        self.assertEqual(failed, [futures[40]])
+        self.assertEqual(len(ids(self.backend.load_history("bob", limit=100))), 63)
+        # halving finds the bad row in about 2 log2(64) transactions, not 64
+        self.assertLess(len(self.backend.transactions), 16)
+
+    def test_unavailable_database_fails_the_batch_once(self):
+        writer = self.writer(interval=0.05)
+        messages = [(["bob"], f"m{i}") for i in range(63)]
+        messages.insert(40, (["bob"], "down"))
+        futures = self.submit_all(writer, messages)
+
+        for future in futures:
+            self.assertIsInstance(future.exception(), ConnectionError)
+        self.assertEqual(len(self.backend.transactions), 1)
+        self.assertEqual(writer.stats()["failed"], 64)
+
+    def test_full_queue_never_blocks(self):
+        writer = self.writer(queue_size=3, interval=0.05)
+        self.backend.release.clear()
+        try:
+            writer.submit("alice", ["bob"], "taken by the writer", DATETIME)
+            futures = []
+            with self.assertRaises(WriterBusy):
+                for i in range(10):
+                    futures.append(writer.submit("alice", ["bob"], f"m{i}", DATETIME))
+            self.assertLessEqual(len(futures), 4)
+        finally:
+            self.backend.release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from metrics import Registry
+
+
+class RegistryTest(unittest.TestCase):
+    def test_collect(self):
+        registry = Registry()
+        registry.collect(
+            "chat_writer", "Writer", lambda: {"queued": 3, "saved": 10, "name": "x"},
+            counters=("saved",),
+        )
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE chat_writer_queued gauge", lines)
+        self.assertIn("chat_writer_queued 3", lines)
+        self.assertIn("# TYPE chat_writer_saved_total counter", lines)
+        self.assertIn("chat_writer_saved_total 10", lines)
+        self.assertFalse(any("name" in line for line in lines))
+
+    def test_collect_with_a_label(self):
+        registry = Registry()
+        registry.collect(
+            "chat_outbox",
+            "Outbox",
+            lambda: {"alice": {"depth": 1, "dropped": 0}, 'b"ob': {"depth": 4, "dropped": 2}},
+            counters=("dropped",),
+            label="user",
+        )
+        lines = registry.render().splitlines()
+        self.assertEqual(
+            lines,
+            [
+                "# HELP chat_outbox_depth Outbox, depth",
+                "# TYPE chat_outbox_depth gauge",
+                'chat_outbox_depth{user="alice"} 1',
+                'chat_outbox_depth{user="b\\"ob"} 4',
+                "# HELP chat_outbox_dropped_total Outbox, dropped",
+                "# TYPE chat_outbox_dropped_total counter",
+                'chat_outbox_dropped_total{user="alice"} 0',
+                'chat_outbox_dropped_total{user="b\\"ob"} 2',
+            ],
+        )
+
+    def test_failing_collector_is_skipped(self):
+        registry = Registry()
+        registry.collect("chat_broken", "Broken", lambda: 1 / 0)
+        registry.collect("chat_ok", "Ok", lambda: {"value": 1})
+        self.assertIn("chat_ok_value 1", registry.render().splitlines())
+
+
+if __name__ == "__main__":
+    unittest.main()
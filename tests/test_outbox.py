@@ -0,0 +1,98 @@
+import socket
+import unittest
+
+from outbox import Outbox, ThreadedOutbox
+
+
+class ManualOutbox(Outbox):
+    """
+    Outbox without a writer, the test takes the batches
+    """
+
+    aborted = False
+
+    def _wakeup(self) -> None:
+        pass
+
+    def _abort(self) -> None:
+        self.aborted = True
+
+
+def manual_outbox(policy: str) -> ManualOutbox:
+    return ManualOutbox(max_frames=2, max_bytes=100, policy=policy, coalesce_bytes=10)
+
+
+class OutboxTest(unittest.TestCase):
+    def test_drop(self):
+        outbox = manual_outbox("drop")
+        self.assertTrue(outbox.put(b"1"))
+        self.assertTrue(outbox.put(b"2"))
+        self.assertFalse(outbox.put(b"3"))
+        # presence and replies go over the limit
+        self.assertTrue(outbox.put(b"4", essential=True))
+        self.assertEqual(outbox._take_batch(), [b"1", b"2", b"4"])
+        self.assertTrue(outbox.put(b"5"))
+        stats = outbox.stats()
+        self.assertEqual((stats["dropped"], stats["max_depth"], stats["evicted"]), (1, 3, False))
+
+    def test_disconnect(self):
+        outbox = manual_outbox("disconnect")
+        outbox.put(b"1")
+        outbox.put(b"2")
+        self.assertFalse(outbox.put(b"3"))
+        self.assertTrue(outbox.aborted)
+        self.assertTrue(outbox.closed)
+        self.assertEqual(outbox.stats()["depth"], 0)
+        self.assertFalse(outbox.put(b"4", essential=True))
+
+    def test_presence_only(self):
+        outbox = ManualOutbox(max_frames=10, max_bytes=40, policy="presence_only")
+        self.assertTrue(outbox.put(b"x" * 40))
+        self.assertFalse(outbox.put(b"chat"))
+        self.assertTrue(outbox.degraded)
+        self.assertTrue(outbox.put(b"presence", essential=True))
+        # not before the queue drains to half of its size
+        self.assertFalse(outbox.put(b"c"))
+        outbox._take_batch()
+        self.assertFalse(outbox.degraded)
+        self.assertTrue(outbox.put(b"chat"))
+
+    def test_essential_frames_are_bounded(self):
+        outbox = manual_outbox("drop")
+        self.assertTrue(outbox.put(b"x" * 100))
+        self.assertTrue(outbox.put(b"x" * 100, essential=True))
+        self.assertFalse(outbox.put(b"x", essential=True))
+        self.assertTrue(outbox.evicted)
+
+    def test_batches_are_coalesced(self):
+        outbox = ManualOutbox(max_frames=10, coalesce_bytes=4)
+        for frame in (b"ab", b"cd", b"ef", b"g"):
+            outbox.put(frame)
+        self.assertEqual(outbox._take_batch(), [b"ab", b"cd"])
+        self.assertEqual(outbox._take_batch(), [b"ef", b"g"])
+        self.assertEqual(outbox._take_batch(), [])
+        self.assertEqual(outbox.stats()["writes"], 2)
+
+
+class ThreadedOutboxTest(unittest.TestCase):
+    def test_writes_queued_frames_before_closing(self):
+        server, client = socket.socketpair()
+        self.addCleanup(client.close)
+        outbox = ThreadedOutbox(server, max_frames=100, policy="drop")
+        for frame in (b"one ", b"two ", b"three"):
+            outbox.put(frame)
+        outbox.close()
+        client.settimeout(5)
+
+        received = b""
+        while True:
+            data = client.recv(1024)
+            if not data:
+                break
+            received += data
+        self.assertEqual(received, b"one two three")
+        self.assertEqual(outbox.stats()["sent_frames"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+
+from presence import Presence
+from tests.test_registry import FakeUser
+from registry import UserRegistry
+
+
+class ManualScheduler:
+    """
+    Collects the scheduled callbacks, run() calls them like the timer would
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def __call__(self, delay, callback) -> None:
+        self.callbacks.append(callback)
+
+    def run(self) -> None:
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def online(registry, username) -> FakeUser:
+    user = FakeUser(username)
+    registry.add(user)
+    registry.claim(user)
+    return user
+
+
+def version(text: str) -> str:
+    return text.split(" ")[1]
+
+
+class PresenceTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = UserRegistry()
+        self.scheduler = ManualScheduler()
+        self.presence = Presence(self.registry, self.scheduler)
+        self.watcher = online(self.registry, "watcher")
+
+    def change(self, joined=(), left=()) -> None:
+        for username in joined:
+            self.presence.join(username)
+        for username in left:
+            self.presence.leave(username)
+        self.scheduler.run()
+
+    def test_changes_are_coalesced(self):
+        self.presence.join("alice")
+        self.presence.join("bob")
+        self.presence.leave("carol")
+        self.assertEqual(len(self.scheduler.callbacks), 1)
+        self.scheduler.run()
+        self.assertEqual(
+            self.watcher.received, [f"/presence {self.presence.epoch}.1 +alice +bob -carol"]
+        )
+
+    def test_join_and_leave_cancel_out(self):
+        self.change(joined=["alice"], left=["alice"])
+        self.assertEqual(self.watcher.received, [])
+        self.assertEqual(self.presence.version, 0)
+
+    def test_snapshot(self):
+        self.change(joined=["watcher"])
+        user = FakeUser("new")
+        self.presence.snapshot(user)
+        self.assertEqual(user.received, [f"/now_online {self.presence.epoch}.1 watcher"])
+
+    def test_catch_up_sends_the_missed_deltas(self):
+        self.change(joined=["alice"])
+        seen = version(self.watcher.received[-1])
+        self.change(joined=["bob"])
+        self.change(left=["alice"])
+
+        user = FakeUser("resumed")
+        self.presence.catch_up(user, seen)
+        self.assertEqual(user.received, self.watcher.received[1:])
+
+        up_to_date = FakeUser("up_to_date")
+        self.presence.catch_up(up_to_date, version(self.watcher.received[-1]))
+        self.assertEqual(up_to_date.received, [])
+
+    def test_catch_up_of_another_roster_is_a_snapshot(self):
+        self.change(joined=["alice"])
+        self.change(joined=["bob"])
+        other = Presence(UserRegistry(), ManualScheduler())
+        self.assertNotEqual(other.epoch, self.presence.epoch)
+
+        # same number, different worker: its deltas are not the ones the client missed
+        for seen in (f"{other.epoch}.1", "1", "", "garbage", f"{self.presence.epoch}.x"):
+            user = FakeUser("resumed")
+            self.presence.catch_up(user, seen)
+            self.assertEqual(len(user.received), 1, seen)
+            self.assertTrue(user.received[0].startswith("/now_online "), seen)
+
+    def test_catch_up_beyond_the_history_is_a_snapshot(self):
+        self.change(joined=["alice"])
+        seen = version(self.watcher.received[-1])
+        for i in range(self.presence._history.maxlen + 1):
+            self.change(joined=[f"user{i}"])
+
+        user = FakeUser("resumed")
+        self.presence.catch_up(user, seen)
+        self.assertEqual(len(user.received), 1)
+        self.assertTrue(user.received[0].startswith("/now_online "))
+
+    def test_catch_up_from_the_future_is_a_snapshot(self):
+        user = FakeUser("resumed")
+        self.presence.catch_up(user, f"{self.presence.epoch}.5")
+        self.assertTrue(user.received[0].startswith("/now_online "))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+
+from ratelimit import RateLimiter, TokenBucket, is_expensive
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("ratelimit.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_is_expensive(self):
+        for text in ("/load", "/load 10 before 5", "/sync 3", "/search a", "/now_online"):
+            self.assertTrue(is_expensive(text), text)
+        for text in ("hello", "/pong", "/ping"):
+            self.assertFalse(is_expensive(text), text)
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(messages=10, messages_burst=20, bytes_rate=0, commands=0)
+        self.assertEqual(sum(limiter.allow(10) for _ in range(30)), 20)
+        self.assertEqual(limiter.stats(), {"allowed": 20, "throttled": 10})
+        self.assertAlmostEqual(limiter.retry_after(10), 0.1)
+
+        self.clock.now += 0.5
+        self.assertEqual(sum(limiter.allow(10) for _ in range(10)), 5)
+
+    def test_commands_have_their_own_budget(self):
+        limiter = RateLimiter(
+            messages=1, messages_burst=1, bytes_rate=0, commands=1, commands_burst=2
+        )
+        self.assertTrue(limiter.allow(10))
+        self.assertFalse(limiter.allow(10))
+        self.assertTrue(limiter.allow(10, command=True))
+        self.assertTrue(limiter.allow(10, command=True))
+        self.assertFalse(limiter.allow(10, command=True))
+
+    def test_bytes(self):
+        limiter = RateLimiter(messages=0, bytes_rate=1000, bytes_burst=1000, commands=0)
+        self.assertTrue(limiter.allow(800))
+        self.assertFalse(limiter.allow(800))
+        self.assertAlmostEqual(limiter.retry_after(800), 0.6)
+        # a throttled frame takes no tokens
+        self.assertTrue(limiter.allow(200))
+
+    def test_frame_larger_than_the_burst_passes_with_a_full_bucket(self):
+        limiter = RateLimiter(messages=0, bytes_rate=100, bytes_burst=100, commands=0)
+        self.assertTrue(limiter.allow(5000))
+        self.assertFalse(limiter.allow(1))
+        self.clock.now += 1
+        self.assertTrue(limiter.allow(5000))
+
+    def test_zero_rate_never_limits(self):
+        bucket = TokenBucket(0, 0)
+        self.assertTrue(bucket.has(10 ** 9))
+        self.assertEqual(bucket.wait(10 ** 9), 0.0)
+
+    def test_flooding(self):
+        limiter = RateLimiter(messages=1, messages_burst=1, bytes_rate=0, commands=0)
+        with mock.patch("ratelimit.RATE_DISCONNECT_AFTER", 5):
+            limiter.allow(1)
+            for _ in range(4):
+                limiter.allow(1)
+            self.assertFalse(limiter.flooding)
+            limiter.allow(1)
+            self.assertTrue(limiter.flooding)
+
+            self.clock.now += 1
+            limiter.allow(1)
+            self.assertFalse(limiter.flooding)
+
+
+if __name__ == "__main__":
+    unittest.main()
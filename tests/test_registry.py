@@ -0,0 +1,120 @@
+import unittest
+
+from chat_util import Message
+from registry import UserRegistry
+
+
+class FakeUser:
+    def __init__(self, username, logged_in=True):
+        self.socket = object()
+        self.username = username
+        self.logged_in = logged_in
+        self.received = []
+
+    def send(self, message, essential=False) -> bool:
+        self.received.append(message.text)
+        return True
+
+
+class FakeBus:
+    def __init__(self, taken=()):
+        self.taken = set(taken)
+        self.published = []
+        self.released = []
+
+    def claim(self, username) -> bool:
+        return username not in self.taken
+
+    def release(self, username) -> None:
+        self.released.append(username)
+
+    def publish(self, frame, recipients) -> None:
+        self.published.append(list(recipients))
+
+
+def login(registry, username) -> FakeUser:
+    user = FakeUser(username)
+    registry.add(user)
+    assert registry.claim(user)
+    return user
+
+
+class UserRegistryTest(unittest.TestCase):
+    def test_claim_is_exclusive(self):
+        registry = UserRegistry()
+        first = login(registry, "alice")
+        second = FakeUser("alice")
+        registry.add(second)
+        self.assertFalse(registry.claim(second))
+        self.assertTrue(registry.claim(first))
+
+        registry.remove(first)
+        self.assertTrue(registry.claim(second))
+        self.assertNotIn(first, registry)
+        self.assertIn(second, registry)
+
+    def test_remove_of_a_duplicate_keeps_the_owner(self):
+        registry = UserRegistry()
+        owner = login(registry, "alice")
+        duplicate = FakeUser("alice")
+        registry.add(duplicate)
+        registry.remove(duplicate)
+        self.assertIs(registry.get("alice"), owner)
+
+    def test_user_logging_in_is_not_online(self):
+        registry = UserRegistry()
+        user = login(registry, "alice")
+        user.logged_in = False
+        self.assertIsNone(registry.get("alice"))
+        self.assertEqual(registry.usernames(), [])
+        self.assertEqual(registry.logged_in_count(), 1)
+
+    def test_route(self):
+        registry = UserRegistry()
+        alice, bob, carol = (login(registry, name) for name in ("alice", "bob", "carol"))
+        message = Message("hi", "alice", ["bob", "dave"])
+        undelivered = registry.route(message, ["bob", "bob", "dave"], sender=alice)
+        self.assertEqual(undelivered, ["dave"])
+        self.assertEqual(bob.received, ["hi"])
+        self.assertEqual(carol.received, [])
+        self.assertEqual(alice.received, [])
+
+    def test_route_to_all_users_skips_the_sender(self):
+        registry = UserRegistry()
+        alice, bob, carol = (login(registry, name) for name in ("alice", "bob", "carol"))
+        message = Message("hi all", "alice", ["All users"])
+        self.assertEqual(registry.route(message, ["All users"], sender=alice), [])
+        self.assertEqual(alice.received, [])
+        self.assertEqual((bob.received, carol.received), (["hi all"], ["hi all"]))
+
+    def test_route_over_the_bus(self):
+        bus = FakeBus(taken={"eve"})
+        registry = UserRegistry(bus)
+        login(registry, "alice")
+        registry.set_remote(["bob"])
+        self.assertEqual(sorted(registry.usernames()), ["alice", "bob"])
+
+        eve = FakeUser("eve")
+        registry.add(eve)
+        self.assertFalse(registry.claim(eve))
+        self.assertIsNone(registry.get("eve"))
+
+        message = Message("hi", "alice", ["bob", "dave"])
+        self.assertEqual(registry.route(message, ["bob", "dave"]), ["dave"])
+        registry.route(Message("all", "alice", ["All users"]), ["All users"])
+        self.assertEqual(bus.published, [["bob"], ["All users"]])
+
+        registry.remove_remote("bob")
+        self.assertEqual(registry.route(message, ["bob"]), ["bob"])
+
+    def test_deliver(self):
+        registry = UserRegistry()
+        alice, bob = login(registry, "alice"), login(registry, "bob")
+        registry.deliver(Message("from the bus", "zed", ["alice"]), ["alice", "nobody"])
+        registry.deliver(Message("to all", "zed", ["All users"]), ["All users"], sender=bob)
+        self.assertEqual(alice.received, ["from the bus", "to all"])
+        self.assertEqual(bob.received, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
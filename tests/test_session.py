@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+
+from session import SessionTokens
+
+SECRET = b"secret"
+
+
+class SessionTokensTest(unittest.TestCase):
+    def test_issue_and_verify(self):
+        tokens = SessionTokens(SECRET, ttl=60)
+        token = tokens.issue("alice")
+        self.assertEqual(tokens.verify(token), "alice")
+        # the secret is shared by the workers, not kept per process
+        self.assertEqual(SessionTokens(SECRET).verify(token), "alice")
+
+    def test_username_with_a_colon(self):
+        tokens = SessionTokens(SECRET)
+        self.assertEqual(tokens.verify(tokens.issue("a:b")), "a:b")
+
+    def test_forged_token(self):
+        tokens = SessionTokens(SECRET)
+        username, expires, signature = tokens.issue("alice").split(":")
+        for token in (
+            f"mallory:{expires}:{signature}",
+            f"alice:{int(expires) + 3600}:{signature}",
+            SessionTokens(b"other").issue("alice"),
+            "alice",
+            "",
+        ):
+            self.assertIsNone(tokens.verify(token), token)
+
+    def test_expired_token(self):
+        tokens = SessionTokens(SECRET, ttl=60)
+        with mock.patch("session.time.time", return_value=1000.0):
+            token = tokens.issue("alice")
+        with mock.patch("session.time.time", return_value=1060.0):
+            self.assertEqual(tokens.verify(token), "alice")
+        with mock.patch("session.time.time", return_value=1061.0):
+            self.assertIsNone(tokens.verify(token))
+
+
+if __name__ == "__main__":
+    unittest.main()
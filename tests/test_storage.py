@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from config_server import SERVER_NAME
+from storage import MemoryBackend, SQLiteBackend, search_terms
+
+DATETIME = "2024-01-01 10:00:00"
+
+
+def rows(chunks) -> list:
+    return [record for chunk in chunks for record in chunk]
+
+
+def ids(chunks) -> list:
+    return [record[0] for record in rows(chunks)]
+
+
+class BackendTests:
+    """
+    Behaviour every StorageBackend shares, mixed into a TestCase per backend
+    """
+
+    def create_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.backend = self.create_backend()
+        for username in ("alice", "bob", "carol"):
+            self.assertTrue(self.backend.register(username, f"hash of {username}"))
+
+    def save(self, author, recipients, text) -> int:
+        (message_id,) = self.backend.save_messages([(author, recipients, text, DATETIME)])
+        return message_id
+
+    def test_accounts(self):
+        self.assertFalse(self.backend.register("alice", "other"))
+        self.assertEqual(self.backend.get_password("alice"), "hash of alice")
+        self.assertIsNone(self.backend.get_password("nobody"))
+
+        self.backend.set_password("alice", "new hash")
+        self.assertEqual(self.backend.get_password("alice"), "new hash")
+        self.assertEqual(
+            self.backend.existing_users(["alice", "nobody", "carol"]), {"alice", "carol"}
+        )
+        self.assertEqual(self.backend.existing_users([]), set())
+
+    def test_save_messages_in_one_batch(self):
+        message_ids = self.backend.save_messages(
+            [("alice", ["bob"], f"message {i}", DATETIME) for i in range(5)]
+        )
+        self.assertEqual(message_ids, sorted(message_ids))
+        self.assertEqual(len(set(message_ids)), 5)
+        records = rows(self.backend.load_history("bob", limit=10))
+        self.assertEqual(
+            [record[1] for record in records], [f"message {i}" for i in range(4, -1, -1)]
+        )
+        self.assertEqual(records[0][2], "alice")
+
+    def test_history_of_a_user(self):
+        to_bob = self.save("alice", ["bob"], "to bob")
+        to_carol = self.save("alice", ["carol"], "to carol")
+        from_bob = self.save("bob", ["alice", "carol"], "from bob")
+        broadcast = self.save("carol", ["All users"], "to everyone")
+
+        self.assertEqual(ids(self.backend.load_history("bob")), [broadcast, from_bob, to_bob])
+        self.assertEqual(
+            ids(self.backend.load_history("alice")), [broadcast, from_bob, to_carol, to_bob]
+        )
+        self.assertEqual(
+            ids(self.backend.load_history("carol")), [broadcast, from_bob, to_carol]
+        )
+
+    def test_broadcasts_reach_later_users(self):
+        broadcast = self.save("alice", ["All users"], "welcome")
+        self.assertTrue(self.backend.register("dave", "hash"))
+        self.assertEqual(ids(self.backend.load_history("dave")), [broadcast])
+        self.assertEqual(ids(self.backend.load_since("dave", 0)), [broadcast])
+
+    def test_pages(self):
+        visible = []
+        for i in range(25):
+            visible.append(self.save("alice", ["bob"], f"m{i}"))
+            if i % 5 == 0:
+                self.save("carol", ["alice"], f"hidden {i}")
+            if i % 7 == 0:
+                visible.append(self.save("carol", ["All users"], f"all {i}"))
+        newest = visible[::-1]
+
+        first = ids(self.backend.load_history("bob", limit=10))
+        self.assertEqual(first, newest[:10])
+        second = ids(self.backend.load_history("bob", limit=10, before=first[-1]))
+        self.assertEqual(second, newest[10:20])
+
+        since = ids(self.backend.load_since("bob", visible[19], limit=3))
+        self.assertEqual(since, visible[20:23])
+
+    def test_chunks(self):
+        for i in range(7):
+            self.save("alice", ["bob"], f"m{i}")
+        chunks = list(self.backend.load_history("bob", limit=7, chunk_size=3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+
+    def test_search(self):
+        apple = self.save("alice", ["bob"], "an apple a day")
+        both = self.save("bob", ["alice"], "apple and pear, apple again")
+        self.save("alice", ["carol"], "apple for carol")
+        broadcast = self.save("carol", ["All users"], "Apple pie for everyone")
+        self.save("alice", ["bob"], "only a pear")
+
+        found = ids(self.backend.search("bob", search_terms("apple")))
+        self.assertEqual(sorted(found), sorted([apple, both, broadcast]))
+        # the message with the most occurrences first
+        self.assertEqual(found[0], both)
+
+        self.assertEqual(ids(self.backend.search("bob", search_terms("PEAR apple"))), [both])
+        self.assertEqual(ids(self.backend.search("bob", search_terms("banana"))), [])
+        self.assertEqual(ids(self.backend.search("bob", [])), [])
+
+        first = ids(self.backend.search("bob", ["apple"], limit=2))
+        rest = ids(self.backend.search("bob", ["apple"], limit=2, offset=2))
+        self.assertEqual(len(first), 2)
+        self.assertEqual(sorted(first + rest), sorted(found))
+
+
+class MemoryBackendTest(BackendTests, unittest.TestCase):
+    def create_backend(self):
+        return MemoryBackend()
+
+
+class SQLiteBackendTest(BackendTests, unittest.TestCase):
+    def create_backend(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "chat.sqlite3")
+        return SQLiteBackend(self.path)
+
+    def test_unknown_recipient_fails_the_transaction(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.backend.save_messages(
+                [("alice", ["bob"], "saved", DATETIME), ("alice", ["nobody"], "x", DATETIME)]
+            )
+        self.assertEqual(ids(self.backend.load_history("bob")), [])
+
+    def test_server_account_is_hashed_once(self):
+        with mock.patch("storage.hash_password", return_value="hash") as hash_password:
+            SQLiteBackend(self.path)
+            SQLiteBackend(self.path).init()
+        hash_password.assert_not_called()
+        self.assertIsNotNone(self.backend.get_password(SERVER_NAME))
+
+    def test_messages_before_the_search_index_are_indexed(self):
+        message_id = self.save("alice", ["bob"], "old database")
+        connection = sqlite3.connect(self.path)
+        connection.execute("DROP TABLE messages_search;")
+        connection.commit()
+        connection.close()
+
+        reopened = SQLiteBackend(self.path)
+        self.assertEqual(ids(reopened.search("bob", ["old"])), [message_id])
+        self.assertEqual(ids(reopened.search("carol", ["old"])), [])
+
+
+if __name__ == "__main__":
+    unittest.main()